@@ -0,0 +1,157 @@
+# Copyright 2018 Xu Chen All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Synchronous collectives between the training processes of one run.
+
+The processes are connected in a star around rank 0 through sockets of
+multiprocessing.connection, so the same run works with local processes
+talking over localhost and with processes on other machines.
+
+rank 1 ──┐
+rank 2 ──┼── rank 0 <--- listens on {address}, sums in rank order and
+  ...    │              sends the same result back to every rank
+rank N ──┘
+
+Every array goes through the sockets as one contiguous float32 buffer, and
+since rank 0 sends the very same bytes to every rank, all the processes
+apply bitwise identical updates and their variables never drift apart.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import pickle
+from multiprocessing import connection
+import numpy as np
+
+class Collective(object):
+    """Collectives between {num_workers} processes connected through rank 0."""
+
+    def __init__(self, rank, num_workers, address, authkey=b'deepdream', timeout_secs=600):
+        """Connect the process to the other ranks, blocks until all of them joined.
+
+        Args:
+            rank: the rank of this process, 0 ~ num_workers - 1;
+            num_workers: total number of processes;
+            address: 'host:port' that rank 0 listens on and the others connect to;
+            authkey: shared secret of the connections;
+            timeout_secs: how long the other ranks keep trying to reach rank 0.
+        """
+        assert 0 <= rank < num_workers
+        self.rank = rank
+        self.num_workers = num_workers
+        host, port = address.rsplit(':', 1)
+        address = (host, int(port))
+        # connections to the other ranks in rank order, rank 0 only
+        self._conns = []
+        # connection to rank 0, the other ranks only
+        self._conn = None
+
+        if num_workers == 1:
+            return
+        if rank == 0:
+            listener = connection.Listener(address, authkey=authkey)
+            try:
+                conns = {}
+                while len(conns) < num_workers - 1:
+                    conn = listener.accept()
+                    conns[conn.recv()] = conn
+            finally:
+                listener.close()
+            self._conns = [conns[r] for r in range(1, num_workers)]
+        else:
+            # rank 0 may still be starting up
+            start = time.time()
+            while True:
+                try:
+                    self._conn = connection.Client(address, authkey=authkey)
+                    break
+                except (OSError, EOFError):
+                    if time.time() - start > timeout_secs:
+                        raise
+                    time.sleep(1)
+            self._conn.send(rank)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def allreduce_mean(self, arrays):
+        """Average the given arrays over all the ranks.
+
+        Args:
+            arrays: list of numpy arrays, the same shapes on every rank.
+        Returns:
+            list of the float32 averaged arrays, identical on every rank.
+        """
+        arrays = [np.asarray(arr, dtype=np.float32) for arr in arrays]
+        if self.num_workers == 1:
+            return arrays
+        flat = np.concatenate([arr.ravel() for arr in arrays])
+
+        if self.rank == 0:
+            total = flat.copy()
+            buf = np.empty_like(flat)
+            # sum in rank order, so the result does not depend on timing
+            for conn in self._conns:
+                conn.recv_bytes_into(buf)
+                total += buf
+            total /= self.num_workers
+            data = total.tobytes()
+            for conn in self._conns:
+                conn.send_bytes(data)
+        else:
+            self._conn.send_bytes(flat.tobytes())
+            total = np.empty_like(flat)
+            self._conn.recv_bytes_into(total)
+
+        # split back into the shapes of the arrays
+        results = []
+        offset = 0
+        for arr in arrays:
+            results.append(total[offset:offset+arr.size].reshape(arr.shape))
+            offset += arr.size
+        return results
+
+    def broadcast(self, obj=None):
+        """Send a picklable object of rank 0 to every rank.
+
+        Args:
+            obj: the object to send, only used on rank 0.
+        Returns:
+            the object of rank 0.
+        """
+        if self.num_workers == 1:
+            return obj
+        if self.rank == 0:
+            data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+            for conn in self._conns:
+                conn.send_bytes(data)
+            return obj
+        return pickle.loads(self._conn.recv_bytes())
+
+    def barrier(self):
+        """Block until every rank reached the barrier."""
+        self.allreduce_mean([np.zeros(1)])
+
+    def close(self):
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
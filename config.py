@@ -18,7 +18,13 @@ import tensorflow as tf
 FLAGS = tf.flags.FLAGS
 
 tf.flags.DEFINE_integer('num_gpus', 2,
-                        'Number of GPUs available.')
+                        'Number of GPUs available, or number of replicas of the\n'
+                        'single and cpu_replicas device strategies.')
+tf.flags.DEFINE_string('device_strategy', 'multi_gpu',
+                       'train, ensemble: placement of the replicas of the model;\n'
+                       'single: all the replicas on one device, run one after another;\n'
+                       'cpu_replicas: every replica on its own virtual CPU device, run concurrently;\n'
+                       'multi_gpu: replica i on gpu:i.')
 tf.flags.DEFINE_integer('total_batch_size', 1,
                         'The total batch size for each batch. It will be splitted into num_gpus partitions.')
 tf.flags.DEFINE_integer('save_epochs', 10,
@@ -33,6 +39,8 @@ tf.flags.DEFINE_string('split', 'train',
 tf.flags.DEFINE_string('mode', 'train',
                        'train: train the model;\n'
                        'evaluate: evaluate the model for both training and testing set using different evaluation metrics;\n'
+                       'ensemble: evaluate the ensemble predictions of every ckpt for a sweep of thresholds;\n'
+                       'export: export a frozen inference graph of the latest ckpt for the explorations;\n'
                        'glitch: find examples the were predicted into wrong class;\n'
                        'Capsule Norm:\n'
                        '    naive_max_norm, max_norm_diff,\n'
@@ -52,6 +60,34 @@ tf.flags.DEFINE_string('model', 'cap',
                        'cap or cnn.')
 tf.flags.DEFINE_string('summary_dir', './summary',
                        'The directory to write results.')
+tf.flags.DEFINE_integer('num_workers', 1,
+                        'Number of local worker processes;\n'
+                        'train: number of synchronous data-parallel training processes, each with\n'
+                        '    one tower on its own shard of the training set;\n'
+                        'evaluate: evaluate the ckpts in parallel;\n'
+                        'Capsule Norm, Capsule Direction: explore the shards, only used when num_shards > 1.')
+tf.flags.DEFINE_integer('rank', None,
+                        'train: only run this rank of the num_workers training processes, e.g. when\n'
+                        'the other ranks run on other machines; by default all of them run locally.')
+tf.flags.DEFINE_string('collective_address', 'localhost:29500',
+                       'train: host:port that rank 0 listens on and the other training processes\n'
+                       'connect to.')
+tf.flags.DEFINE_string('ensemble_thresholds', '0.0:1.0:51',
+                       'ensemble: thresholds to sweep at once, start:stop:num of np.linspace\n'
+                       'or a comma separated list.')
+tf.flags.DEFINE_boolean('export_remake', False,
+                        'export: whether to keep the reconstruction subnetwork in the exported graph.')
+tf.flags.DEFINE_boolean('watch', False,
+                        'evaluate: keep watching the train directory of a running training and\n'
+                        'evaluate every new ckpt as soon as it is saved.')
+tf.flags.DEFINE_integer('watch_interval', 60,
+                        'evaluate with watch: seconds between two checks for new ckpts.')
+tf.flags.DEFINE_integer('watch_timeout', 3600,
+                        'evaluate with watch: stop when no new ckpt shows up for this many seconds.')
+tf.flags.DEFINE_boolean('streaming_input', False,
+                        'train, evaluate, test: stream the examples from the memory mapped\n'
+                        'cache of the dataset instead of embedding the whole split in the graph,\n'
+                        'which keeps the saved meta graphs small and the memory bounded.')
 
 ###### Norm & Direction only ######
 tf.flags.DEFINE_integer('iter_n', 101,
@@ -61,6 +97,16 @@ tf.flags.DEFINE_integer('iter_n', 101,
                         ' 10, 20, 40, 60, 80, 100\n')
 tf.flags.DEFINE_string('step', '1.0',
                        'Step size for each iteration.')
+tf.flags.DEFINE_boolean('in_graph_ascent', False,
+                        'Whether to run the whole gradient ascent inside the graph\n'
+                        'with a tf.while_loop, so every image only takes one session call.')
+tf.flags.DEFINE_integer('dream_seed', None,
+                        'Seed to randomly select the images of every class (or to produce\n'
+                        'the noise images), by default the first images of every class are used.')
+tf.flags.DEFINE_integer('num_shards', 1,
+                        'Number of shards to split the images of the exploration into, every\n'
+                        'shard is claimed by one worker through a lock file in the summary_dir,\n'
+                        'so workers on other machines sharing the summary_dir may join the run.')
 ###################################
 tf.flags.DEFINE_string('threshold', '0.0',
                        'Capsule Norm, Capsule Direction:\n'
@@ -71,6 +117,7 @@ tf.flags.DEFINE_string('threshold', '0.0',
 def default_hparams():
     """Builds an HParams object with default hperparameters."""
     return tf.contrib.training.HParams(
+        data_format='NCHW',
         decay_rate=0.96,
         decay_steps=2000,
         leaky=False,
@@ -78,6 +125,7 @@ def default_hparams():
         loss_type='margin',
         num_prime_capsules=32,
         padding='VALID',
+        reassemble=False,
         remake=True,
         routing=3,
         verbose=False)
\ No newline at end of file
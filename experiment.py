@@ -28,22 +28,33 @@ import os
 import sys 
 import time 
 import re 
+import json
+import errno
+import socket
+import multiprocessing
 from glob import glob
 from pprint import pprint
 import numpy as np 
 import tensorflow as tf 
+from tensorflow.tools.graph_transforms import TransformGraph
 
 from input_data.mnist import mnist_input, mnist_dream_inputs
 from input_data.fashion_mnist import fashion_mnist_input, fashion_mnist_dream_input
 from input_data.svhn import svhn_input, svhn_dream_input
 from input_data.cifar10 import cifar10_input, cifar10_dream_input
 from input_data.noise import noise_dream_input
+from input_data import utils as input_utils
 
 from models import cnn_model
 from models import capsule_model
+from models import devices
+from models.layers import utils as model_utils
 
 from grad import naive_max_norm, max_norm_diff, naive_max_caps_dim, max_caps_dim_diff, utils
 
+import result_store
+import collective
+
 from config import FLAGS, default_hparams
 
 MODELS = {
@@ -58,6 +69,14 @@ INPUTS = {
     'cifar10': cifar10_input
 }
 
+# depth of the images of every dataset
+DEPTHS = {
+    'mnist': 1,
+    'fashion_mnist': 1,
+    'svhn': 3,
+    'cifar10': 3
+}
+
 DREAM_INPUTS = {
     'mnist': mnist_dream_inputs,
     'fashion_mnist': fashion_mnist_dream_input,
@@ -78,21 +97,11 @@ NORM_ASPECT_TYPES = ['naive_max_norm', 'max_norm_diff']
 
 DIRECTION_ASPECT_TYPES = ['naive_max_caps_dim', 'max_caps_dim_diff']
 
-def _compute_entropy(arr):
-    """Given a numpy array compute the entropy of it
-    Args:
-        arr: a numpy array;
-    Returns:
-        entropy: scalar, the entropy of the given array;
-    """
-    arr_sum = np.sum(arr)
-    arr_exp = np.exp(arr)
-    entropy = - np.dot(arr_exp/arr_sum, arr)
-    return entropy
-
 def get_distributed_dataset(total_batch_size, num_gpus,
                             max_epochs, data_dir, dataset, image_size,
-                            split='default', n_repeats=None):
+                            split='default', n_repeats=None, seed=None, streaming=False,
+                            data_format='NCHW', input_device='/cpu:0',
+                            num_shards=1, shard_index=0):
     """Reads the input data using 'input_data' functions.
 
     For 'train' and 'test' splits,
@@ -116,30 +125,64 @@ def get_distributed_dataset(total_batch_size, num_gpus,
         dataset: the name of the dataset;
         image_size: image size after cropping;
         split: 'train', 'test', 'noise', 'dream';
-        n_repeats ('noise' and 'dream'): the number of repeats of the same image.
+        n_repeats ('noise' and 'dream'): the number of repeats of the same image;
+        seed ('noise' and 'dream'): seed of the noise images or of the random 
+            selection of the examples of every class, None for the default;
+        streaming ('train' and 'test'): whether to stream the examples from the 
+            memory mapped cache instead of embedding them in the graph;
+        data_format: 'NCHW' or 'NHWC', layout of the images;
+        input_device: the device of the input pipeline, the input device of 
+            the device strategy;
+        num_shards ('train' and 'test'): number of disjoint shards of the 
+            examples, one per training process;
+        shard_index ('train' and 'test'): index of the shard to read.
     Returns:
         batched_dataset: dataset object;
         specs: dataset specifications.
     """
     assert dataset in ['mnist', 'fashion_mnist', 'svhn', 'cifar10']
-    with tf.device('/gpu:0'):
+    with tf.device(input_device):
         if split in ['train', 'test']:
             assert total_batch_size % num_gpus == 0
             distributed_dataset, specs = INPUTS[dataset].inputs(
                 total_batch_size, num_gpus, max_epochs, image_size, 
-                data_dir, split)
+                data_dir, split, streaming=streaming, data_format=data_format,
+                num_shards=num_shards, shard_index=shard_index)
             return distributed_dataset, specs
         elif split == 'noise':
-            batched_dataset, specs = noise_dream_input.inputs(
-                'noise', 1, max_epochs, n_repeats, image_size)
+            if seed is None:
+                batched_dataset, specs = noise_dream_input.inputs(
+                    'noise', 1, max_epochs, n_repeats, image_size, 
+                    data_format=data_format)
+            else:
+                batched_dataset, specs = noise_dream_input.inputs(
+                    'noise', 1, max_epochs, n_repeats, image_size, seed, 
+                    data_format=data_format)
             return batched_dataset, specs
         elif split == 'dream':
             batched_dataset, specs = DREAM_INPUTS[dataset].inputs(
-                'train', data_dir, max_epochs, n_repeats, image_size)
+                'train', data_dir, max_epochs, n_repeats, image_size, seed, 
+                data_format=data_format)
             return batched_dataset, specs
         else:
             raise ValueError()
 
+def _spawn_context(num_workers):
+    """Context to start {num_workers} worker processes with TensorFlow.
+
+    Tensorflow is not fork safe, so the workers are spawned from scratch,
+    and they share the cores of the machine evenly.
+
+    Args:
+        num_workers: number of worker processes.
+    Returns:
+        ctx: the spawn multiprocessing context;
+        session_threads: number of threads of the session of every worker.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    session_threads = max(1, multiprocessing.cpu_count() // num_workers)
+    return ctx, session_threads
+
 def find_event_file_path(load_dir):
     """Finds the event file.
 
@@ -204,9 +247,291 @@ def _write_specs_file(write_dir, aspect_type, dataset, total_batch_size,
         f.write('threshold: {};\n'.format(threshold))
     return write_dir
 
+def _open_result_store(write_dir, latest_ckpt_path, params):
+    """Open the result store of an exploration run and find out the work
+    units completed by previous runs.
+
+    The manifest of the run records the checkpoint and the parameters that
+    produced the stored results. If they match, the run resumes from the
+    stored results, otherwise the stored results are dropped.
+
+    Args:
+        write_dir: the directory of the run;
+        latest_ckpt_path: path to the checkpoint to explore;
+        params: dictionary of the parameters of the run.
+    Returns:
+        store: the result store opened for appending;
+        completed: set of completed (instance, class) work units, every 
+            unit holds the results of all the objectives of one image.
+    """
+    manifest_path = os.path.join(write_dir, 'manifest.json')
+    # json round trip so that the comparison is not fooled by tuples etc.
+    manifest = json.loads(json.dumps({
+        'checkpoint': os.path.basename(latest_ckpt_path),
+        'params': params}))
+    
+    mode = 'w'
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            if json.load(f) == manifest:
+                mode = 'a'
+    store = result_store.ResultStore(write_dir, mode)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    
+    completed = set(map(tuple, np.asarray(store.keys())[:, :2].tolist()))
+    if completed:
+        print('Resuming from {} completed work units'.format(len(completed)))
+    return store, completed
+
+def _count_completed_prefix(completed, units, num_class_loop):
+    """Count the work units completed in a row from the first one, which are
+    skipped by the dataset.
+
+    Args:
+        completed: set of completed (instance, class) work units;
+        units: work unit numbers in the order of the dataset, 
+            unit = instance * num_class_loop + class;
+        num_class_loop: number of classes of every instance.
+    Returns:
+        number of leading completed work units.
+    """
+    n_done = 0
+    while n_done < len(units) and \
+        divmod(units[n_done], num_class_loop) in completed:
+        n_done += 1
+    return n_done
+
+def _claim_shards(shard_dir, num_shards):
+    """Claim the unfinished shards of a run one after another. 
+
+    A shard is claimed by creating its lock file exclusively, so the worker 
+    processes of one or more machines sharing {shard_dir} never process the 
+    same shard. A shard is marked as done when the caller asks for the next 
+    one, the lock is released in any case.
+
+    Args:
+        shard_dir: the shared directory of the shards of the run;
+        num_shards: number of shards.
+    Yields:
+        shard_idx: index of the claimed shard;
+        store_dir: the directory of the result store of the shard.
+    """
+    try:
+        os.makedirs(shard_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    for shard_idx in range(num_shards):
+        done_path = os.path.join(shard_dir, 'shard_%d.done' % shard_idx)
+        lock_path = os.path.join(shard_dir, 'shard_%d.lock' % shard_idx)
+        if os.path.exists(done_path):
+            continue
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                # claimed by another worker
+                continue
+            raise
+        with os.fdopen(fd, 'w') as f:
+            f.write('{}:{}\n'.format(socket.gethostname(), os.getpid()))
+        try:
+            # finished by another worker between the check and the claim
+            if os.path.exists(done_path):
+                continue
+            yield shard_idx, os.path.join(shard_dir, 'shard_%d' % shard_idx)
+            open(done_path, 'w').close()
+        finally:
+            os.remove(lock_path)
+
+def _merge_shard_stores(write_dir, num_shards, latest_ckpt_path, params):
+    """Merge the result stores of the shards into the result store of the run
+    once all the shards are done. Only the first worker to see all the shards
+    done does the merge.
+
+    Args:
+        write_dir: the directory of the run;
+        num_shards: number of shards;
+        latest_ckpt_path: path to the explored checkpoint;
+        params: dictionary of the parameters of the run.
+    """
+    shard_dir = os.path.join(write_dir, 'shards')
+    if not all(os.path.exists(os.path.join(shard_dir, 'shard_%d.done' % shard_idx))
+               for shard_idx in range(num_shards)):
+        return
+    merge_lock_path = os.path.join(shard_dir, 'merge.lock')
+    try:
+        os.close(os.open(merge_lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            # merged by another worker
+            return
+        raise
+    
+    try:
+        store, completed = _open_result_store(write_dir, latest_ckpt_path, params)
+        for shard_idx in range(num_shards):
+            shard_store = result_store.ResultStore(
+                os.path.join(shard_dir, 'shard_%d' % shard_idx))
+            if len(shard_store) == 0:
+                continue
+            keys = np.asarray(shard_store.keys())
+            rows = np.array([row for row, key in enumerate(keys[:, :2].tolist())
+                             if tuple(key) not in completed], dtype=np.int64)
+            # copy in chunks, only the selected rows of the memory maps are read
+            for start in range(0, rows.shape[0], 1024):
+                chunk = rows[start:start + 1024]
+                store.append(keys[chunk], **{name: shard_store.field(name)[chunk]
+                                             for name in result_store.FIELDS})
+        store.close()
+        print('Merged {} shards into {}'.format(num_shards, write_dir))
+    except:
+        # leave the merge to the next run
+        os.remove(merge_lock_path)
+        raise
+
+def _explore_shards(sess, iterator, batch_data, shard_index, n_skip, ascend_fn,
+                    shards, num_shards, latest_ckpt_path, params,
+                    max_epochs, num_class_loop, n_repeats):
+    """Run the gradient ascent of every missing work unit of the given shards
+    and append the results to the result store of every shard.
+
+    The work unit u = instance * num_class_loop + class belongs to the shard 
+    u % num_shards, which is also the order of the sharded dataset.
+
+    Args:
+        sess: the running session;
+        iterator: the sharded dataset iterator;
+        batch_data: the next batch of the iterator;
+        shard_index: placeholder of the shard index of the dataset;
+        n_skip: placeholder of the number of images that the dataset skips;
+        ascend_fn: function that ascends the next image of the dataset along
+            the {n_repeats} objectives of the given class and returns 
+            iter_n_recorded, images (NCHW), predictions and entropies;
+        shards: iterable of (shard_idx, store_dir) to process;
+        num_shards: total number of shards;
+        latest_ckpt_path: path to the explored checkpoint;
+        params: dictionary of the parameters of the run;
+        max_epochs: number of instances;
+        num_class_loop: number of classes of every instance;
+        n_repeats: number of objectives per image.
+    """
+    for shard_idx, store_dir in shards:
+        if num_shards > 1:
+            print('Shard {}/{}'.format(shard_idx, num_shards))
+            shard_params = dict(params, shard=[shard_idx, num_shards])
+        else:
+            shard_params = params
+        # open the result store, the work units completed by a previous 
+        # run with the same checkpoint and parameters are kept
+        store, completed = _open_result_store(store_dir, latest_ckpt_path, shard_params)
+        
+        # fast forward the dataset to the first missing work unit
+        units = list(range(shard_idx, max_epochs * num_class_loop, num_shards))
+        n_done = _count_completed_prefix(completed, units, num_class_loop)
+        sess.run(iterator.initializer, feed_dict={shard_index: shard_idx, n_skip: n_done})
+
+        # all the results of the shard go into one result store, which
+        # writes in the background while the next image is ascended
+        store = result_store.AsyncResultWriter(store)
+
+        for unit in units[n_done:]:
+            i, j = divmod(unit, num_class_loop)
+            try:
+                if (i, j) in completed:
+                    # only consume the image of the completed work unit
+                    sess.run(batch_data)
+                    continue
+
+                iter_n_recorded, ga_img_matr, pred_matr, entropy_matr = ascend_fn(j)
+
+                # row k of every recorded iteration belongs to the objective k,
+                # swap the first two axes so that every row of the store holds 
+                # the recorded results of one objective
+                # (n_repeats, n_recorded, 1, 1, 24, 24), (n_repeats, n_recorded, 10)
+                # and (n_repeats, n_recorded)
+                ga_iter_matr = np.tile(np.array(iter_n_recorded), (n_repeats, 1))
+                ga_img_matr = np.expand_dims(np.swapaxes(ga_img_matr, 0, 1), axis=2)
+                pred_class_prob_matr = np.swapaxes(pred_matr, 0, 1)
+                pred_class_entropy_matr = np.swapaxes(entropy_matr, 0, 1)
+
+                # append to the result store, keyed by (instance, lbl0, lbl1)
+                # or (instance, cap, dim)
+                keys = np.stack([np.full(n_repeats, i), np.full(n_repeats, j), 
+                                 np.arange(n_repeats)], axis=1)
+                store.append(keys, iters=ga_iter_matr, images=ga_img_matr, 
+                             pred=pred_class_prob_matr, pred_entropy=pred_class_entropy_matr)
+
+                print('{0} {1} total:class = {2:.1f}% ~ {3:.1f}%'.format(
+                    ' '*5, '-'*5, 
+                    100.0*(i * num_class_loop + j + 1) / (max_epochs * num_class_loop),
+                    100.0*(j + 1)/num_class_loop), end='\r')
+            except tf.errors.OutOfRangeError:
+                break
+        print()
+        store.close()
+
+def _data_format_of(images_shape):
+    """Layout of batched images of the given shape, (?, depth, h, w) is 'NCHW' 
+    and (?, h, w, depth) is 'NHWC', the depth is smaller than the image size."""
+    return 'NCHW' if images_shape[1] < images_shape[3] else 'NHWC'
+
+def _convert_images(images, src_format, dst_format):
+    """Convert the layout of the images, the last three axes of the array."""
+    if src_format == dst_format:
+        return images
+    if dst_format == 'NHWC':
+        return np.moveaxis(images, -3, -1)
+    return np.moveaxis(images, -1, -3)
+
+def _import_meta_graph_on_iterator(meta_path, iterator, data_format='NCHW'):
+    """Import the meta graph and map the inputs of every tower to its split
+    of the next batch of {iterator}, so no batch has to go through feed_dict. The images
+    are transposed if the graph was built with the other data format.
+
+    The number of towers is read from the graph, it may differ from the 
+    current number of GPUs, e.g. a graph trained by the collective training
+    only has tower 0.
+
+    Args:
+        meta_path: path to the meta graph file;
+        iterator: dataset iterator;
+        data_format: 'NCHW' or 'NHWC', layout of the images of {iterator}.
+    Returns:
+        saver: the saver of the imported graph.
+    """
+    meta_graph_def = tf.MetaGraphDef()
+    with open(meta_path, 'rb') as f:
+        meta_graph_def.ParseFromString(f.read())
+    # the towers and the layout of the graph are in the images placeholders
+    image_nodes = {}
+    for node in meta_graph_def.graph_def.node:
+        match = re.match(r'^tower_(\d+)/batched_images$', node.name)
+        if match:
+            image_nodes[int(match.group(1))] = node
+    num_towers = len(image_nodes)
+    if num_towers == 0 or sorted(image_nodes) != list(range(num_towers)):
+        raise ValueError('{} has no input placeholders of towers 0 ~ {}!'.format(
+            meta_path, max(image_nodes) if image_nodes else 0))
+    graph_format = _data_format_of(
+        [dim.size for dim in image_nodes[0].attr['shape'].shape.dim])
+
+    input_map = {}
+    # split every batch among the towers
+    tower_batches = input_utils.split_batch(iterator.get_next(), num_towers)
+    for i in range(num_towers):
+        batch_data = tower_batches[i]
+        images = batch_data['images']
+        if graph_format != data_format:
+            images = tf.transpose(images, [0, 3, 1, 2] if graph_format == 'NCHW' else [0, 2, 3, 1])
+        input_map['tower_%d/batched_images:0' % i] = images
+        input_map['tower_%d/batched_labels:0' % i] = tf.cast(batch_data['labels'], tf.int32)
+    return tf.train.import_meta_graph(meta_graph_def, input_map=input_map)
+
 def run_train_session(iterator, specs, 
                       summary_dir, max_epochs,
-                      joined_result, save_epochs):
+                      joined_result, save_epochs, config=None):
     """Starts a session, train the model, write summary into an event file,
     and save the whole graph one time and variable every {save_epochs} epochs.
     
@@ -216,13 +541,15 @@ def run_train_session(iterator, specs,
         summary_dir: str, directory to store ckpts;
         joined_result: namedtuple, TowerResult('inferred', 'train_op',
                                                'summary', 'correct', 'accuracy');
-        save_epochs: scalar, how often to save the data.
+        save_epochs: scalar, how often to save the data;
+        config: session config of the device strategy, None for the default.
     """
-    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+    if config is None:
+        config = tf.ConfigProto(allow_soft_placement=True)
+    with tf.Session(config=config) as sess:
         # declare summary writer and save the graph in the meanwhile
         writer = tf.summary.FileWriter(summary_dir, sess.graph)
-        # declar batched data instance and initialize the iterator
-        batch_data = iterator.get_next()
+        # initialize the iterator, the towers read their batches from it
         sess.run(iterator.initializer)
         # initialize variables
         init_op = tf.group(tf.global_variables_initializer(),
@@ -249,17 +576,9 @@ def run_train_session(iterator, specs,
             step_counter += 1
 
             try:
-                # get placeholders and create feed_dict
-                feed_dict = {} 
-                for i in range(specs['num_gpus']):
-                    batch_val = sess.run(batch_data)
-                    feed_dict[tf.get_collection('tower_%d_batched_images' % i)[0]] = batch_val['images']
-                    feed_dict[tf.get_collection('tower_%d_batched_labels' % i)[0]] = batch_val['labels']
-                
                 """Run inferences"""
                 summary, accuracy, _ = sess.run(
-                    [joined_result.summary, joined_result.accuracy, joined_result.train_op],
-                    feed_dict=feed_dict)
+                    [joined_result.summary, joined_result.accuracy, joined_result.train_op])
                 """Add summary"""
                 writer.add_summary(summary, global_step=step_counter)
                 # calculate time
@@ -303,17 +622,19 @@ def run_train_session(iterator, specs,
             accuracy))
 
 def train(hparams, num_gpus, data_dir, dataset, model_type, total_batch_size, image_size,
-                   summary_dir, save_epochs, max_epochs):
+                   summary_dir, save_epochs, max_epochs, streaming=False,
+                   device_strategy='multi_gpu'):
     """Trains a model.
 
     It will initialize the model with either previously a saved model ckpt in
     the {summary_dir} directory or start from scratch if the directory is empty.
-    The training is distributed on {num_gpus} GPUs. It writes a summary at 
-    every step and saves the model every {save_epochs} epochs.
+    The training is distributed on {num_gpus} replicas placed by the device 
+    strategy. It writes a summary at every step and saves the model every 
+    {save_epochs} epochs.
 
     Args:
         hparams: the hyperparameters to build the model graph;
-        num_gpus: number of GPUs to use;
+        num_gpus: number of GPUs to use, or number of replicas;
         data_dir: the directory containing the input data;
         dataset: the name of the dataset for the experiment;
         model_type: the name of model architecture;
@@ -321,23 +642,28 @@ def train(hparams, num_gpus, data_dir, dataset, model_type, total_batch_size, im
         image_size: image size after cropping/resizing;
         summary_dir: the directory to write summaries and save the model;
         save_epochs: how often the training model should be saved;
-        max_epochs: maximum epochs to train.
+        max_epochs: maximum epochs to train;
+        streaming: whether to stream the examples from the memory mapped cache,
+            which keeps the data out of the saved meta graphs;
+        device_strategy: 'single', 'cpu_replicas' or 'multi_gpu'.
     """
     # define subfolder in {summary_dir}
     summary_dir = os.path.join(summary_dir, 'train')
+    strategy = devices.DeviceStrategy(device_strategy, num_gpus)
     # define model graph
     with tf.Graph().as_default():
         # get batched dataset and declare initializable iterator
         distributed_dataset, specs = get_distributed_dataset(
             total_batch_size, num_gpus, max_epochs,
             data_dir, dataset, image_size,
-            'train')
+            'train', streaming=streaming, data_format=hparams.data_format,
+            input_device=strategy.input_device)
         iterator = distributed_dataset.make_initializable_iterator()
-        # initialize model with hparams and specs
-        model = MODELS[model_type](hparams, specs)
-        # build a model on multiple gpus and returns a tuple of 
-        # (a list of input tensor placeholders, a list of output tensor placeholders)
-        joined_result = model.build_model_on_multi_gpus()
+        # initialize model with hparams, specs and the device strategy
+        model = MODELS[model_type](hparams, specs, strategy)
+        # build a model on multiple gpus, every batch of the iterator is 
+        # split among the towers, and returns the joined result of the towers
+        joined_result = model.build_model_on_multi_gpus(iterator)
 
         """Print stats"""
         param_stats = tf.contrib.tfprof.model_analyzer.print_model_analysis(
@@ -348,22 +674,379 @@ def train(hparams, num_gpus, data_dir, dataset, model_type, total_batch_size, im
 
         run_train_session(iterator, specs, 
                           summary_dir, max_epochs,
-                          joined_result, save_epochs)
+                          joined_result, save_epochs, strategy.session_config())
+
+def run_collective_train_session(iterator, specs, 
+                                 summary_dir, max_epochs,
+                                 collective_result, save_epochs, coll, config=None):
+    """Starts a session and train one replica in sync with the other training
+    processes, the gradients of every step are averaged over the processes
+    before they are applied.
 
-def run_evaluate_session(iterator, specs, load_dir, summary_dir, kind, 
-                         model_type, threshold):
-    """Find available ckpts and iteratively load the graph and variables.
+    Only rank 0 writes the summaries and saves the ckpts. It restores the 
+    latest ckpt and broadcasts the variables, so every rank starts from the
+    same variables and stays in sync with the same averaged updates.
 
     Args:
-        iterator: dataset iterator;
+        iterator: dataset iterator of the shard of this process;
         specs: dict, dataset specifications;
-        load_dir: str, directory to load graph;
         summary_dir: str, directory to store ckpts;
-        kind: 'train' or 'test';
-        model_type: 'cnn' or 'cap';
-        threhold: if {model_type}='cnn', then it should be None; 
-            else, it is threshold to filter capsules;
+        max_epochs: maximum epochs to train;
+        collective_result: namedtuple, CollectiveResult('summary', 'grads', 
+            'grad_placeholders', 'train_op', 'correct', 'accuracy');
+        save_epochs: scalar, how often to save the data;
+        coll: collective.Collective connecting the training processes;
+        config: session config of the device strategy, None for the default.
+    """
+    is_chief = coll.rank == 0
+    if config is None:
+        config = tf.ConfigProto(allow_soft_placement=True)
+    with tf.Session(config=config) as sess:
+        if is_chief:
+            # declare summary writer and save the graph in the meanwhile
+            writer = tf.summary.FileWriter(summary_dir, sess.graph)
+        # initialize the iterator, the tower reads its batches from it
+        sess.run(iterator.initializer)
+        # initialize variables
+        init_op = tf.group(tf.global_variables_initializer(),
+                           tf.local_variables_initializer())
+        sess.run(init_op)
+        # declare saver object for future saving
+        saver = tf.train.Saver(max_to_keep=None)
+
+        epoch_time = 0
+        total_time = 0
+        step_counter = 0
+        # restore ckpt if not restart, then start every rank from the 
+        # variables of rank 0
+        global_vars = tf.global_variables()
+        values = None
+        if is_chief:
+            latest_step, latest_checkpoint_fpath, _ = find_latest_checkpoint_info(summary_dir, False)
+            if latest_step != -1 and latest_checkpoint_fpath != None:
+                saver.restore(sess, latest_checkpoint_fpath)
+                step_counter = latest_step
+            values = sess.run(global_vars)
+        step_counter, values = coll.broadcast((step_counter, values))
+        if not is_chief:
+            for var, value in zip(global_vars, values):
+                var.load(value, sess)
+        epochs_done = step_counter // specs['steps_per_epoch']
+        total_steps = specs['steps_per_epoch'] * (max_epochs - epochs_done)
+
+        fetches = [collective_result.grads, collective_result.accuracy]
+        if is_chief:
+            fetches.append(collective_result.summary)
+        # every rank takes the same number of steps, the shards hold 
+        # enough examples for all of them
+        for _ in range(total_steps):
+            start_anchor = time.time() # time anchor
+            step_counter += 1
+
+            """Run inferences"""
+            results = sess.run(fetches)
+            """Average gradients and accuracies over the ranks"""
+            averaged = coll.allreduce_mean(results[0] + [results[1]])
+            accuracy = float(averaged.pop())
+            sess.run(collective_result.train_op, 
+                     feed_dict=dict(zip(collective_result.grad_placeholders, averaged)))
+            if not is_chief:
+                continue
+
+            """Add summary"""
+            writer.add_summary(results[2], global_step=step_counter)
+            # calculate time
+            time_consuming = time.time() - start_anchor
+            epoch_time += time_consuming
+            total_time += time_consuming
+            """Save ckpts"""
+            if step_counter % (specs['steps_per_epoch'] * save_epochs) == 0:
+                ckpt_path = saver.save(
+                    sess, os.path.join(summary_dir, 'model.ckpt'),
+                    global_step=step_counter)
+                print("{0} epochs done (step = {1}), accuracy {2:.4f}. {3:.2f}s, checkpoint saved at {4}".format(
+                    step_counter // specs['steps_per_epoch'], 
+                    step_counter, 
+                    accuracy, 
+                    epoch_time, 
+                    ckpt_path))
+                epoch_time = 0
+            elif step_counter % specs['steps_per_epoch'] == 0:
+                print("{0} epochs done (step = {1}), accuracy {2:.4f}. {3:.2f}s".format(
+                    step_counter // specs['steps_per_epoch'], 
+                    step_counter, 
+                    accuracy, 
+                    epoch_time))
+                epoch_time = 0
+            else:
+                print("running {0} epochs {1:.1f}%, total time ~ {2}:{3}:{4}".format(
+                    step_counter // specs['steps_per_epoch'] + 1,
+                    step_counter % specs['steps_per_epoch'] * 100.0 / specs['steps_per_epoch'],
+                    int(total_time // 3600), 
+                    int(total_time % 3600 // 60), 
+                    int(total_time % 60)),
+                    end='\r')
+            # Finished one step
+        if is_chief and total_steps > 0:
+            print('total time: {0}:{1}:{2}, accuracy: {3:.4f}.'.format(
+                int(total_time // 3600), 
+                int(total_time % 3600 // 60), 
+                int(total_time % 60),
+                accuracy))
+
+def train_collective(hparams, rank, num_workers, address, 
+                     num_gpus, data_dir, dataset, model_type, total_batch_size, image_size,
+                     summary_dir, save_epochs, max_epochs, streaming=False,
+                     device_strategy='multi_gpu', session_threads=None):
+    """Trains a model with {num_workers} synchronous data-parallel processes,
+    this process being the given rank.
+
+    Every process builds a single tower which reads its own shard of the
+    training set with {total_batch_size} / {num_workers} examples per batch,
+    the gradients are averaged over the processes every step. Only rank 0 
+    writes the summaries and saves the model every {save_epochs} epochs.
+
+    Args:
+        hparams: the hyperparameters to build the model graph;
+        rank: the rank of this process, 0 ~ num_workers - 1;
+        num_workers: total number of training processes;
+        address: 'host:port' of rank 0 to connect the processes;
+        num_gpus: number of GPUs of the machine, the processes take them in turn;
+        data_dir: the directory containing the input data;
+        dataset: the name of the dataset for the experiment;
+        model_type: the name of model architecture;
+        total_batch_size: total batch size over all the processes;
+        image_size: image size after cropping/resizing;
+        summary_dir: the directory to write summaries and save the model;
+        save_epochs: how often the training model should be saved;
+        max_epochs: maximum epochs to train;
+        streaming: whether to stream the examples from the memory mapped cache;
+        device_strategy: 'multi_gpu' to put the tower on a GPU, otherwise on the CPU;
+        session_threads: number of threads of the session, None for all the cores.
+    """
+    assert total_batch_size % num_workers == 0
+    # define subfolder in {summary_dir}
+    summary_dir = os.path.join(summary_dir, 'train')
+    if device_strategy == 'multi_gpu' and num_gpus > 0:
+        # the processes of the machine take the GPUs in turn
+        device = '/gpu:%d' % (rank % num_gpus)
+    else:
+        device = '/cpu:0'
+    strategy = devices.DeviceStrategy('single', 1, device=device)
+    # define model graph
+    with tf.Graph().as_default():
+        # get the batched dataset of the shard of this process
+        distributed_dataset, specs = get_distributed_dataset(
+            total_batch_size // num_workers, 1, max_epochs,
+            data_dir, dataset, image_size,
+            'train', streaming=streaming, data_format=hparams.data_format,
+            input_device=strategy.input_device, 
+            num_shards=num_workers, shard_index=rank)
+        iterator = distributed_dataset.make_initializable_iterator()
+        # initialize model with hparams, specs and the device strategy
+        model = MODELS[model_type](hparams, specs, strategy)
+        # build the tower, its gradients are averaged outside of the graph
+        collective_result = model.build_model_for_collective(iterator)
+
+        config = strategy.session_config(session_threads)
+        # share the GPUs with the other processes
+        config.gpu_options.allow_growth = True
+        with collective.Collective(rank, num_workers, address) as coll:
+            run_collective_train_session(iterator, specs, 
+                                         summary_dir, max_epochs,
+                                         collective_result, save_epochs, coll, config)
+
+def run_collective_training(args, num_workers, address, rank=None):
+    """Start the processes of a synchronous data-parallel training.
+
+    Args:
+        args: the positional arguments of train_collective() from num_gpus 
+            until device_strategy, preceded by hparams;
+        num_workers: total number of training processes;
+        address: 'host:port' of rank 0 to connect the processes;
+        rank: if None, start all the {num_workers} processes on this machine,
+            otherwise only run the given rank in this process, e.g. when the 
+            other ranks run on other machines.
+    """
+    hparams, args = args[0], tuple(args[1:])
+    if rank is not None:
+        train_collective(hparams, rank, num_workers, address, *args)
+        return
+
+    ctx, session_threads = _spawn_context(num_workers)
+    workers = [ctx.Process(target=train_collective,
+                           args=(hparams, r, num_workers, address) + args + (session_threads,))
+               for r in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError('{} of {} training processes failed!'.format(
+            len(failed), num_workers))
+
+def _compute_mean_accuracy(sess, acc_t, iterator, feed_dict=None):
+    """Run the accuracy over one pass of the dataset and average it.
+
+    Args:
+        sess: session with the restored variables;
+        acc_t: accuracy tensor;
+        iterator: initializable dataset iterator to go through;
+        feed_dict: feed dict of every run, e.g. the handle of {iterator}.
+    Returns:
+        mean accuracy over the batches.
+    """
+    sess.run(iterator.initializer)
+    accs = []
+    while True:
+        try: 
+            acc = sess.run(acc_t, feed_dict=feed_dict)
+            accs.append(acc)
+        except tf.errors.OutOfRangeError:
+            break
+    return sum(accs) / len(accs)
+
+class _CheckpointEvaluator(object):
+    """Import the meta graph once, with the towers reading from a feedable 
+    iterator switched between the train and test iterators by their string
+    handles, so only the variables are restored to evaluate every ckpt."""
+
+    def __init__(self, meta_path, num_gpus, data_dir, dataset, total_batch_size, 
+                 image_size, max_epochs, streaming, data_format, session_threads=None):
+        """Build the datasets and import the meta graph in a new graph and session.
+
+        Args:
+            meta_path: str, path to the meta graph to import;
+            num_gpus: number of towers to read the batches;
+            data_dir: the directory containing the input data;
+            dataset: the name of the dataset for the experiment;
+            total_batch_size: total batch size, which will be distributed to {num_gpus} GPUs;
+            image_size: image size after cropping/resizing;
+            max_epochs: maximum epochs to evaluate, ≡ 1;
+            streaming: whether to stream the examples from the memory mapped cache;
+            data_format: 'NCHW' or 'NHWC', layout of the input images;
+            session_threads: number of threads of the session, None for all the cores.
+        """
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            # get batched datasets and declare initializable iterators
+            self._iterators = {}
+            for kind in ['train', 'test']:
+                distributed_dataset, specs = get_distributed_dataset(
+                    total_batch_size, num_gpus, max_epochs,
+                    data_dir, dataset, image_size,
+                    kind, streaming=streaming, data_format=data_format)
+                self._iterators[kind] = distributed_dataset.make_initializable_iterator()
+            # feedable iterator, the towers read from the iterator of the fed handle
+            self._handle = tf.placeholder(tf.string, shape=[], name='dataset_handle')
+            iterator = tf.data.Iterator.from_string_handle(
+                self._handle, distributed_dataset.output_types, distributed_dataset.output_shapes)
+
+            config = tf.ConfigProto(allow_soft_placement=True)
+            if session_threads:
+                # share the devices with the other evaluation workers
+                config.intra_op_parallelism_threads = session_threads
+                config.inter_op_parallelism_threads = session_threads
+                config.gpu_options.allow_growth = True
+            self._sess = tf.Session(config=config)
+            # import compute graph once with the towers reading from the iterator
+            self._saver = _import_meta_graph_on_iterator(
+                meta_path, iterator, data_format)
+            self._acc_t = tf.get_collection('accuracy')[0]
+            self._handles = {kind: self._sess.run(it.string_handle()) 
+                             for kind, it in self._iterators.items()}
+
+    def evaluate(self, step, ckptpath, kinds):
+        """Restore the variables of the ckpt and evaluate it on the given splits.
+
+        Args:
+            step: global step of the ckpt;
+            ckptpath: path to the ckpt;
+            kinds: list of the splits to evaluate, 'train' and/or 'test'.
+        Returns:
+            list of (kind, step, mean accuracy) tuples.
+        """
+        with self._graph.as_default():
+            # restore variables
+            self._saver.restore(self._sess, ckptpath)
+            results = []
+            for kind in kinds:
+                mean_acc = _compute_mean_accuracy(
+                    self._sess, self._acc_t, self._iterators[kind], 
+                    feed_dict={self._handle: self._handles[kind]})
+                results.append((kind, step, mean_acc))
+        return results
+
+    def close(self):
+        self._sess.close()
+
+# the ckpt evaluator of an evaluation worker process, created by its first task
+_worker_evaluator = None
+
+def _evaluate_checkpoint(args):
+    """Evaluate one ckpt, the target of the evaluation workers. Only the first 
+    task of every worker imports the meta graph, the others reuse it.
+
+    Args:
+        args: tuple of (evaluator_args, step, ckptpath, kinds), where 
+            evaluator_args are the arguments of _CheckpointEvaluator.
+    Returns:
+        list of (kind, step, mean accuracy) tuples.
+    """
+    global _worker_evaluator
+    evaluator_args, step, ckptpath, kinds = args
+    if _worker_evaluator is None:
+        _worker_evaluator = _CheckpointEvaluator(*evaluator_args)
+    return _worker_evaluator.evaluate(step, ckptpath, kinds)
+
+def _read_history(history_path):
+    """Read the {step: mean accuracy} dictionary of a history file, empty if not found."""
+    history = {}
+    if os.path.exists(history_path):
+        with open(history_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    step, mean_acc = line.split(',')
+                    history[int(step)] = float(mean_acc)
+    return history
+
+def _write_history(history_path, history):
+    """Write the {step: mean accuracy} dictionary to a history file in step order."""
+    with result_store.atomic_open(history_path) as f:
+        for step in sorted(history):
+            f.write('{}, {}\n'.format(step, history[step]))
+
+def evaluate(num_gpus, data_dir, dataset, model_type, total_batch_size, image_size,
+             threshold, summary_dir, max_epochs, streaming=False, num_workers=1,
+             data_format='NCHW'):
+    """Restore the graph and variables of every ckpt, and return the data to train and test curve.
+
+    The steps already written to {kind}_history.txt are skipped, so only the
+    new ckpts are evaluated. The remaining ckpts are distributed over 
+    {num_workers} worker processes, each importing the graph once in its own
+    session and only restoring the variables of every ckpt. The history 
+    files are rewritten in step order as soon as every ckpt completes.
+    
+    Args:
+        num_gpus: number of GPUs to use;
+        data_dir: the directory containing the input data;
+        dataset: the name of the dataset for the experiment;
+        model_type: the name of model architecture;
+        total_batch_size: total batch size, which will be distributed to {num_gpus} GPUs;
+        image_size: image size after cropping/resizing;
+        threshold: threshold to filter out the target capsule effect;
+        summary_dir: the directory to write summaries and save the model;
+        max_epochs: maximum epochs to evaluate, ≡ 1;
+        streaming: whether to stream the examples from the memory mapped cache;
+        num_workers: number of worker processes to evaluate the ckpts;
+        data_format: 'NCHW' or 'NHWC', layout of the input images, the images 
+            are transposed if the graph of the ckpts has the other one.
     """
+    # define subfolder to load ckpt and write related files
+    load_dir = os.path.join(summary_dir, 'train')
+    summary_dir = os.path.join(summary_dir, 'evaluate')
     # create summary folder if not exists
     if not os.path.exists(summary_dir):
         os.makedirs(summary_dir)
@@ -377,48 +1060,60 @@ def run_evaluate_session(iterator, specs, load_dir, summary_dir, kind,
         print('{0}\nFound a ckpt!\n{0}'.format('='*20))
         latest_ckpt_meta_path = latest_ckpt_path + '.meta'
 
-    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
-        # import compute graph
-        saver = tf.train.import_meta_graph(latest_ckpt_meta_path)
-        # get dataset object working
-        batch_data = iterator.get_next()
+    kinds = ['train', 'test']
+    history_paths = {kind: os.path.join(summary_dir, '%s_history.txt' % kind) for kind in kinds}
+    histories = {kind: _read_history(history_paths[kind]) for kind in kinds}
+    # skip the steps evaluated before
+    tasks = []
+    for step, ckptpath in all_step_ckpt_pairs:
+        pending_kinds = [kind for kind in kinds if step not in histories[kind]]
+        if pending_kinds:
+            tasks.append((step, ckptpath, pending_kinds))
+    for kind in kinds:
+        num_pending = sum(kind in task[2] for task in tasks)
+        print('{}: {} ckpts evaluated before, {} to evaluate'.format(
+            kind, len(all_step_ckpt_pairs) - num_pending, num_pending))
+    if len(tasks) == 0:
+        return
+
+    evaluator_args = (latest_ckpt_meta_path, num_gpus, data_dir, dataset, total_batch_size,
+                      image_size, max_epochs, streaming, data_format)
+    if num_workers > 1:
+        ctx, session_threads = _spawn_context(num_workers)
+        pool = ctx.Pool(num_workers)
+        results = pool.imap_unordered(
+            _evaluate_checkpoint, 
+            [(evaluator_args + (session_threads,), step, ckptpath, pending_kinds)
+             for step, ckptpath, pending_kinds in tasks])
+    else:
+        evaluator = _CheckpointEvaluator(*evaluator_args)
+        results = (evaluator.evaluate(*task) for task in tasks)
+    try:
+        for kind_step_acc_list in results:
+            # write every ckpt as it completes, so a killed evaluation keeps 
+            # the finished ones
+            for kind, step, mean_acc in kind_step_acc_list:
+                histories[kind][step] = mean_acc
+                _write_history(history_paths[kind], histories[kind])
+                print('step: {0}, {1} accuracy = {2:.4f}, {3} / {4} ckpts evaluated'.format(
+                    step, kind, mean_acc, len(histories[kind]), len(all_step_ckpt_pairs)))
+    finally:
+        if num_workers > 1:
+            pool.close()
+            pool.join()
+        else:
+            evaluator.close()
 
-        acc_t = tf.get_collection('accuracy')[0]
-        step_mean_acc_pairs = []
+def watch_evaluate(num_gpus, data_dir, dataset, model_type, total_batch_size, image_size,
+                   threshold, summary_dir, max_epochs, streaming=False,
+                   interval_secs=60, timeout_secs=3600, data_format='NCHW'):
+    """Follow a training run, evaluate every new ckpt on the train and test splits 
+    and add it to the history files, then wait for the next one.
 
-        # iteratively restore variables and run evaluations
-        for idx, (step, ckptpath) in enumerate(all_step_ckpt_pairs):
-            # restore variables
-            saver.restore(sess, ckptpath)
-
-            sess.run(iterator.initializer)
-            accs = []
-
-            while True:
-                try: 
-                    # get placeholders and create feed dict
-                    feed_dict = {}
-                    for i in range(specs['num_gpus']):
-                        batch_val = sess.run(batch_data)
-                        feed_dict[tf.get_collection('tower_%d_batched_images' % i)[0]] = batch_val['images']
-                        feed_dict[tf.get_collection('tower_%d_batched_labels' % i)[0]] = batch_val['labels']
-
-                    acc = sess.run(acc_t, feed_dict=feed_dict)
-                    accs.append(acc)
-                except tf.errors.OutOfRangeError:
-                    break
-            mean_acc = sum(accs) / len(accs)
-            step_mean_acc_pairs.append((step, mean_acc))
-            
-            print('step: {0}, accuracy = {1:.4f} ~ {2} / {3}'.format(step, mean_acc, idx+1, len(all_step_ckpt_pairs)))
-        with open(os.path.join(summary_dir, '%s_history.txt') % kind, 'w+') as f:
-            for step, mean_acc in step_mean_acc_pairs:
-                f.write('{}, {}\n'.format(step, mean_acc))
+    The meta graph is imported only once, the towers read from a feedable 
+    iterator switched between the train and test iterators by their string 
+    handles, so only the variables are restored for every ckpt.
 
-def evaluate(num_gpus, data_dir, dataset, model_type, total_batch_size, image_size,
-             threshold, summary_dir, max_epochs):
-    """Iteratively restore the graph and variables, and return the data to train and test curve.
-    
     Args:
         num_gpus: number of GPUs to use;
         data_dir: the directory containing the input data;
@@ -428,32 +1123,206 @@ def evaluate(num_gpus, data_dir, dataset, model_type, total_batch_size, image_si
         image_size: image size after cropping/resizing;
         threshold: threshold to filter out the target capsule effect;
         summary_dir: the directory to write summaries and save the model;
-        max_epochs: maximum epochs to evaluate, ≡ 1.
+        max_epochs: maximum epochs to evaluate, ≡ 1;
+        streaming: whether to stream the examples from the memory mapped cache;
+        interval_secs: seconds to wait between two checks for new ckpts;
+        timeout_secs: stop when no new ckpt shows up for this many seconds;
+        data_format: 'NCHW' or 'NHWC', layout of the input images, the images 
+            are transposed if the graph of the ckpts has the other one.
     """
     # define subfolder to load ckpt and write related files
     load_dir = os.path.join(summary_dir, 'train')
     summary_dir = os.path.join(summary_dir, 'evaluate')
-    # declare an empty model graph
-    with tf.Graph().as_default():
-        # get train batched dataset and declare initializable iterator
-        train_distributed_dataset, train_specs = get_distributed_dataset(
-            total_batch_size, num_gpus, max_epochs,
-            data_dir, dataset, image_size,
-            'train')
-        train_iterator = train_distributed_dataset.make_initializable_iterator()
-        # call evaluate experiment
-        run_evaluate_session(train_iterator, train_specs, load_dir, summary_dir, 'train', 
-                             model_type, threshold)
-    with tf.Graph().as_default():
-        # get test batched dataset and delcare initializable iterator
-        test_distributed_dataset, test_specs = get_distributed_dataset(
-            total_batch_size, num_gpus, max_epochs,
-            data_dir, dataset, image_size,
-            'test')
-        test_iterator = test_distributed_dataset.make_initializable_iterator()
-        # call evaluate experiment
-        run_evaluate_session(test_iterator, test_specs, load_dir, summary_dir, 'test', 
-                             model_type, threshold)
+    # create summary folder if not exists
+    if not os.path.exists(summary_dir):
+        os.makedirs(summary_dir)
+    kinds = ['train', 'test']
+    history_paths = {kind: os.path.join(summary_dir, '%s_history.txt' % kind) for kind in kinds}
+    histories = {kind: _read_history(history_paths[kind]) for kind in kinds}
+
+    """Wait for the first ckpt"""
+    last_found = time.time()
+    latest_step, latest_ckpt_path, _ = find_latest_checkpoint_info(load_dir)
+    while latest_step == -1 or latest_ckpt_path == None:
+        if time.time() - last_found > timeout_secs:
+            raise ValueError('{0}\n ckpt files not found!\n {0}'.format('='*20))
+        time.sleep(interval_secs)
+        latest_step, latest_ckpt_path, _ = find_latest_checkpoint_info(load_dir)
+
+    # import compute graph once with the towers reading from the iterator
+    evaluator = _CheckpointEvaluator(latest_ckpt_path + '.meta', num_gpus, data_dir, dataset,
+                                     total_batch_size, image_size, max_epochs, streaming, 
+                                     data_format)
+    try:
+        while True:
+            # only take those ckpts listed in the checkpoint state, which are complete
+            latest_step, _, all_step_ckpt_pairs = find_latest_checkpoint_info(load_dir, True)
+            pending_pairs = [(step, ckptpath) for step, ckptpath in all_step_ckpt_pairs
+                             if step <= latest_step 
+                             and any(step not in histories[kind] for kind in kinds)]
+            if len(pending_pairs) == 0:
+                if time.time() - last_found > timeout_secs:
+                    print('No new ckpt in {} seconds, stop watching.'.format(timeout_secs))
+                    break
+                time.sleep(interval_secs)
+                continue
+
+            for step, ckptpath in pending_pairs:
+                pending_kinds = [kind for kind in kinds if step not in histories[kind]]
+                for kind, step, mean_acc in evaluator.evaluate(step, ckptpath, pending_kinds):
+                    histories[kind][step] = mean_acc
+                    _write_history(history_paths[kind], histories[kind])
+                    print('step: {0}, {1} accuracy = {2:.4f}'.format(step, kind, mean_acc))
+            last_found = time.time()
+    finally:
+        evaluator.close()
+
+def _parse_thresholds(thresholds):
+    """Parse the thresholds to sweep, 'start:stop:num' for np.linspace or a 
+    comma separated list of values."""
+    if ':' in thresholds:
+        start, stop, num = thresholds.split(':')
+        return np.linspace(float(start), float(stop), int(num)).astype(np.float32)
+    return np.array([float(th) for th in thresholds.split(',')], dtype=np.float32)
+
+def _read_ensemble_history(history_path, thresholds):
+    """Read the {step: accuracies} dictionary of an ensemble history file, 
+    empty if not found, if its header is malformed or if it was written for
+    other thresholds."""
+    history = {}
+    if os.path.exists(history_path):
+        with open(history_path, 'r') as f:
+            header = f.readline().strip().split(',')[1:]
+            try:
+                header = [float(th) for th in header]
+            except ValueError:
+                return {}
+            if len(header) != len(thresholds) or not np.allclose(header, thresholds):
+                return {}
+            for line in f:
+                if line.strip():
+                    values = line.split(',')
+                    history[int(values[0])] = [float(acc) for acc in values[1:]]
+    return history
+
+def _write_ensemble_history(history_path, history, thresholds):
+    """Write the accuracy vs threshold table, one row per step in step order."""
+    with result_store.atomic_open(history_path) as f:
+        f.write('step, {}\n'.format(', '.join('{:g}'.format(th) for th in thresholds)))
+        for step in sorted(history):
+            f.write('{}, {}\n'.format(step, ', '.join(str(acc) for acc in history[step])))
+
+def ensemble_evaluate(hparams, num_gpus, data_dir, dataset, model_type, total_batch_size, image_size,
+                      thresholds, summary_dir, max_epochs, streaming=False,
+                      device_strategy='multi_gpu'):
+    """Evaluate the ensemble predictions of every ckpt for a whole sweep of thresholds.
+
+    For every class k, the input capsules of capsule2 routed to k with a 
+    coefficient above the threshold are removed and the output capsules 
+    are reassembled from the rest. The ensemble prediction is the argmax of 
+    the norms averaged over the classes k. The towers are rebuilt with the 
+    reassemble branch and the variables of every ckpt are restored, the 
+    forward pass runs once per batch while all the thresholds are fed at 
+    once as a vector. An accuracy vs threshold table is written per split,
+    one row per ckpt, the steps written before are skipped.
+
+    Args:
+        hparams: the hyperparameters to build the model graph;
+        num_gpus: number of GPUs to use;
+        data_dir: the directory containing the input data;
+        dataset: the name of the dataset for the experiment;
+        model_type: the name of model architecture, ≡ 'cap';
+        total_batch_size: total batch size, which will be distributed to {num_gpus} GPUs;
+        image_size: image size after cropping/resizing;
+        thresholds: 'start:stop:num' or comma separated thresholds to sweep;
+        summary_dir: the directory to write summaries and save the model;
+        max_epochs: maximum epochs to evaluate, ≡ 1;
+        streaming: whether to stream the examples from the memory mapped cache;
+        device_strategy: 'single', 'cpu_replicas' or 'multi_gpu'.
+    """
+    assert model_type == 'cap', 'Only capsule models have the ensemble outputs!'
+    thresholds = _parse_thresholds(thresholds)
+    strategy = devices.DeviceStrategy(device_strategy, num_gpus)
+    # define subfolder to load ckpt and write related files
+    load_dir = os.path.join(summary_dir, 'train')
+    summary_dir = os.path.join(summary_dir, 'ensemble')
+    if not os.path.exists(summary_dir):
+        os.makedirs(summary_dir)
+    _, _, all_step_ckpt_pairs = find_latest_checkpoint_info(load_dir, True)
+    if len(all_step_ckpt_pairs) == 0:
+        raise ValueError('{0}\n ckpt files not found!\n {0}'.format('='*20))
+
+    # copy hparams, build the reassemble branch but not the reconstruction
+    hparams = tf.contrib.training.HParams(**hparams.values())
+    hparams.set_hparam('reassemble', True)
+    hparams.set_hparam('remake', False)
+
+    for kind in ['train', 'test']:
+        history_path = os.path.join(summary_dir, '%s_ensemble_history.txt' % kind)
+        history = _read_ensemble_history(history_path, thresholds)
+        # skip the steps evaluated before
+        pending_pairs = [(step, ckptpath) for step, ckptpath in all_step_ckpt_pairs 
+                         if step not in history]
+        if len(pending_pairs) == 0:
+            continue
+
+        # declare an empty model graph
+        with tf.Graph().as_default():
+            # get batched dataset and declare initializable iterator
+            distributed_dataset, specs = get_distributed_dataset(
+                total_batch_size, num_gpus, max_epochs,
+                data_dir, dataset, image_size,
+                kind, streaming=streaming, data_format=hparams.data_format,
+                input_device=strategy.input_device)
+            iterator = distributed_dataset.make_initializable_iterator()
+            model = MODELS[model_type](hparams, specs, strategy)
+
+            # rebuild the towers reading from the iterator 
+            feed_dict = {}
+            tower_corrects = []
+            with tf.device(strategy.input_device):
+                tower_batches = input_utils.split_batch(
+                    iterator.get_next(), specs['num_gpus'])
+            with tf.variable_scope(tf.get_variable_scope()):
+                for i in range(specs['num_gpus']):
+                    with tf.device(strategy.device_fn(i)):
+                        with tf.name_scope('tower_%d' % i):
+                            model.build_replica(i, tower_batches[i])
+                            threshold = tf.get_collection('tower_%d_batched_threshold' % i)[0]
+                            feed_dict[threshold] = thresholds
+                            # (classes, thresholds, ?, 10) -> (thresholds, ?, 10)
+                            ensemble_acts = tf.reduce_mean(
+                                tf.stack(tf.get_collection('tower_%d_ensemble_acts' % i)), axis=0)
+                            preds = tf.argmax(ensemble_acts, axis=-1, output_type=tf.int32)
+                            labels = tf.get_collection('tower_%d_batched_labels' % i)[0]
+                            lbls = tf.argmax(labels, axis=-1, output_type=tf.int32)
+                            # number of correct predictions for every threshold, (thresholds,)
+                            tower_corrects.append((
+                                tf.reduce_sum(tf.cast(tf.equal(preds, lbls), tf.int32), axis=1),
+                                tf.shape(lbls)[0]))
+                    tf.get_variable_scope().reuse_variables()
+            saver = tf.train.Saver()
+
+            with tf.Session(config=strategy.session_config()) as sess:
+                for step, ckptpath in pending_pairs:
+                    # restore variables
+                    saver.restore(sess, ckptpath)
+                    sess.run(iterator.initializer)
+                    corrects = np.zeros(len(thresholds), dtype=np.int64)
+                    total = 0
+                    while True:
+                        try:
+                            for num_correct, num_examples in sess.run(tower_corrects, feed_dict=feed_dict):
+                                corrects += num_correct
+                                total += num_examples
+                        except tf.errors.OutOfRangeError:
+                            break
+                    accs = corrects / total
+                    history[step] = accs.tolist()
+                    _write_ensemble_history(history_path, history, thresholds)
+                    best = np.argmax(accs)
+                    print('step: {0}, {1} best accuracy = {2:.4f} at threshold {3:g}'.format(
+                        step, kind, accs[best], thresholds[best]))
 
 def run_test_session(iterator, specs, load_dir):
     """Load available ckpts"""
@@ -464,27 +1333,27 @@ def run_test_session(iterator, specs, load_dir):
         print('{0}\nFound a ckpt!\n{0}'.format('='*20))
         latest_ckpt_meta_path = latest_ckpt_path + '.meta'
 
+    export_dir = find_inference_graph(load_dir, latest_ckpt_path)
     with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
-        # import compute graph
-        saver = tf.train.import_meta_graph(latest_ckpt_meta_path)
-        # get dataset object working
-        batch_data = iterator.get_next()
+        if export_dir is not None:
+            # the exported inference graph of the ckpt is a single tower 
+            # taking whole batches, with no variables to restore
+            load_inference_graph(export_dir, batch_data=iterator.get_next(), 
+                                 data_format=specs['data_format'])
+        else:
+            # import compute graph with the towers reading from the iterator
+            saver = _import_meta_graph_on_iterator(
+                latest_ckpt_meta_path, iterator, specs['data_format'])
+            # restore variables 
+            saver.restore(sess, latest_ckpt_path)
 
         acc_t = tf.get_collection('accuracy')[0]
-        
-        # restore variables 
-        saver.restore(sess, latest_ckpt_path)
         sess.run(iterator.initializer)
 
         accs = []
         while True:
             try:
-                feed_dict = {}
-                for i in range(specs['num_gpus']):
-                    batch_val = sess.run(batch_data)
-                    feed_dict[tf.get_collection('tower_%d_batched_images' % i)[0]] = batch_val['images']
-                    feed_dict[tf.get_collection('tower_%d_batched_labels' % i)[0]] = batch_val['labels']
-                acc = sess.run(acc_t, feed_dict=feed_dict)
+                acc = sess.run(acc_t)
                 accs.append(acc)
             except tf.errors.OutOfRangeError:
                 break
@@ -492,7 +1361,8 @@ def run_test_session(iterator, specs, load_dir):
         mean_acc = np.mean(accs)
         print(mean_acc)
 
-def test(split, num_gpus, data_dir, dataset, total_batch_size, image_size, summary_dir, max_epochs):
+def test(split, num_gpus, data_dir, dataset, total_batch_size, image_size, summary_dir, max_epochs,
+         streaming=False, data_format='NCHW'):
     # define subfolder to load ckpt
     load_dir = os.path.join(summary_dir, 'train')
     # declare an empty model graph
@@ -501,14 +1371,238 @@ def test(split, num_gpus, data_dir, dataset, total_batch_size, image_size, summa
         distributed_dataset, specs = get_distributed_dataset(
             total_batch_size, num_gpus, max_epochs,
             data_dir, dataset, image_size,
-            split)
+            split, streaming=streaming, data_format=data_format)
         iterator = distributed_dataset.make_initializable_iterator()
         # call test experiment
         run_test_session(iterator, specs, load_dir)
 
+def _inference_graph_paths(export_dir):
+    """Paths of the frozen inference graph and its sidecar file."""
+    return (os.path.join(export_dir, 'inference_graph.meta'), 
+            os.path.join(export_dir, 'inference_graph.json'))
+
+def _check_inference_graph(meta_graph_def, tensors):
+    """Whether the gradients of the visual tensors w.r.t. the input images, 
+    which the explorations need, can still be built on the given graph."""
+    with tf.Graph().as_default() as graph:
+        try:
+            tf.train.import_meta_graph(meta_graph_def)
+            batched_images = graph.get_tensor_by_name(tensors['batched_images'])
+            visual_tensors = [graph.get_tensor_by_name(name) for name in tensors['visual']]
+            grads = tf.gradients(tf.reduce_sum(visual_tensors[-1]), batched_images)
+            return grads[0] is not None
+        except Exception as e:
+            print('Inference graph check failed: {}'.format(e))
+            return False
+
+def export_inference_graph(hparams, model_type, dataset, image_size, 
+                           summary_dir, keep_remake=False):
+    """Export a frozen inference graph of the latest ckpt.
+
+    A single tower is rebuilt from the model class without the optimizer, 
+    the summaries and the other replicas, the variables are restored and 
+    converted into constants and the constants are folded. The input 
+    placeholders, the visual tensors and the accuracy are kept, their names
+    are written to a sidecar json file read by load_inference_graph(). The
+    graph is written as a meta graph with the while loop contexts of the 
+    routing, so that the explorations can still take gradients on it.
+
+    Args:
+        hparams: the hyperparameters to build the model graph;
+        model_type: the name of model architecture;
+        dataset: the name of the dataset for the experiment;
+        image_size: image size after cropping/resizing;
+        summary_dir: the directory of the run, the graph is written to {summary_dir}/export;
+        keep_remake: whether to keep the reconstruction subnetwork.
+    """
+    # define subfolder to load ckpt and write the graph
+    load_dir = os.path.join(summary_dir, 'train')
+    export_dir = os.path.join(summary_dir, 'export')
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    latest_step, latest_ckpt_path, _ = find_latest_checkpoint_info(load_dir)
+    if latest_step == -1 or latest_ckpt_path == None:
+        raise ValueError('{0}\n ckpt files not found!\n {0}'.format('='*20))
+
+    # copy hparams, the reconstruction subnetwork is only built when kept
+    hparams = tf.contrib.training.HParams(**hparams.values())
+    if 'remake' in hparams.values():
+        hparams.set_hparam('remake', hparams.remake and keep_remake)
+
+    # the input placeholders only need the shape of the images
+    specs = {
+        'image_size': image_size,
+        'depth': DEPTHS[dataset],
+        'num_classes': 10,
+        'num_gpus': 1,
+        'data_format': hparams.data_format
+    }
+    with tf.Graph().as_default():
+        model = MODELS[model_type](hparams, specs)
+        with tf.name_scope('tower_0') as scope:
+            inferred = model.build_replica(0)
+            _, _, accuracy = model_utils.evaluate(
+                logits=inferred.logits,
+                scope=scope,
+                loss_type=hparams.loss_type)
+        tensors = {
+            'batched_images': tf.get_collection('tower_0_batched_images')[0].name,
+            'batched_labels': tf.get_collection('tower_0_batched_labels')[0].name,
+            'visual': [t.name for t in tf.get_collection('tower_0_visual')],
+            'recons': [t.name for t in tf.get_collection('tower_0_recons')],
+            'accuracy': accuracy.name
+        }
+        input_nodes = [tensors['batched_images'].split(':')[0], 
+                       tensors['batched_labels'].split(':')[0]]
+        output_nodes = sorted(set(name.split(':')[0] for name in 
+                                  tensors['visual'] + tensors['recons'] + [tensors['accuracy']]))
+
+        saver = tf.train.Saver()
+        with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+            saver.restore(sess, latest_ckpt_path)
+            # only keep the nodes the outputs depend on, variables become constants
+            frozen_graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, sess.graph.as_graph_def(), output_nodes)
+        # the graph is placed by the session that loads it
+        for node in frozen_graph_def.node:
+            node.device = ''
+        folded_graph_def = TransformGraph(frozen_graph_def, input_nodes, output_nodes, 
+                                          ['fold_constants(ignore_errors=true)'])
+
+        # folding may drop nodes the while loop contexts refer to, 
+        # fall back to the unfolded graph if the gradients break
+        meta_graph_def = None
+        for graph_def in [folded_graph_def, frozen_graph_def]:
+            candidate = tf.train.export_meta_graph(
+                graph_def=graph_def, collection_list=[tf.GraphKeys.WHILE_CONTEXT],
+                clear_devices=True)
+            if _check_inference_graph(candidate, tensors):
+                meta_graph_def = candidate
+                break
+        if meta_graph_def is None:
+            raise ValueError('The exported inference graph can not be differentiated!')
+
+    graph_path, info_path = _inference_graph_paths(export_dir)
+    with open(graph_path, 'wb') as f:
+        f.write(meta_graph_def.SerializeToString())
+    with open(info_path, 'w') as f:
+        json.dump({'checkpoint': os.path.basename(latest_ckpt_path),
+                   'model': model_type, 'dataset': dataset, 
+                   'image_size': specs['image_size'], 'depth': specs['depth'],
+                   'data_format': hparams.data_format,
+                   'remake': len(tensors['recons']) > 0,
+                   'tensors': tensors}, f, indent=4)
+    print('Exported the inference graph of {} to {} ({} nodes, {})'.format(
+        latest_ckpt_path, graph_path, len(graph_def.node), 
+        'folded' if graph_def is folded_graph_def else 'not folded'))
+
+def find_inference_graph(load_dir, ckpt_path):
+    """Find the exported inference graph of the given ckpt of the run.
+
+    Args:
+        load_dir: the train directory of the run;
+        ckpt_path: the ckpt path the graph should have been exported from.
+    Returns:
+        the export directory, or None if there is no graph of {ckpt_path}.
+    """
+    export_dir = os.path.join(os.path.dirname(os.path.normpath(load_dir)), 'export')
+    graph_path, info_path = _inference_graph_paths(export_dir)
+    if not (os.path.exists(graph_path) and os.path.exists(info_path)):
+        return None
+    with open(info_path, 'r') as f:
+        info = json.load(f)
+    if info['checkpoint'] != os.path.basename(ckpt_path):
+        return None
+    return export_dir
+
+def load_inference_graph(export_dir, input_map=None, batch_data=None, data_format='NCHW'):
+    """Import an exported inference graph into the default graph and add 
+    its tensors to the collections of tower 0, the same collections the 
+    training graph has, so the graph needs no variables to restore.
+
+    Args:
+        export_dir: the directory of the exported graph;
+        input_map: optional map from the input tensor names to tensors;
+        batch_data: optional feature dictionary of a batch of the dataset 
+            iterator, the inputs of the graph are mapped to it;
+        data_format: 'NCHW' or 'NHWC', layout of the images of {batch_data},
+            the images are transposed if the graph has the other one.
+    Returns:
+        info: the content of the sidecar json file.
+    """
+    graph_path, info_path = _inference_graph_paths(export_dir)
+    with open(info_path, 'r') as f:
+        info = json.load(f)
+    tensors = info['tensors']
+    if batch_data is not None:
+        images = batch_data['images']
+        graph_format = info.get('data_format', 'NCHW')
+        if graph_format != data_format:
+            images = tf.transpose(images, [0, 3, 1, 2] if graph_format == 'NCHW' else [0, 2, 3, 1])
+        input_map = dict(input_map or {})
+        input_map[tensors['batched_images']] = images
+        input_map[tensors['batched_labels']] = tf.cast(batch_data['labels'], tf.int32)
+    # no variables, so there is nothing to restore
+    tf.train.import_meta_graph(graph_path, input_map=input_map)
+
+    graph = tf.get_default_graph()
+    tf.add_to_collection('tower_0_batched_images', graph.get_tensor_by_name(tensors['batched_images']))
+    tf.add_to_collection('tower_0_batched_labels', graph.get_tensor_by_name(tensors['batched_labels']))
+    for name in tensors['visual']:
+        tf.add_to_collection('tower_0_visual', graph.get_tensor_by_name(name))
+    for name in tensors['recons']:
+        tf.add_to_collection('tower_0_recons', graph.get_tensor_by_name(name))
+    tf.add_to_collection('accuracy', graph.get_tensor_by_name(tensors['accuracy']))
+    return info
+
+def _build_in_graph_ascent(model_type, hparams, specs, aspect_type,
+                           img0, iter_n, step, threshold):
+    """Rebuild the first tower of the model on top of the given images and 
+    build the in-graph gradient ascent of the given aspect.
+
+    The imported meta graph only holds the forward pass of the input 
+    placeholders, which can't run again inside a tf.while_loop, so the tower 
+    is rebuilt from the model class and the variables should be restored 
+    from the checkpoint afterwards.
+
+    Args:
+        model_type: the abbreviation of model architecture;
+        hparams: the hyperparameters of the model;
+        specs: dataset specs;
+        aspect_type: 'naive_max_norm', 'max_norm_diff', 'naive_max_caps_dim' or 'max_caps_dim_diff';
+        img0: the original batched input images tensor, every row is ascended along its own objective;
+        iter_n: number of iterations to add gradients to original image;
+        step: step size of each iteration of gradient ascent to mutliply;
+        threshold: any gradients less than this value will not be added to the original image.
+    Returns:
+        batched_targets: placeholder of target objective indices;
+        iter_n_recorded: iterations number recorded;
+        ga_imgs: tensor of recorded images;
+        ga_preds: tensor of capsule norms of the recorded images.
+    """
+    model = MODELS[model_type](hparams, specs)
+
+    def forward_fn(images):
+        """Build the first tower on the given images and return its new 
+        visualization related tensors."""
+        num_visual = len(tf.get_collection('tower_0_visual'))
+        with tf.variable_scope(tf.get_variable_scope(), reuse=tf.AUTO_REUSE):
+            with tf.name_scope('tower_0'):
+                model.build_inference(images, 0)
+        return tf.get_collection('tower_0_visual')[num_visual:]
+    
+    # create the variables outside of the while loop
+    forward_fn(img0)
+
+    return utils.build_gradient_ascent(
+        forward_fn, VIS_GRAD_COMPUTER[aspect_type].compute_objectives, 
+        img0, iter_n, step, threshold)
+
 def run_norm_aspect(num_gpus, total_batch_size, max_epochs, data_dir, dataset, image_size,
                     iter_n, step, threshold,
-                    load_dir, summary_dir, aspect_type):
+                    load_dir, summary_dir, aspect_type,
+                    in_graph_ascent=False, model_type=None, hparams=None,
+                    dream_seed=None, num_shards=1, session_threads=None):
     """Run norm aspect exploration. Producing results to summary_dir.
     
     Args:
@@ -523,7 +1617,16 @@ def run_norm_aspect(num_gpus, total_batch_size, max_epochs, data_dir, dataset, i
         threshold: any gradients less than this value will not be added to the original image;
         load_dir: the directory to load files;
         summary_dir: the directory to write files;
-        aspect_type: 'naive_max_norm' or 'max_norm_diff'.
+        aspect_type: 'naive_max_norm' or 'max_norm_diff';
+        in_graph_ascent: whether to run the whole gradient ascent inside the graph;
+        model_type: the abbreviation of model architecture, used by in graph ascent;
+        hparams: the hyperparameters of the model, used by in graph ascent and 
+            for the data format of the input images;
+        dream_seed: seed of the noise images or of the random selection of 
+            the images of every class, None for the default;
+        num_shards: number of shards of the work units, if larger than 1, the 
+            unfinished shards are claimed one after another and merged at the end;
+        session_threads: number of threads of the session, None for all the cores.
     """
     # wrtie specs file 
     write_dir = _write_specs_file(summary_dir, aspect_type, dataset, total_batch_size,
@@ -542,89 +1645,105 @@ def run_norm_aspect(num_gpus, total_batch_size, max_epochs, data_dir, dataset, i
     else:
         latest_ckpt_meta_path = latest_ckpt_path + '.meta'
     
-    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
-        # import compute graph and restore variables 
-        saver = tf.train.import_meta_graph(latest_ckpt_meta_path)
-        saver.restore(sess, latest_ckpt_path)
-
-        # compute the gradients
-        result_grads, batched_images, caps_norms_tensor = VIS_GRAD_COMPUTER[aspect_type].compute_grads(0)
-        n_repeats = len(result_grads)
-        print('Number of gradients computed (= n_repeats = number of batches per epoch): ',
+    # get batched dataset and specs, every image is ascended along all 
+    # the {n_repeats} objectives at once, so it only appears once
+    data_format = hparams.data_format if hparams is not None else 'NCHW'
+    batched_dataset, specs = get_distributed_dataset(
+        total_batch_size, num_gpus, max_epochs,
+        data_dir, dataset, image_size,
+        split=split, n_repeats=1, seed=dream_seed, data_format=data_format)
+    if split == 'noise':
+        num_class_loop = 1
+    else:
+        num_class_loop = specs['num_classes'] 
+    # take the images of one shard and skip the completed ones
+    shard_index = tf.placeholder(tf.int64, shape=[], name='shard_index')
+    n_skip = tf.placeholder(tf.int64, shape=[], name='n_skip')
+    batched_dataset = batched_dataset.shard(num_shards, shard_index).skip(n_skip)
+    iterator = batched_dataset.make_initializable_iterator()
+    batch_data = iterator.get_next()
+
+    if in_graph_ascent:
+        # one objective per class capsule
+        n_repeats = specs['num_classes']
+        img0 = tf.tile(batch_data['images'], [n_repeats, 1, 1, 1])
+        batched_targets, iter_n_recorded, ga_imgs, ga_preds, ga_entropies = _build_in_graph_ascent(
+            model_type, hparams, specs, aspect_type, img0, iter_n, step, threshold)
+        saver = tf.train.Saver()
+
+    config = tf.ConfigProto(allow_soft_placement=True)
+    if session_threads:
+        config.intra_op_parallelism_threads = session_threads
+        config.inter_op_parallelism_threads = session_threads
+    with tf.Session(config=config) as sess:
+        if in_graph_ascent:
+            # restore variables of the rebuilt tower
+            saver.restore(sess, latest_ckpt_path)
+        else:
+            export_dir = find_inference_graph(load_dir, latest_ckpt_path)
+            if export_dir is not None:
+                # import the exported inference graph of the ckpt
+                load_inference_graph(export_dir)
+            else:
+                # import compute graph and restore variables 
+                saver = tf.train.import_meta_graph(latest_ckpt_meta_path)
+                saver.restore(sess, latest_ckpt_path)
+
+            # compute the gradients
+            result_grads, batched_images, batched_targets, caps_norms_tensor = VIS_GRAD_COMPUTER[aspect_type].compute_grads(0)
+            n_repeats = caps_norms_tensor.get_shape()[1].value
+            # the imported graph may have been built with the other data format
+            graph_format = _data_format_of(batched_images.get_shape().as_list())
+        print('Number of objectives ascended per image (= n_repeats = batch size of ascent): ',
               n_repeats)
         
-        batched_labels_t = tf.get_collection('tower_%d_batched_labels' % 0)[0]
-
-        # get batched dataset and specs
-        batched_dataset, specs = get_distributed_dataset(
-            total_batch_size, num_gpus, max_epochs,
-            data_dir, dataset, image_size,
-            split=split, n_repeats=n_repeats)
-        iterator = batched_dataset.make_initializable_iterator()
-        batch_data = iterator.get_next()
-        sess.run(iterator.initializer)
-
-        if split == 'noise':
-            num_class_loop = 1
+        def ascend_fn(j):
+            """Ascend the next image along all the {n_repeats} objectives."""
+            if in_graph_ascent:
+                # run the whole gradient ascent and the predictions 
+                # of the recorded images in one session call
+                ga_img_matr, pred_matr, entropy_matr = sess.run(
+                    [ga_imgs, ga_preds, ga_entropies], feed_dict={batched_targets: np.arange(n_repeats)})
+                # the images are stored in (CHW)
+                return (iter_n_recorded, _convert_images(ga_img_matr, data_format, 'NCHW'), 
+                        pred_matr, entropy_matr)
+            
+            # get batched values
+            batch_val = sess.run(batch_data)
+
+            # run gradient ascent {iter_n} iterations with {step} step size
+            # and threshold to get gradient ascended stacked image tensor,
+            # row k of the batch is ascended along the objective k
+            # (n_repeats, 1, 24, 24) and (n_repeats, 3, 24, 24)
+            img0 = np.repeat(_convert_images(batch_val['images'], data_format, graph_format), 
+                             n_repeats, axis=0)
+            iter_n_recorded, ga_img_matr, pred_matr, entropy_matr = utils.run_gradient_ascent(
+                result_grads, caps_norms_tensor, img0, batched_images, sess, iter_n, step, threshold,
+                feed_dict={batched_targets: np.arange(n_repeats)})
+            # the images are stored in (CHW)
+            return (iter_n_recorded, _convert_images(ga_img_matr, graph_format, 'NCHW'), 
+                    pred_matr, entropy_matr)
+
+        params = {
+            'aspect_type': aspect_type, 'split': split, 'dataset': dataset, 
+            'total_batch_size': total_batch_size, 'image_size': image_size, 
+            'max_epochs': max_epochs, 'iter_n': iter_n, 'step': step, 
+            'threshold': threshold, 'dream_seed': dream_seed}
+        if num_shards > 1:
+            shards = _claim_shards(os.path.join(write_dir, 'shards'), num_shards)
         else:
-            num_class_loop = specs['num_classes'] 
-        for i in range(max_epochs):
-            for j in range(num_class_loop):
-                for k in range(n_repeats):
-                    try:
-                        # get batched values
-                        batch_val = sess.run(batch_data)
-
-                        # run gradient ascent {iter_n} iterations with {step} step size
-                        # and threshold to get gradient ascended stacked image tensor
-                        # (iter_n, 1, 24, 24) and (iter_n, 3, 24, 24)
-                        img0 = batch_val['images']
-                        iter_n_recorded, ga_img_list = utils.run_gradient_ascent(
-                            result_grads[k], img0, batched_images, sess, iter_n, step, threshold)
-                        
-                        pred_class_prob_list = [] # list of probabilities of classes
-                        pred_class_entropy_list = [] # list of probabilities of prediction entropies
-                        for img in ga_img_list:
-                            pred = sess.run(caps_norms_tensor, feed_dict={batched_images: img}) # (1, 10)
-                            pred = np.reshape(pred, -1) # (10,)
-                            pred_cl = np.argmax(pred) # ()
-
-                            entropy = _compute_entropy(pred)
-                            
-                            # winning capsule mask
-                            win_cap_mask = np.array([0.0 for _ in range(10)])
-                            win_cap_mask[pred_cl] = 1.0
-                            win_cap_mask = np.expand_dims(win_cap_mask, axis=0)
-                            # all capsules mask
-                            all_cap_mask = np.expand_dims(np.array([1.0 for _ in range(10)]), axis=0)
-
-                            pred_class_prob_list.append(pred) # [(10,), (10,), ...]
-                            pred_class_entropy_list.append(entropy)
-
-                        ga_iter_matr = np.array(iter_n_recorded)
-                        ga_img_matr = np.stack(ga_img_list, axis=0)
-                        pred_class_prob_matr = np.stack(pred_class_prob_list)
-                        pred_class_entropy_matr = np.stack(pred_class_entropy_list, axis=0)
-
-                        # save to npz file
-                        npzfname = 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(i, j, k)
-                        npzfname = os.path.join(write_dir, npzfname)
-                        np.savez(npzfname, iters=ga_iter_matr, images=ga_img_matr, pred=pred_class_prob_matr, 
-                                 pred_entropy=pred_class_entropy_matr)
-
-                        print('{0} {1} total:class:gradient = {2:.1f}% ~ {3:.1f}% ~ {4:.1f}%'.format(
-                            ' '*5, '-'*5, 
-                            100.0*(i * num_class_loop * n_repeats + j * n_repeats + k + 1) / (max_epochs * num_class_loop * n_repeats),
-                            100.0*(j * n_repeats + k + 1)/(num_class_loop * n_repeats),
-                            100.0*(k + 1)/n_repeats), end='\r')
-                    except tf.errors.OutOfRangeError:
-                        break
-        print()
+            shards = [(0, write_dir)]
+        _explore_shards(sess, iterator, batch_data, shard_index, n_skip, ascend_fn,
+                        shards, num_shards, latest_ckpt_path, params,
+                        max_epochs, num_class_loop, n_repeats)
+        if num_shards > 1:
+            _merge_shard_stores(write_dir, num_shards, latest_ckpt_path, params)
 
 def explore_norm_aspect(num_gpus, data_dir, dataset, image_size,
                         total_batch_size, summary_dir, max_epochs,
                         iter_n, step, threshold,
-                        aspect_type):
+                        aspect_type, in_graph_ascent=False, model_type=None, hparams=None,
+                        dream_seed=None, num_shards=1, session_threads=None):
     """Run gradient ascent on given images.
     
     Args:
@@ -638,7 +1757,15 @@ def explore_norm_aspect(num_gpus, data_dir, dataset, image_size,
         iter_n: number of iterations to add gradients to original images;
         step: step size of each iteration of gradient ascent;
         threshold: any gradients less than this value will not be added to the original images;
-        aspect_type: 'naive_max_norm', 'max_norm_diff', or 'noise_naive_max_norm', 'noise_max_norm_diff'.
+        aspect_type: 'naive_max_norm', 'max_norm_diff', or 'noise_naive_max_norm', 'noise_max_norm_diff';
+        in_graph_ascent: whether to run the whole gradient ascent inside the graph;
+        model_type: the abbreviation of model architecture, used by in graph ascent;
+        hparams: the hyperparameters of the model, used by in graph ascent and 
+            for the data format of the input images;
+        dream_seed: seed of the noise images or of the random selection of 
+            the images of every class, None for the default;
+        num_shards: number of shards of the work units;
+        session_threads: number of threads of the session, None for all the cores.
     """
     # define load_dir and summary_dir
     load_dir = os.path.join(summary_dir, 'train')
@@ -648,11 +1775,15 @@ def explore_norm_aspect(num_gpus, data_dir, dataset, image_size,
         # call run_norm_aspect
         run_norm_aspect(num_gpus, total_batch_size, max_epochs, data_dir, dataset, image_size,
                         iter_n, step, threshold,
-                        load_dir, summary_dir, aspect_type)
+                        load_dir, summary_dir, aspect_type,
+                        in_graph_ascent, model_type, hparams, dream_seed,
+                        num_shards, session_threads)
 
 def run_direction_aspect(num_gpus, total_batch_size, max_epochs, data_dir, dataset, image_size,
                          iter_n, step, threshold,
-                         load_dir, summary_dir, aspect_type):
+                         load_dir, summary_dir, aspect_type,
+                         in_graph_ascent=False, model_type=None, hparams=None,
+                         dream_seed=None, num_shards=1, session_threads=None):
     """Run direction aspect exploration. Producing results to summary_dir.
 
     Args:
@@ -667,7 +1798,16 @@ def run_direction_aspect(num_gpus, total_batch_size, max_epochs, data_dir, datas
         threshold: any gradients less than this value will not be added to original images;
         load_dir: the directory to load files;
         summary_dir: the directory to write files;
-        aspect_type: 'naive_max_caps_dim', 'max_caps_dim_diff', or 'noise_naive_max_caps_dim', 'max_caps_dim_diff'.
+        aspect_type: 'naive_max_caps_dim', 'max_caps_dim_diff', or 'noise_naive_max_caps_dim', 'max_caps_dim_diff';
+        in_graph_ascent: whether to run the whole gradient ascent inside the graph;
+        model_type: the abbreviation of model architecture, used by in graph ascent;
+        hparams: the hyperparameters of the model, used by in graph ascent and 
+            for the data format of the input images;
+        dream_seed: seed of the noise images or of the random selection of 
+            the images of every class, None for the default;
+        num_shards: number of shards of the work units, if larger than 1, the 
+            unfinished shards are claimed one after another and merged at the end;
+        session_threads: number of threads of the session, None for all the cores.
     """
     # Write specs file
     write_dir = _write_specs_file(summary_dir, aspect_type, dataset, total_batch_size,
@@ -687,88 +1827,103 @@ def run_direction_aspect(num_gpus, total_batch_size, max_epochs, data_dir, datas
     else:
         latest_ckpt_meta_path = latest_ckpt_path + '.meta'
 
-    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
-        # Import compute graph and restore variables
-        saver = tf.train.import_meta_graph(latest_ckpt_meta_path)
-        saver.restore(sess, latest_ckpt_path)
-
-        # Compute the gradients
-        result_grads, batched_images, caps_norms_tensor= VIS_GRAD_COMPUTER[aspect_type].compute_grads(0)
-        n_repeats = 16 # 16 dimensional vector
-        print('Number of gradients computed: ', len(result_grads))
-
-        batched_labels_t = tf.get_collection('tower_%d_batched_labels' % 0)[0]
-
-        # Get batched dataset and specs
-        batched_dataset, specs = get_distributed_dataset(
-            total_batch_size, num_gpus, max_epochs, 
-            data_dir, dataset, image_size,
-            split=split, n_repeats=n_repeats)
-        iterator = batched_dataset.make_initializable_iterator()
-        batch_data = iterator.get_next()
-        sess.run(iterator.initializer)
+    # Get batched dataset and specs, every image is ascended along all 
+    # the {n_repeats} dimensions at once, so it only appears once
+    data_format = hparams.data_format if hparams is not None else 'NCHW'
+    batched_dataset, specs = get_distributed_dataset(
+        total_batch_size, num_gpus, max_epochs, 
+        data_dir, dataset, image_size,
+        split=split, n_repeats=1, seed=dream_seed, data_format=data_format)
+    num_class_loop = specs['num_classes'] 
+    # Take the images of one shard and skip the completed ones
+    shard_index = tf.placeholder(tf.int64, shape=[], name='shard_index')
+    n_skip = tf.placeholder(tf.int64, shape=[], name='n_skip')
+    batched_dataset = batched_dataset.shard(num_shards, shard_index).skip(n_skip)
+    iterator = batched_dataset.make_initializable_iterator()
+    batch_data = iterator.get_next()
+
+    n_repeats = 16 # 16 dimensional vector
+    if in_graph_ascent:
+        img0 = tf.tile(batch_data['images'], [n_repeats, 1, 1, 1])
+        batched_targets, iter_n_recorded, ga_imgs, ga_preds, ga_entropies = _build_in_graph_ascent(
+            model_type, hparams, specs, aspect_type, img0, iter_n, step, threshold)
+        saver = tf.train.Saver()
+
+    config = tf.ConfigProto(allow_soft_placement=True)
+    if session_threads:
+        config.intra_op_parallelism_threads = session_threads
+        config.inter_op_parallelism_threads = session_threads
+    with tf.Session(config=config) as sess:
+        if in_graph_ascent:
+            # Restore variables of the rebuilt tower
+            saver.restore(sess, latest_ckpt_path)
+        else:
+            export_dir = find_inference_graph(load_dir, latest_ckpt_path)
+            if export_dir is not None:
+                # Import the exported inference graph of the checkpoint
+                load_inference_graph(export_dir)
+            else:
+                # Import compute graph and restore variables
+                saver = tf.train.import_meta_graph(latest_ckpt_meta_path)
+                saver.restore(sess, latest_ckpt_path)
+
+            # Compute the gradients
+            result_grads, batched_images, batched_targets, caps_norms_tensor = VIS_GRAD_COMPUTER[aspect_type].compute_grads(0)
+            # The imported graph may have been built with the other data format
+            graph_format = _data_format_of(batched_images.get_shape().as_list())
+        print('Number of objectives ascended per image (= batch size of ascent): ', n_repeats)
 
         # Suppose now we feed in image with lbl0 = '0',
-        # and only run experiment on maximizing one specific 
-        # dimension of capsule '0'.
-        num_class_loop = specs['num_classes'] 
-        for i in range(max_epochs): # instance number 
-            for j in range(num_class_loop): # j is the index of the target label capsule
-                for k in range(n_repeats): # 16 dimensional wise loop
-                    try:
-                        # Get batched values
-                        batch_val = sess.run(batch_data)
-
-                        # Run gradient ascent {iter_n} iterations with step_size={step}
-                        # and threshold to get gradient ascended stacked image tensor
-                        # (iter_n, 1, 24, 24) and (iter_n, 3, 24, 24)
-                        img0 = batch_val['images']
-                        iter_n_recorded, ga_img_list = utils.run_gradient_ascent(
-                            result_grads[j*num_class_loop+k], img0, batched_images, sess, iter_n, step, threshold)
-                        
-                        pred_class_prob_list = [] # list of (predicted_class, probabilities of predicted class)s
-                        pred_class_entropy_list = []
-
-                        for img in ga_img_list:
-                            pred = sess.run(caps_norms_tensor, feed_dict={batched_images: img}) # (1, 10)
-                            pred = np.reshape(pred, -1) # (10,)
-                            pred_cl = np.argmax(pred) # ()
-
-                            entropy = _compute_entropy(pred)
-
-                            # winning capsule mask
-                            win_cap_mask = np.array([0.0 for _ in range(10)])
-                            win_cap_mask[pred_cl] = 1.0 
-                            win_cap_mask = np.expand_dims(win_cap_mask, axis=0)
-                            # all capsules mask
-                            all_cap_mask = np.expand_dims(np.array([1.0 for _ in range(10)]), axis=0)
-
-                            pred_class_prob_list.append(pred)
-                            pred_class_entropy_list.append(entropy)
-
-                        ga_iter_matr = np.array(iter_n_recorded)
-                        ga_img_matr = np.stack(ga_img_list, axis=0)
-                        pred_class_prob_matr = np.stack(pred_class_prob_list)
-                        pred_class_entropy_matr = np.stack(pred_class_entropy_list, axis=0)
-
-                        # save to npz file
-                        npzfname = 'instance_{}-cap_{}-dim_{}.npz'.format(i, j, k)
-                        npzfname = os.path.join(write_dir, npzfname)
-                        np.savez(npzfname, iters=ga_iter_matr, images=ga_img_matr, pred=pred_class_prob_matr,
-                                 pred_entropy=pred_class_entropy_matr)
-
-                        print('{0} {1} total:class:gradient = {2:.1f}% ~ {3:.1f}% ~ {4:.1f}%'.format(
-                            ' '*5, '-'*5, 
-                            100.0*(i * num_class_loop * n_repeats + j * n_repeats + k + 1) / (max_epochs * num_class_loop * n_repeats),
-                            100.0*(j * n_repeats + k + 1)/(num_class_loop * n_repeats),
-                            100.0*(k + 1)/n_repeats), end='\r')
-                    except tf.errors.OutOfRangeError:
-                        break
-        print()
+        # and run experiment on maximizing every dimension 
+        # of capsule '0' at once, one dimension per row.
+        def ascend_fn(j):
+            """Ascend the next image along all the dimensions of capsule j."""
+            if in_graph_ascent:
+                # Run the whole gradient ascent and the predictions 
+                # of the recorded images in one session call
+                ga_img_matr, pred_matr, entropy_matr = sess.run(
+                    [ga_imgs, ga_preds, ga_entropies], 
+                    feed_dict={batched_targets: j * n_repeats + np.arange(n_repeats)})
+                # The images are stored in (CHW)
+                return (iter_n_recorded, _convert_images(ga_img_matr, data_format, 'NCHW'), 
+                        pred_matr, entropy_matr)
+
+            # Get batched values
+            batch_val = sess.run(batch_data)
+
+            # Run gradient ascent {iter_n} iterations with step_size={step}
+            # and threshold to get gradient ascended stacked image tensor,
+            # row k of the batch maximizes the dimension k of capsule j
+            # (n_repeats, 1, 24, 24) and (n_repeats, 3, 24, 24)
+            img0 = np.repeat(_convert_images(batch_val['images'], data_format, graph_format), 
+                             n_repeats, axis=0)
+            iter_n_recorded, ga_img_matr, pred_matr, entropy_matr = utils.run_gradient_ascent(
+                result_grads, caps_norms_tensor, img0, batched_images, sess, iter_n, step, threshold,
+                feed_dict={batched_targets: j * n_repeats + np.arange(n_repeats)})
+            # The images are stored in (CHW)
+            return (iter_n_recorded, _convert_images(ga_img_matr, graph_format, 'NCHW'), 
+                    pred_matr, entropy_matr)
+
+        params = {
+            'aspect_type': aspect_type, 'split': split, 'dataset': dataset, 
+            'total_batch_size': total_batch_size, 'image_size': image_size, 
+            'max_epochs': max_epochs, 'iter_n': iter_n, 'step': step, 
+            'threshold': threshold, 'dream_seed': dream_seed}
+        if num_shards > 1:
+            shards = _claim_shards(os.path.join(write_dir, 'shards'), num_shards)
+        else:
+            shards = [(0, write_dir)]
+        _explore_shards(sess, iterator, batch_data, shard_index, n_skip, ascend_fn,
+                        shards, num_shards, latest_ckpt_path, params,
+                        max_epochs, num_class_loop, n_repeats)
+        if num_shards > 1:
+            _merge_shard_stores(write_dir, num_shards, latest_ckpt_path, params)
 
 def explore_direction_aspect(num_gpus, data_dir, dataset, image_size,
                              total_batch_size, summary_dir, max_epochs,
-                             iter_n, step, threshold, aspect_type):
+                             iter_n, step, threshold, aspect_type,
+                             in_graph_ascent=False, model_type=None, hparams=None,
+                             dream_seed=None, num_shards=1, session_threads=None):
     """Start direction aspect exploration. Producing results to summary_dir.
 
     Args:
@@ -782,7 +1937,15 @@ def explore_direction_aspect(num_gpus, data_dir, dataset, image_size,
         iter_n: number of iterations to add gradients to original image;
         step: step size of each iteration of gradient ascent to mutliply;
         threshold: any gradients less than this value will not be added to the original image;
-        aspect_type: 'naive_max_caps_dim', 'max_caps_dim_diff', or 'noise_naive_max_caps_dim', 'max_caps_dim_diff'.
+        aspect_type: 'naive_max_caps_dim', 'max_caps_dim_diff', or 'noise_naive_max_caps_dim', 'max_caps_dim_diff';
+        in_graph_ascent: whether to run the whole gradient ascent inside the graph;
+        model_type: the abbreviation of model architecture, used by in graph ascent;
+        hparams: the hyperparameters of the model, used by in graph ascent and 
+            for the data format of the input images;
+        dream_seed: seed of the noise images or of the random selection of 
+            the images of every class, None for the default;
+        num_shards: number of shards of the work units;
+        session_threads: number of threads of the session, None for all the cores.
     """
     # define load_dir and summary_dir
     load_dir = os.path.join(summary_dir, 'train')
@@ -792,33 +1955,90 @@ def explore_direction_aspect(num_gpus, data_dir, dataset, image_size,
         # call run direction aspect
         run_direction_aspect(num_gpus, total_batch_size, max_epochs, data_dir, dataset, image_size,
                              iter_n, step, threshold,
-                             load_dir, summary_dir, aspect_type)
+                             load_dir, summary_dir, aspect_type,
+                             in_graph_ascent, model_type, hparams, dream_seed,
+                             num_shards, session_threads)
+
+def run_sharded_exploration(explore_fn, args, num_shards, num_workers):
+    """Start {num_workers} worker processes which claim and explore the shards
+    of one run, the last worker to finish merges the results of all shards. 
+    Other machines sharing the summary directory may join the same run by 
+    starting their own workers with the same arguments.
+
+    Args:
+        explore_fn: explore_norm_aspect or explore_direction_aspect;
+        args: the positional arguments of {explore_fn} until dream_seed;
+        num_shards: number of shards of the work units;
+        num_workers: number of local worker processes.
+    """
+    if num_workers == 1:
+        # the shards are explored one after another in this process
+        explore_fn(*(tuple(args) + (num_shards, None)))
+        return
+
+    ctx, session_threads = _spawn_context(num_workers)
+    workers = [ctx.Process(target=explore_fn, 
+                           args=tuple(args) + (num_shards, session_threads))
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    
+    failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError('{} of {} workers failed, rerun to resume the unfinished shards!'.format(
+            len(failed), num_workers))
 
 def main(_):
     hparams = default_hparams()
     if FLAGS.hparams_override:
         hparams.parse(FLAGS.hparams_override)
     
-    if FLAGS.mode == 'train':
+    if FLAGS.mode == 'train' and (FLAGS.num_workers > 1 or FLAGS.rank is not None):
+        args = (hparams, FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.model, FLAGS.total_batch_size, FLAGS.image_size,
+                FLAGS.summary_dir, FLAGS.save_epochs, FLAGS.max_epochs, FLAGS.streaming_input,
+                FLAGS.device_strategy)
+        run_collective_training(args, FLAGS.num_workers, FLAGS.collective_address, FLAGS.rank)
+    elif FLAGS.mode == 'train':
         train(hparams, FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.model, FLAGS.total_batch_size, FLAGS.image_size, 
-                       FLAGS.summary_dir, FLAGS.save_epochs, FLAGS.max_epochs)
+                       FLAGS.summary_dir, FLAGS.save_epochs, FLAGS.max_epochs, FLAGS.streaming_input,
+                       FLAGS.device_strategy)
     if FLAGS.mode == 'test':
-        test(FLAGS.split, FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.total_batch_size, FLAGS.image_size, FLAGS.summary_dir, FLAGS.max_epochs)
+        test(FLAGS.split, FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.total_batch_size, FLAGS.image_size, FLAGS.summary_dir, FLAGS.max_epochs,
+             FLAGS.streaming_input, hparams.data_format)
+    elif FLAGS.mode == 'evaluate' and FLAGS.watch:
+        watch_evaluate(FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.model, FLAGS.total_batch_size, FLAGS.image_size,
+                       FLAGS.threshold, FLAGS.summary_dir, FLAGS.max_epochs, FLAGS.streaming_input,
+                       FLAGS.watch_interval, FLAGS.watch_timeout, hparams.data_format)
     elif FLAGS.mode == 'evaluate':
         evaluate(FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.model, FLAGS.total_batch_size, FLAGS.image_size,
-                 FLAGS.threshold, FLAGS.summary_dir, FLAGS.max_epochs)
+                 FLAGS.threshold, FLAGS.summary_dir, FLAGS.max_epochs, FLAGS.streaming_input,
+                 FLAGS.num_workers, hparams.data_format)
+    elif FLAGS.mode == 'ensemble':
+        ensemble_evaluate(hparams, FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.model, FLAGS.total_batch_size, 
+                          FLAGS.image_size, FLAGS.ensemble_thresholds, FLAGS.summary_dir, FLAGS.max_epochs, 
+                          FLAGS.streaming_input, FLAGS.device_strategy)
+    elif FLAGS.mode == 'export':
+        export_inference_graph(hparams, FLAGS.model, FLAGS.dataset, FLAGS.image_size,
+                               FLAGS.summary_dir, FLAGS.export_remake)
     elif FLAGS.mode == 'glitch':
         pass
-    elif FLAGS.mode in NORM_ASPECT_TYPES or FLAGS.mode in ['noise_' + aspect for aspect in NORM_ASPECT_TYPES]:
-        explore_norm_aspect(FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.image_size,
-                            FLAGS.total_batch_size, FLAGS.summary_dir, FLAGS.max_epochs,
-                            FLAGS.iter_n, float(FLAGS.step), float(FLAGS.threshold),
-                            FLAGS.mode)
-    elif FLAGS.mode in DIRECTION_ASPECT_TYPES or FLAGS.mode in ['noise_' + aspect for aspect in DIRECTION_ASPECT_TYPES]:
-        explore_direction_aspect(FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.image_size,
-                                 FLAGS.total_batch_size, FLAGS.summary_dir, FLAGS.max_epochs,
-                                 FLAGS.iter_n, float(FLAGS.step), float(FLAGS.threshold),
-                                 FLAGS.mode)
+    elif FLAGS.mode in NORM_ASPECT_TYPES or FLAGS.mode in ['noise_' + aspect for aspect in NORM_ASPECT_TYPES] \
+        or FLAGS.mode in DIRECTION_ASPECT_TYPES or FLAGS.mode in ['noise_' + aspect for aspect in DIRECTION_ASPECT_TYPES]:
+        if FLAGS.mode.replace('noise_', '') in NORM_ASPECT_TYPES:
+            explore_fn = explore_norm_aspect
+        else:
+            explore_fn = explore_direction_aspect
+        args = (FLAGS.num_gpus, FLAGS.data_dir, FLAGS.dataset, FLAGS.image_size,
+                FLAGS.total_batch_size, FLAGS.summary_dir, FLAGS.max_epochs,
+                FLAGS.iter_n, float(FLAGS.step), float(FLAGS.threshold),
+                FLAGS.mode, FLAGS.in_graph_ascent, FLAGS.model, hparams,
+                FLAGS.dream_seed)
+        if FLAGS.num_shards > 1:
+            run_sharded_exploration(explore_fn, args, FLAGS.num_shards, FLAGS.num_workers)
+        else:
+            explore_fn(*args)
     else:
         raise ValueError("No matching mode found for '{}'".format(FLAGS.mode))
 
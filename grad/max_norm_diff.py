@@ -19,7 +19,23 @@ from __future__ import division
 from __future__ import print_function
 
 import tensorflow as tf
-from pprint import pprint
+
+from grad import utils
+
+def compute_objectives(visual_tensors):
+    """Compute the objectives of every capsule, which are the differences 
+    between the capsule norm and the rest.
+
+    Args:
+        visual_tensors: visualization related tensors of one tower.
+    Returns:
+        objectives: the objective of every capsule, (?, num_cap_types) (?, 10).
+    """
+    caps_norms_tensor = visual_tensors[-1] # (?, num_cap_types) (?, 10)
+    num_caps = caps_norms_tensor.get_shape()[1].value
+    caps_norms_sum = tf.reduce_sum(caps_norms_tensor, axis=1, keepdims=True) # (?, 1)
+    caps_norms_diff = (num_caps * caps_norms_tensor - caps_norms_sum) / (num_caps - 1) # (?, 10)
+    return caps_norms_diff
 
 def compute_grads(tower_idx):
     """Compute the gradients of difference between target norm and the rest w.r.t. the input tensor.
@@ -30,6 +46,7 @@ def compute_grads(tower_idx):
     Returns:
         grads: the gradients of the capsule norms difference w.r.t. the input.
         batched_images: placeholder for batched image tensor.
+        batched_targets: placeholder for the target objective index of each row.
         caps_norms_tensor: predicted normalized logits of the model.
     """
     print('{0} Maximizing Difference between Target Capsule Norm and the Rest{0}'.format('*'*15))
@@ -55,36 +72,12 @@ def compute_grads(tower_idx):
     print(caps_norms_name_prefix)
     print(caps_norms_tensor.get_shape())
 
-    """Split the norms into individual norm"""
-    caps_norm_list = tf.split(
-        caps_norms_tensor, num_or_size_splits=caps_norms_tensor.get_shape()[1],
-        axis=1, name=caps_norms_name_prefix + '/split_op')
-    
-    """Calculate the difference between target tensor and the sum of the rest"""
-    caps_norms_sum = tf.reduce_sum(caps_norm_list, axis=1) # (?, 1)
-    caps_norm_diff_list = [(10 * caps_norm - caps_norms_sum) / 9 
-                           for caps_norm in caps_norm_list]
-    pprint(caps_norm_diff_list)
-
     """Compute the gradients"""
-    res_grads = []
-    for i, caps_norm_diff in enumerate(caps_norm_diff_list):
-        # process name TODO: need to debug
-        caps_norm_diff_name = '_'.join(caps_norm_list[i].name.split(':')) + '_diff'
-        # define objective function
-        obj_func = caps_norm_diff
-        # compute gradients
-        caps_norm_diff_grads = tf.gradients(obj_func, batched_images, name='gradients/' + caps_norm_diff_name)
-        # append to resultant list
-        res_grads.append(caps_norm_diff_grads)
-        # print process info
-        print('Done processing {0} ---- {1}/{2}      '.format(
-            caps_norm_diff_name, i+1, len(caps_norm_diff_list)))
-    print('')
-
-    """Flatten the list"""
-    res_grads = [item for sub in res_grads for item in sub]
+    # every row of the batch picks its own target capsule norm difference 
+    # and the gradients of all rows come from one backward pass
+    res_grads, batched_targets = utils.compute_target_grads(
+        compute_objectives(visual_tensors), batched_images, name=caps_norms_name_prefix + '/caps_norm_diff')
     print('Gradients computing completed!')
     
-    return res_grads, batched_images, caps_norms_tensor
+    return res_grads, batched_images, batched_targets, caps_norms_tensor
 
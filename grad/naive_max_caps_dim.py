@@ -20,6 +20,23 @@ from __future__ import print_function
 
 import tensorflow as tf
 
+from grad import utils
+
+def compute_objectives(visual_tensors):
+    """Compute the objectives of every (capsule, dimension) pair, which are
+    the flattened poses of the last capsule layer.
+
+    Args:
+        visual_tensors: visualization related tensors of one tower.
+    Returns:
+        objectives: the objective of every (capsule, dimension) pair, indexed 
+            by capsule * num_atoms + dimension, (?, 160).
+    """
+    caps_out_tensor = visual_tensors[-2] # (?, num_cap_types, num_atoms) (?, 10, 16)
+    _, num_caps, num_atoms = caps_out_tensor.get_shape()
+    caps_dims = tf.reshape(caps_out_tensor, [-1, num_caps.value * num_atoms.value]) # (?, 160)
+    return caps_dims
+
 def compute_grads(tower_idx):
     """Compute the gradients of every dimension of the most activated 
     capsule of the last capsule layer w.r.t. the input tensor.
@@ -31,6 +48,7 @@ def compute_grads(tower_idx):
         grads: the gradients of every dimension of the most activated capsule
             w.r.t. the input.
         batched_images: placeholder for batched image tensor
+        batched_targets: placeholder for the target objective index of each row.
         caps_norms_tensor: predicted normalized logits of the model.
     """
     print('{0} Naively Maximizing Dimensions of the Most Activated Capsule {0}'.format('*'*15))
@@ -57,41 +75,12 @@ def compute_grads(tower_idx):
     print(caps_out_name_prefix)
     print(caps_out_tensor.get_shape()) # (?, num_cap_types, num_atoms) (?, 10, 16)
 
-    """Split the tensor according to which capsule it is"""
-    caps_split_D1_list = tf.split(
-        caps_out_tensor, num_or_size_splits=caps_out_tensor.get_shape()[1],
-        axis=1, name=caps_out_name_prefix + '/class_split')
-    
-    """Split the tensor according to which dimension it is"""
-    caps_split_D2_list = []
-    for splited_by_D1_t in caps_split_D1_list:
-        temp = tf.split(
-            splited_by_D1_t, num_or_size_splits=splited_by_D1_t.get_shape()[2],
-            axis=2, name='-'.join(splited_by_D1_t.name.split(':')[:-1]) + '/dim_split')
-        caps_split_D2_list.append(temp)
-    # flatten caps_split_D2_list 
-    caps_split_D2_list = [item for sub in caps_split_D2_list for item in sub]
-    # squeeze out dimension 2
-    caps_split_D2_list = [tf.squeeze(t, axis=2) for t in caps_split_D2_list]
-
     """Compute gradients"""
-    res_grads = []
-    for i, caps_single_dim_t in enumerate(caps_split_D2_list):
-        # process name 
-        caps_single_dim_t_name = '_'.join(caps_single_dim_t.name.split(':'))
-        # define objective function
-        obj_func = caps_single_dim_t
-        # compute gradients
-        caps_single_dim_grads = tf.gradients(obj_func, batched_images, name='gradients/' + caps_single_dim_t_name)
-        # append to resultant list
-        res_grads.append(caps_single_dim_grads)
-        # print process information
-        print('Done processing {0} ---- {1}/{2}       '.format(
-            caps_single_dim_t_name, i+1, len(caps_split_D2_list)))
-    print('')
-
-    """Flatten the list"""
-    res_grads = [item for sub in res_grads for item in sub]
+    # every row of the batch picks its own (capsule, dimension) target,
+    # indexed by capsule * num_atoms + dimension, so the gradients are the 
+    # needed rows of the output pose Jacobian from one backward pass
+    res_grads, batched_targets = utils.compute_target_grads(
+        compute_objectives(visual_tensors), batched_images, name=caps_out_name_prefix + '/caps_dim')
     print('Gradients computing completed!')
 
-    return res_grads, batched_images, caps_norms_tensor
+    return res_grads, batched_images, batched_targets, caps_norms_tensor
@@ -20,6 +20,20 @@ from __future__ import print_function
 
 import tensorflow as tf
 
+from grad import utils
+
+def compute_objectives(visual_tensors):
+    """Compute the objectives of every capsule, which are the logit norms
+    of the last capsule layer.
+
+    Args:
+        visual_tensors: visualization related tensors of one tower.
+    Returns:
+        objectives: the objective of every capsule, (?, num_cap_types) (?, 10).
+    """
+    caps_norms_tensor = visual_tensors[-1] # (?, num_cap_types) (?, 10)
+    return caps_norms_tensor
+
 def compute_grads(tower_idx):
     """Compute the gradients of the logit norms of the last capsule layer
     w.r.t. the input tensor.
@@ -28,8 +42,9 @@ def compute_grads(tower_idx):
         tower_idx: given tower index, which should be 0 since we are using 
             the first tower in any case.
     Returns:
-        grads: the gradients of capsule norms w.r.t. the input.
+        grads: the gradients of the target capsule norm of each row w.r.t. the input.
         batched_images: placeholder for batched image tensor
+        batched_targets: placeholder for the target objective index of each row.
         caps_norms_tensor: predicted normalized logits of the model.
     """
     print('{0} Naively Maximizing Single Capsule Norm {0}'.format('*'*15))
@@ -56,30 +71,12 @@ def compute_grads(tower_idx):
     print(caps_norms_name_prefix)
     print(caps_norms_tensor.get_shape())
 
-    """Split the norms into individual norm"""
-    caps_norm_list = tf.split(
-        caps_norms_tensor, num_or_size_splits=caps_norms_tensor.get_shape()[1],
-        axis=1, name=caps_norms_name_prefix + '/split_op')
-    
     """Compute norm gradients"""
-    res_grads = []
-    for i, caps_norm_t in enumerate(caps_norm_list):
-        # process name
-        caps_norm_t_name = '_'.join(caps_norm_t.name.split(':'))
-        # define objective function
-        obj_func = caps_norm_t
-        # compute gradients
-        caps_norm_grads = tf.gradients(obj_func, batched_images, name='gradients/' + caps_norm_t_name)
-        # append to resultant list
-        res_grads.append(caps_norm_grads)
-        # print process information
-        print('Done processing {0} ---- {1}/{2}         '.format(
-            caps_norm_t_name, i+1, len(caps_norm_list)))
-    print('')
-
-    """Flatten the list"""
-    res_grads = [item for sub in res_grads for item in sub]
+    # every capsule norm is an objective, every row of the batch picks its 
+    # own target capsule and the gradients of all rows come from one backward pass
+    res_grads, batched_targets = utils.compute_target_grads(
+        compute_objectives(visual_tensors), batched_images, name=caps_norms_name_prefix + '/caps_norm')
     print('Gradients computing completed!')
     
-    return res_grads, batched_images, caps_norms_tensor
+    return res_grads, batched_images, batched_targets, caps_norms_tensor
 
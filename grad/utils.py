@@ -19,52 +19,206 @@ from __future__ import print_function
 import tensorflow as tf
 import numpy as np 
 
-def run_gradient_ascent(t_grad, img0, in_ph, sess,
-                        iter_n, step, threshold=0.0):
-    """Run gradient ascent to the given image and only record those results at 
-    iter_ns_to_record = [1, 2, 3, 4, 5, 
-                         10, 20, 40, 60, 80, 100]
+ITER_NS_TO_RECORD = [1, 2, 3, 4, 5, 
+                     10, 20, 40, 60, 80, 100]
+
+def compute_target_grads(objectives, batched_images, name='target_grads'):
+    """Compute the gradients of a batch of objectives w.r.t. the input tensor,
+    where every row of the batch is driven by its own objective.
+
+    Each row selects the column of {objectives} given by the target 
+    placeholder, so the gradients of all the rows come from one backward pass.
+
+    Args:
+        objectives: tensor of every objective of every row, (?, num_objectives).
+        batched_images: placeholder for batched image tensor.
+        name: name of the gradient ops.
+    Returns:
+        grads: the gradients of the selected objectives w.r.t. the input,
+            row i holds the gradient of objective batched_targets[i].
+        batched_targets: placeholder of target objective indices, (?,).
+    """
+    batched_targets = tf.placeholder(tf.int32, shape=[None], name='batched_targets')
+    num_objectives = objectives.get_shape()[1].value
+    target_mask = tf.one_hot(batched_targets, num_objectives) # (?, num_objectives)
+    obj_func = tf.reduce_sum(objectives * target_mask)
+    grads = tf.gradients(obj_func, batched_images, name='gradients/' + name)[0]
+    return grads, batched_targets
+
+def compute_entropy(preds):
+    """Compute the entropy of every row of the given predictions at once.
 
     Args:
-        t_grad: the gradients of target objective function w.r.t. the batched
-            input placeholder images, but actually there is only 1 image per
-            batch with the shape of (1, 1, 24, 24) or (1, 3, 24, 24) (NCHW)
-        img0: the original batched input images, (1, 1, 24, 24) or (1, 3, 24, 24) (NCHW)
+        preds: numpy array of predicted capsule norms (or logits), (..., num_classes).
+    Returns:
+        entropy: numpy array of the entropy of every row, (...,).
+    """
+    preds_sum = np.sum(preds, axis=-1, keepdims=True)
+    preds_exp = np.exp(preds)
+    entropy = - np.sum(preds_exp / preds_sum * preds, axis=-1)
+    return entropy
+
+def run_gradient_ascent(t_grad, t_pred, img0, in_ph, sess,
+                        iter_n, step, threshold=0.0, feed_dict=None):
+    """Run gradient ascent to the given batch of images and only record those 
+    results at iter_ns_to_record = [1, 2, 3, 4, 5, 
+                                    10, 20, 40, 60, 80, 100]
+
+    Every row of the batch is ascended along its own objective, so all the 
+    objectives of one image advance together with one session call per 
+    iteration. The capsule norms come with the same forward pass of the 
+    gradients, so the predictions of the recorded images cost nothing but 
+    the last one.
+
+    Args:
+        t_grad: the gradients of the target objectives w.r.t. the batched
+            input placeholder images, row i is the gradient of the objective 
+            of row i, shape (n, 1, 24, 24) or (n, 3, 24, 24) (NCHW),
+            or (n, 24, 24, 1) or (n, 24, 24, 3) if the model is NHWC.
+        t_pred: the capsule norms (or logits) of the batched input placeholder 
+            images, (n, 10).
+        img0: the original batched input images, (n, 1, 24, 24) or (n, 3, 24, 24) (NCHW),
+            or the same in NHWC, the layout of the model.
         in_ph: input batched image placeholder, used as the key of feed dict.
         sess: the running session.
         iter_n: number of iterations to add gradients to the img0.
         step: step size multiplier of each iteration.
         threshold: gradient lower bound threshold, any calculated gradients under this
             value will be ignored.
+        feed_dict: extra feed dict to run t_grad, e.g. the target objective of 
+            each row.
     Returns:
         iter_n_recorded: iterations number recorded
-        ga_img_list: a list of images, where images are 4D tensors with the 
-        shape of (1, 1, 24, 24) or (1, 3, 24, 24),
+        ga_imgs: recorded images, (len(iter_n_recorded), n, 1, 24, 24) 
+            or (len(iter_n_recorded), n, 3, 24, 24).
+        ga_preds: capsule norms of the recorded images, (len(iter_n_recorded), n, 10).
+        ga_entropies: prediction entropies of the recorded images, (len(iter_n_recorded), n).
     """
     assert iter_n >= 10
-    iter_ns_to_record = [1, 2, 3, 4, 5, 
-                         10, 20, 40, 60, 80, 100]
+    iter_ns_to_record = ITER_NS_TO_RECORD
 
-    img = img0.copy() # (1, 1, 24, 24) or (1, 3, 24, 24)
+    feed_dict = dict(feed_dict or {})
 
-    ga_img_list = [img0.copy()]
-    iter_n_recorded = [0]
+    img = img0.copy() # (n, 1, 24, 24) or (n, 3, 24, 24)
 
-    for i in range(1, iter_n + 1):
-        # caculate the gradient values
-        g = sess.run(t_grad, feed_dict={in_ph: img})
+    ga_img_list = []
+    ga_pred_list = []
+    iter_n_recorded = []
 
-        # fgsm
-        # g = np.sign(g)
-        
-        # add gradients
-        img += g * step # (1, 1, 24, 24) or (1, 3, 24, 24)
-        # clip out invalid values
-        img = np.clip(img, 0., 1.)
+    # the predictions of the image of iteration i come with the gradients 
+    # of iteration i + 1, so the last iteration only runs the forward pass
+    for i in range(iter_n + 1):
+        record = i == 0 or i in iter_ns_to_record
+        feed_dict[in_ph] = img
+        if i == iter_n:
+            if record:
+                ga_img_list.append(img)
+                ga_pred_list.append(sess.run(t_pred, feed_dict=feed_dict))
+                iter_n_recorded.append(i)
+            break
+
+        # caculate the gradient values and the predictions of every row
+        g, pred = sess.run([t_grad, t_pred], feed_dict=feed_dict)
 
         # record results
-        if i in iter_ns_to_record:
+        if record:
             ga_img_list.append(img)
+            ga_pred_list.append(pred)
             iter_n_recorded.append(i)
+
+        # fgsm
+        # g = np.sign(g)
+        
+        # add gradients and clip out invalid values
+        img = np.clip(img + g * step, 0., 1.) # (n, 1, 24, 24) or (n, 3, 24, 24)
     
-    return iter_n_recorded, ga_img_list # a list of (idex, image), where images have the shape of (1, 1, 24, 24) or (1, 3, 24, 24)
+    ga_imgs = np.stack(ga_img_list)
+    ga_preds = np.stack(ga_pred_list)
+    ga_entropies = compute_entropy(ga_preds)
+    return iter_n_recorded, ga_imgs, ga_preds, ga_entropies
+
+def build_gradient_ascent(forward_fn, objective_fn, img0, iter_n, step, threshold=0.0):
+    """Build the whole gradient ascent inside the graph with a tf.while_loop and
+    only record those results at iter_ns_to_record = [1, 2, 3, 4, 5,
+                                                      10, 20, 40, 60, 80, 100]
+
+    Every iteration rebuilds the forward pass on the current images, steps
+    along the gradients of the objective of every row and clips out invalid
+    values. The recorded images and the capsule norms of those images are
+    written into TensorArrays, so one session call returns the whole ascent 
+    together with the predictions and their entropies.
+
+    Args:
+        forward_fn: function that builds the inference graph on top of the 
+            given images and returns the visualization related tensors, where
+            the last one is the capsule norms (or logits).
+        objective_fn: function that takes the visualization related tensors 
+            and returns the objectives of every row, (?, num_objectives).
+        img0: the original batched input images tensor, (n, 1, 24, 24) or (n, 3, 24, 24) (NCHW),
+            or the same in NHWC, the layout of the model.
+        iter_n: number of iterations to add gradients to the img0.
+        step: step size multiplier of each iteration.
+        threshold: gradient lower bound threshold, same as run_gradient_ascent.
+    Returns:
+        batched_targets: placeholder of target objective indices, (n,).
+        iter_n_recorded: iterations number recorded.
+        ga_imgs: tensor of recorded images, (len(iter_n_recorded), n, 1, 24, 24) 
+            or (len(iter_n_recorded), n, 3, 24, 24).
+        ga_preds: tensor of capsule norms of the recorded images, 
+            (len(iter_n_recorded), n, 10).
+        ga_entropies: tensor of prediction entropies of the recorded images,
+            (len(iter_n_recorded), n).
+    """
+    assert iter_n >= 10
+    iter_n_recorded = [0] + [i for i in ITER_NS_TO_RECORD if i <= iter_n]
+    # slot of every iteration in the TensorArrays, -1 if it is not recorded
+    record_slots = np.full(iter_n + 1, -1, dtype=np.int32)
+    record_slots[iter_n_recorded] = np.arange(len(iter_n_recorded))
+    record_slots = tf.constant(record_slots, name='record_slots')
+
+    batched_targets = tf.placeholder(tf.int32, shape=[None], name='batched_targets')
+
+    def _body(i, img, ga_imgs, ga_preds):
+        """Gradient ascent while loop."""
+        visual_tensors = forward_fn(img)
+        caps_norms = visual_tensors[-1]
+        objectives = objective_fn(visual_tensors)
+        target_mask = tf.one_hot(batched_targets, objectives.get_shape()[1].value)
+        obj_func = tf.reduce_sum(objectives * target_mask)
+        g = tf.gradients(obj_func, img)[0]
+
+        # record results, the capsule norms of the image come with the 
+        # forward pass of the same iteration
+        slot = record_slots[i]
+        ga_imgs, ga_preds = tf.cond(
+            slot >= 0,
+            lambda: (ga_imgs.write(slot, img), ga_preds.write(slot, caps_norms)),
+            lambda: (ga_imgs, ga_preds))
+
+        # add gradients and clip out invalid values
+        img = tf.clip_by_value(img + g * step, 0., 1.)
+        return (i + 1, img, ga_imgs, ga_preds)
+
+    ga_imgs = tf.TensorArray(dtype=tf.float32, size=len(iter_n_recorded))
+    ga_preds = tf.TensorArray(dtype=tf.float32, size=len(iter_n_recorded))
+    i = tf.constant(0, dtype=tf.int32)
+
+    # same number of gradient steps as the host side ascent
+    _, img, ga_imgs, ga_preds = tf.while_loop(
+        lambda i, img, ga_imgs, ga_preds: i < iter_n,
+        _body,
+        loop_vars=[i, img0, ga_imgs, ga_preds],
+        swap_memory=True)
+    if iter_n in iter_n_recorded:
+        # the last iteration only needs its forward pass, not its gradients
+        caps_norms = forward_fn(img)[-1]
+        ga_imgs = ga_imgs.write(len(iter_n_recorded) - 1, img)
+        ga_preds = ga_preds.write(len(iter_n_recorded) - 1, caps_norms)
+
+    ga_imgs = ga_imgs.stack()
+    ga_preds = ga_preds.stack()
+    # same as compute_entropy
+    ga_preds_sum = tf.reduce_sum(ga_preds, axis=-1, keepdims=True)
+    ga_entropies = - tf.reduce_sum(tf.exp(ga_preds) / ga_preds_sum * ga_preds, axis=-1)
+
+    return batched_targets, iter_n_recorded, ga_imgs, ga_preds, ga_entropies
@@ -15,6 +15,7 @@
 import tensorflow as tf 
 import numpy as np 
 import os 
+from input_data import utils
 from input_data.cifar10 import load_cifar10_data
 
 def _dream_cropping(image, label, specs, cropped_size):
@@ -25,8 +26,9 @@ def _dream_cropping(image, label, specs, cropped_size):
     
     # convert from 0 ~ 255 to 0. ~ 1.
     image = tf.cast(image, tf.float32) * (1. / 255.)
-    # transpose image into (CHW)
-    image = tf.transpose(image, [2, 0, 1]) # (CHW)
+    if specs['data_format'] == 'NCHW':
+        # transpose image into (CHW)
+        image = tf.transpose(image, [2, 0, 1]) # (CHW)
 
     feature = {
         'image': image,
@@ -43,11 +45,12 @@ def _dream_process(feature):
     return batched_features
 
 def _dream_sample_pairs(split, data_dir, max_epochs, n_repeats,
-                        total_batch_size=1):
+                        seed=None, total_batch_size=1):
     """
     We do the following steps to produce the dataset:
         1. sample one (image, label) pair in one class;
-        2. repeat pair in 1. {n_repeats} times;
+        2. repeat pair in 1. {n_repeats} times, which is done lazily 
+           by inputs() so only the unique pairs are kept in memory;
         3. go back to do 1. unless we finish one iteration 
            (after a {num_classes} time loop). And we consider
            this as one epoch.
@@ -60,9 +63,11 @@ def _dream_sample_pairs(split, data_dir, max_epochs, n_repeats,
         data_dir: path to the mnist data directory;
         max_epochs: maximum epochs to go through the model;
         n_repeats: number of computed gradients;
+        seed: seed of the random selection of every class, None to take
+            the first {max_epochs} examples of every class;
         batch_size: total number of images per batch.
     Returns:
-        processed images, labels and specs
+        unique sampled images, labels and specs
     """
 
     """Dataset specs"""
@@ -76,47 +81,32 @@ def _dream_sample_pairs(split, data_dir, max_epochs, n_repeats,
         'num_classes': 10
     }
 
-    """Load data from mat files"""
+    """Load data from the memory mapped cache"""
     images, labels = load_cifar10_data.load_cifar10(data_dir, split)
     assert images.shape[0] == labels.shape[0]
     specs['total_size'] = int(images.shape[0])
 
-    """Process np array"""
-    # sort by labels to get the index permutations
-    # classes: 0, 1, 2, 3, 4, 5, 6, 7, 8, 9
-    indices = [specs['total_size'] // specs['num_classes'] * i
-               for i in range(specs['num_classes'])]
-    indices.append(specs['total_size'])
-    perm = labels.argsort()
-    images = images[perm]
-    labels = labels[perm]
-
-    sampled_idc_lists = []
-    for start in indices[:-1]:
-        sampled_idc_lists.append(
-            np.arange(start, start + max_epochs).tolist())
-    sampled_idc_mat = np.array(sampled_idc_lists)
-    sampled_idc_mat = np.transpose(sampled_idc_mat, [1, 0])
-    sampled_idc_lists = sampled_idc_mat.flatten().tolist()
+    """Sample pairs from the class index"""
+    # the index of every class is built once and memory mapped later on
+    class_index, class_offsets = utils.load_class_index(
+        data_dir, split, lambda: labels, specs['num_classes'])
+    sampled_idc_lists = utils.sample_class_pairs(
+        class_index, class_offsets, max_epochs, seed)
     assert len(sampled_idc_lists) == max_epochs * specs['num_classes']
+    # only keep the unique sampled pairs, the {n_repeats} repeats of every 
+    # pair are expanded lazily in the dataset pipeline after preprocessing;
     # we let n_repeats = steps_per_epoch = number of computed gradients
-    list_of_images = []
-    list_of_labels = []
-    for idx in sampled_idc_lists:
-        for _ in range(n_repeats):
-            list_of_images.append(images[idx])
-            list_of_labels.append(labels[idx])
-    res_images = np.stack(list_of_images, axis=0)
-    res_labels = np.array(list_of_labels)
-    assert res_images.shape == (max_epochs*specs['num_classes']*n_repeats, specs['image_size'], specs['image_size'], specs['depth'])
-    assert res_labels.shape == (max_epochs*specs['num_classes']*n_repeats,)
-
-    specs['total_size'] = res_labels.shape[0]
+    res_images = images[sampled_idc_lists]
+    res_labels = labels[sampled_idc_lists]
+    assert res_images.shape == (max_epochs*specs['num_classes'], specs['image_size'], specs['image_size'], specs['depth'])
+    assert res_labels.shape == (max_epochs*specs['num_classes'],)
+
+    specs['total_size'] = res_labels.shape[0] * n_repeats
     return (res_images, res_labels), specs
 
 
 def inputs(split, data_dir, max_epochs, n_repeats, cropped_size,
-           total_batch_size=1):
+           seed=None, total_batch_size=1, data_format='NCHW'):
     """Construct fashion mnist inputs for dream experiment.
 
     Args:
@@ -125,7 +115,10 @@ def inputs(split, data_dir, max_epochs, n_repeats, cropped_size,
         max_epochs: maximum epochs to go through the model;
         n_repeats: number of computed gradients / number of the same input to repeat;
         cropped_size: image size after cropping;
-        total_batch_size: total number of images per batch.
+        seed: seed of the random selection of every class, None to take
+            the first {max_epochs} examples of every class;
+        total_batch_size: total number of images per batch;
+        data_format: 'NCHW' or 'NHWC', layout of the images.
     Returns:    
         batched_features: a dictionary of the input data features.
     """
@@ -133,7 +126,8 @@ def inputs(split, data_dir, max_epochs, n_repeats, cropped_size,
     
     """Load sampled images and labels"""
     (images, labels), specs = _dream_sample_pairs(
-        split, data_dir, max_epochs, n_repeats, total_batch_size)
+        split, data_dir, max_epochs, n_repeats, seed, total_batch_size)
+    specs['data_format'] = data_format
     
     if cropped_size == None:
         cropped_size = specs['image_size']
@@ -145,6 +139,10 @@ def inputs(split, data_dir, max_epochs, n_repeats, cropped_size,
     dataset = dataset.map(
         lambda image, label: _dream_cropping(image, label, specs, cropped_size),
         num_parallel_calls=3)
+    # every unique image is only preprocessed once, then repeated 
+    # {n_repeats} times without materializing the copies
+    dataset = dataset.flat_map(
+        lambda feature: tf.data.Dataset.from_tensors(feature).repeat(n_repeats))
     specs['image_size'] = cropped_size
     batched_dataset = dataset.batch(specs['batch_size'])
     batched_dataset = batched_dataset.map(_dream_process, num_parallel_calls=3)
@@ -20,6 +20,7 @@ from __future__ import print_function
 import os 
 import tensorflow as tf 
 
+from input_data import utils
 from input_data.cifar10 import load_cifar10_data
 
 def _single_process(image, label, specs, cropped_size):
@@ -47,8 +48,9 @@ def _single_process(image, label, specs, cropped_size):
                 image = tf.image.resize_image_with_crop_or_pad(image, cropped_size, cropped_size)
     # convert from 0 ~ 255 to 0. ~ 1.
     image = tf.cast(image, tf.float32) * (1. / 255.)
-    # transpose image into (CHW)
-    image = tf.transpose(image, [2, 0, 1])
+    if specs['data_format'] == 'NCHW':
+        # transpose image into (CHW)
+        image = tf.transpose(image, [2, 0, 1])
 
     feature = {
         'image': image,
@@ -71,7 +73,8 @@ def _feature_process(feature):
     return batched_feature
 
 def inputs(total_batch_size, num_gpus, max_epochs, cropped_size,
-           data_dir, split, distort=True):
+           data_dir, split, distort=True, streaming=False, data_format='NCHW',
+           num_shards=1, shard_index=0):
     """Construct inputs for cifar10 dataset.
 
     Args:
@@ -81,7 +84,13 @@ def inputs(total_batch_size, num_gpus, max_epochs, cropped_size,
         cropped_size: image size after cropping;
         data_dir: path to the fashion-mnist data directory;
         split: 'train' or 'test', which split of dataset to read from;
-        distort: whether to distort the iamges, including scale down the image and rotations.
+        distort: whether to distort the iamges, including scale down the image and rotations;
+        streaming: whether to stream the examples from the memory mapped cache
+            instead of embedding the whole split in the graph;
+        data_format: 'NCHW' or 'NHWC', layout of the images;
+        num_shards: number of disjoint shards of the examples, e.g. one
+            per training process;
+        shard_index: index of the shard to read.
     Returns:
         batched_dataset: Dataset object, each instance is a feature dictionary;
         specs: dataset specifications.
@@ -102,46 +111,64 @@ def inputs(total_batch_size, num_gpus, max_epochs, cropped_size,
         'image_size': 32,
         'depth': 3,
         'num_classes': 10,
-        'distort': distort
+        'distort': distort,
+        'data_format': data_format
     }
     
     if cropped_size == None:
         cropped_size = specs['image_size']
     assert cropped_size <= specs['image_size']
 
-    """Load data from mat file"""
+    """Load data from the memory mapped cache"""
     images, labels = load_cifar10_data.load_cifar10(data_dir, split)
     # images: 0 ~ 255 uint8 (?, 32, 32, 3)
     # labels: 0 ~ 9 uint8   (?, 1)
     assert images.shape[0] == labels.shape[0]
-    specs['total_size'] = int(images.shape[0])
+    # every shard holds at least this many examples, so that all the
+    # shards take the same number of steps per epoch
+    specs['total_size'] = int(images.shape[0]) // num_shards
     specs['steps_per_epoch'] = int(specs['total_size']) // specs['total_batch_size']
 
     """Process dataset object"""
-    # read from numpy array
-    dataset = tf.data.Dataset.from_tensor_slices((images, labels))
-    # prefetch examples
-    dataset = dataset.prefetch(
-        buffer_size=specs['batch_size']*specs['num_gpus']*2)
-    # shuffle (if 'train') and repeat 'max_epochs'
-    if split == 'train':
-        dataset = dataset.apply(tf.contrib.data.shuffle_and_repeat(
-            buffer_size=specs['batch_size']*specs['num_gpus']*10,
-            count=specs['max_epochs']))
-    else:
+    if streaming:
+        # read from the memory mapped cache, in a new random order 
+        # every epoch (if 'train'), and repeat 'max_epochs'
+        dataset = utils.streaming_dataset(
+            images, labels, shuffle=(split == 'train'),
+            num_shards=num_shards, shard_index=shard_index)
         dataset = dataset.repeat(specs['max_epochs'])
+        # prefetch examples
+        dataset = dataset.prefetch(
+            buffer_size=specs['batch_size']*specs['num_gpus']*2)
+    else:
+        # read from numpy array
+        dataset = tf.data.Dataset.from_tensor_slices((images, labels))
+        if num_shards > 1:
+            # only keep the examples of the shard
+            dataset = dataset.shard(num_shards, shard_index)
+        # prefetch examples
+        dataset = dataset.prefetch(
+            buffer_size=specs['batch_size']*specs['num_gpus']*2)
+        # shuffle (if 'train') and repeat 'max_epochs'
+        if split == 'train':
+            dataset = dataset.apply(tf.contrib.data.shuffle_and_repeat(
+                buffer_size=specs['batch_size']*specs['num_gpus']*10,
+                count=specs['max_epochs']))
+        else:
+            dataset = dataset.repeat(specs['max_epochs'])
     # process single example
     dataset = dataset.map(
         lambda image, label: _single_process(image, label, specs, cropped_size),
         num_parallel_calls=3)
     specs['image_size'] = cropped_size
-    # stack into batches
-    batched_dataset = dataset.batch(specs['batch_size'])
+    # stack into batches of all the towers, the towers split every batch
+    # among them inside the graph
+    batched_dataset = dataset.batch(specs['total_batch_size'])
     # process into feature
     batched_dataset = batched_dataset.map(
         _feature_process,
         num_parallel_calls=3)
-    # prefetch to improve the performance
-    batched_dataset = batched_dataset.prefetch(specs['num_gpus'])
+    # prefetch the next batch to improve the performance
+    batched_dataset = batched_dataset.prefetch(1)
 
     return batched_dataset, specs
@@ -14,7 +14,7 @@
 # ==============================================================================
 import os
 import numpy as np 
-from scipy.io import loadmat
+from input_data import utils
 
 def get_info(data_dir, split='train'):
     """Get cifar10 filenames.
@@ -37,8 +37,8 @@ def get_info(data_dir, split='train'):
 
     return filenames
 
-def load_cifar10(data_dir, split='train'):
-    """Get cifar10 data.
+def _load_cifar10_raw(data_dir, split='train'):
+    """Read cifar10 data from the mat files.
 
     Args:
         data_dir: data directory of where cifar10 was stored.
@@ -46,6 +46,7 @@ def load_cifar10(data_dir, split='train'):
     Returns:
         images, labels
     """
+    from scipy.io import loadmat
     filenames = get_info(data_dir, split)
     
     images_list = []
@@ -61,3 +62,17 @@ def load_cifar10(data_dir, split='train'):
     labels = np.concatenate(labels_list, axis=0)
 
     return images, labels
+
+def load_cifar10(data_dir, split='train'):
+    """Get cifar10 data, the mat files are only read once to build the
+    memory mapped cache.
+
+    Args:
+        data_dir: data directory of where cifar10 was stored.
+        split: 'train' or 'test' split.
+    Returns:
+        images: memory mapped images, uint8 0 ~ 255, (?, 32, 32, 3)
+        labels: memory mapped labels, uint8 0 ~ 9, (?,)
+    """
+    return utils.load_cached(
+        data_dir, split, lambda: _load_cifar10_raw(data_dir, split))
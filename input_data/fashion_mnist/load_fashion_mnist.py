@@ -15,9 +15,10 @@
 import os 
 import gzip
 import numpy as np
+from input_data import utils
 
-def load_fashion_mnist(path, split='train'):
-    """Load fashion-mnist dataset from byte files.
+def _load_fashion_mnist_raw(path, split='train'):
+    """Read fashion-mnist dataset from byte files.
 
     Args:
         path: given directory of where the dataset was stored
@@ -42,4 +43,20 @@ def load_fashion_mnist(path, split='train'):
         images = np.frombuffer(
             imgpath.read(), dtype=np.uint8, offset=16).reshape(len(labels), 28, 28)
 
-    return images, labels 
\ No newline at end of file
+    return images, labels
+
+def load_fashion_mnist(path, split='train'):
+    """Load fashion-mnist dataset, the byte files are only read once to 
+    build the memory mapped cache.
+
+    Args:
+        path: given directory of where the dataset was stored
+        split: 'train' or 'test'.
+    Return:
+        images: memory mapped image data, uint8 0 ~ 255, (60000 or 10000, 28, 28)
+        labels: memory mapped label data, uint8 0 ~ 9, (60000 or 10000,)
+    """
+    images, labels = utils.load_cached(
+        path, split, lambda: _load_fashion_mnist_raw(path, split))
+    # view without the channel dimension of the cache
+    return images[..., 0], labels
@@ -0,0 +1,47 @@
+# Copyright 2018 Xu Chen All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import os
+import numpy as np 
+from input_data import utils
+
+def _load_mnist_raw(data_dir, split='train'):
+    """Read mnist dataset from the numpy array file.
+
+    Args:
+        data_dir: data directory of where mnist.npz was stored.
+        split: 'train' or 'test' split.
+    Returns:
+        images: numpy array storing image data, uint8 0 ~ 255, (60000 or 10000, 28, 28)
+        labels: numpy array storing label data, uint8 0 ~ 9, (60000 or 10000,)
+    """
+    with np.load(os.path.join(data_dir, 'mnist.npz')) as f:
+        images, labels = f['x_%s' % split], f['y_%s' % split]
+    return images, labels
+
+def load_mnist(data_dir, split='train'):
+    """Load mnist dataset, mnist.npz is only unpacked once to build the
+    memory mapped cache.
+
+    Args:
+        data_dir: data directory of where mnist.npz was stored.
+        split: 'train' or 'test' split.
+    Returns:
+        images: memory mapped image data, uint8 0 ~ 255, (60000 or 10000, 28, 28)
+        labels: memory mapped label data, uint8 0 ~ 9, (60000 or 10000,)
+    """
+    images, labels = utils.load_cached(
+        data_dir, split, lambda: _load_mnist_raw(data_dir, split))
+    # view without the channel dimension of the cache
+    return images[..., 0], labels
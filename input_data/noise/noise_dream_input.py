@@ -29,7 +29,7 @@ def _dream_process(image):
     return batched_features
 
 def inputs(split, depth, max_epochs, n_repeats, cropped_size,
-           seed=123, total_batch_size=1):
+           seed=123, total_batch_size=1, data_format='NCHW'):
     """Construct noise inputs for dream experiment.
 
     Args:
@@ -39,7 +39,8 @@ def inputs(split, depth, max_epochs, n_repeats, cropped_size,
         n_repeats: number of computed gradients / number of the same input to repeat;
         cropped_size: image size after cropping;
         seed: seed to produce pseudo randomness that we can replicate each time;
-        total_batch_size: total number of images per batch.
+        total_batch_size: total number of images per batch;
+        data_format: 'NCHW' or 'NHWC', layout of the images.
     Returns:    
         batched_features: a dictionary of the input data features.
     """
@@ -52,28 +53,31 @@ def inputs(split, depth, max_epochs, n_repeats, cropped_size,
         'batch_size': total_batch_size,
         'image_size': cropped_size,
         'depth': depth,
-        'num_classes': 10
+        'num_classes': 10,
+        'data_format': data_format
     }
 
     """Set random seed"""
     np.random.seed(seed)
 
     """Initialize noise images"""
-    noise_img_list = []
-    for _ in range(max_epochs):
-        one_noise_img = np.random.uniform(size=(
-            specs['batch_size'],
-            specs['depth'], specs['image_size'], specs['image_size']))*128 + 127.0
-        """Convert into 0. ~ 1. """
-        one_noise_img = one_noise_img * (1. / 255.)
-        for _ in range(10*n_repeats):
-            noise_img_list.append(one_noise_img)
-    """Transform into np array"""
-    noise_img_matr = np.concatenate(noise_img_list, axis=0)
+    # only the unique noise images of every epoch are kept, the 
+    # {n_repeats} repeats of every image are expanded lazily
+    noise_img_matr = np.random.uniform(size=(
+        max_epochs * specs['batch_size'],
+        specs['depth'], specs['image_size'], specs['image_size']))*128 + 127.0
+    """Convert into 0. ~ 1. """
+    noise_img_matr = noise_img_matr * (1. / 255.)
+    if data_format == 'NHWC':
+        # same noise images whatever the layout
+        noise_img_matr = np.transpose(noise_img_matr, [0, 2, 3, 1])
 
     """Process dataset object"""
     # extract single instance 
     dataset = tf.data.Dataset.from_tensor_slices((noise_img_matr))
+    # repeat every instance {n_repeats} times without materializing the copies
+    dataset = dataset.flat_map(
+        lambda image: tf.data.Dataset.from_tensors(image).repeat(n_repeats))
     # create batched image dataset
     batched_dataset = dataset.batch(specs['batch_size'])
     # convert into feature
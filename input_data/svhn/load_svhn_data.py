@@ -14,18 +14,19 @@
 # ==============================================================================
 import os
 import numpy as np 
-from scipy.io import loadmat
+from input_data import utils
 
-def load_svhn(path, split='train'):
-    """Load svhn dataset from mat files.
+def _load_svhn_raw(path, split='train'):
+    """Read svhn dataset from mat files.
 
     Args:
         path: given directory of where the dataset was stored
         split: 'train' (73257) or 'test' (26032)
     Returns: 
         images: numpy array storing image data, uint8 0 ~ 255, (?, 32, 32, 3)
-        labels: numpy array storing label data, uint8 0 ~ 9, (?, 1)
+        labels: numpy array storing label data, uint8 0 ~ 9, (?,)
     """
+    from scipy.io import loadmat
     data = os.path.join(
         path, '%s_32x32.mat' % split)
     
@@ -40,6 +41,16 @@ def load_svhn(path, split='train'):
     # labels: (?, )
     return images, labels
 
+def load_svhn(path, split='train'):
+    """Load svhn dataset, the mat files are only read once to build the 
+    memory mapped cache.
 
-
-    
+    Args:
+        path: given directory of where the dataset was stored
+        split: 'train' (73257) or 'test' (26032)
+    Returns: 
+        images: memory mapped image data, uint8 0 ~ 255, (?, 32, 32, 3)
+        labels: memory mapped label data, uint8 0 ~ 9, (?,)
+    """
+    return utils.load_cached(
+        path, split, lambda: _load_svhn_raw(path, split))
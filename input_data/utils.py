@@ -0,0 +1,249 @@
+# Copyright 2018 Xu Chen All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+import tensorflow as tf
+import result_store
+
+def _cache_paths(data_dir, split):
+    """Paths of the cached arrays of the given split.
+
+    Args:
+        data_dir: the directory containing the data;
+        split: 'train' or 'test'.
+    Returns:
+        images_path: path to the uint8 images, (?, H, W, C);
+        labels_path: path to the uint8 labels, (?,).
+    """
+    images_path = os.path.join(data_dir, '%s_images.npy' % split)
+    labels_path = os.path.join(data_dir, '%s_labels.npy' % split)
+    return images_path, labels_path
+
+def _save_atomic(path, arr):
+    """Save an array to a .npy file, concurrent readers either see the
+    whole file or no file at all."""
+    with result_store.atomic_open(path, 'wb') as f:
+        np.save(f, arr)
+
+def load_cached(data_dir, split, load_raw_fn):
+    """Load the images and labels of the given split from the cache, the 
+    cache is converted once from the raw files and stored next to them as
+    contiguous uint8 NHWC arrays, later runs only memory map the stored 
+    files, so processes running at once share the same pages.
+
+    Args:
+        data_dir: the directory containing the data;
+        split: 'train' or 'test';
+        load_raw_fn: function that returns the images, (?, H, W) or 
+            (?, H, W, C), and the labels of the split read from the raw 
+            files, only called when the cache is built.
+    Returns:
+        images: memory mapped images, uint8 0 ~ 255, (?, H, W, C);
+        labels: memory mapped labels, uint8 0 ~ 9, (?,).
+    """
+    images_path, labels_path = _cache_paths(data_dir, split)
+    if not (os.path.exists(images_path) and os.path.exists(labels_path)):
+        images, labels = load_raw_fn()
+        if images.ndim == 3:
+            # add the channel dimension of the gray scale images
+            images = images[..., np.newaxis]
+        images = np.ascontiguousarray(images, dtype=np.uint8)
+        labels = np.ascontiguousarray(np.reshape(labels, -1), dtype=np.uint8)
+        assert images.ndim == 4 and images.shape[0] == labels.shape[0]
+        # labels last, so the cache only counts as built once both exist
+        _save_atomic(images_path, images)
+        _save_atomic(labels_path, labels)
+
+    images = np.load(images_path, mmap_mode='r')
+    labels = np.load(labels_path, mmap_mode='r')
+    return images, labels
+
+def _class_index_paths(data_dir, split):
+    """Paths of the class index files of the given split.
+
+    Args:
+        data_dir: the directory containing the data;
+        split: 'train' or 'test'.
+    Returns:
+        index_path: path to the positions of the examples sorted by class;
+        offsets_path: path to the start position of every class;
+        source_path: path to the fingerprint of the labels the index was 
+            built from.
+    """
+    index_path = os.path.join(data_dir, '%s_class_index.npy' % split)
+    offsets_path = os.path.join(data_dir, '%s_class_offsets.npy' % split)
+    source_path = os.path.join(data_dir, '%s_class_index_source.npy' % split)
+    return index_path, offsets_path, source_path
+
+def _labels_fingerprint(data_dir, split):
+    """Fingerprint of the cached labels of the given split, the size and 
+    the modification time of the file, or -1s if there is no cache yet."""
+    _, labels_path = _cache_paths(data_dir, split)
+    if not os.path.exists(labels_path):
+        return np.array([-1, -1], dtype=np.int64)
+    stat = os.stat(labels_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def _is_class_index_valid(index_path, offsets_path, source_path, 
+                          fingerprint, num_classes):
+    """Whether the stored class index was built from the labels with the 
+    given fingerprint and is consistent."""
+    if not all(os.path.exists(path) for path in [index_path, offsets_path, source_path]):
+        return False
+    if not np.array_equal(np.load(source_path), fingerprint):
+        return False
+    class_offsets = np.load(offsets_path)
+    if class_offsets.shape != (num_classes + 1,):
+        return False
+    class_index = np.load(index_path, mmap_mode='r')
+    return class_index.shape == (class_offsets[-1],)
+
+def load_class_index(data_dir, split, load_labels_fn, num_classes=10):
+    """Load the per class index of the given split, the index is built once
+    from the labels and stored next to the data, later runs only memory map
+    the stored files. The index is rebuilt whenever the cached labels of 
+    the split changed since it was built.
+
+    Args:
+        data_dir: the directory containing the data;
+        split: 'train' or 'test';
+        load_labels_fn: function that returns the labels of the split,
+            only called when the index is built;
+        num_classes: number of classes.
+    Returns:
+        class_index: positions of the examples sorted by class, the
+            examples of the same class keep their original order, (?,);
+        class_offsets: the examples of class c are
+            class_index[class_offsets[c]:class_offsets[c+1]], (num_classes+1,).
+    """
+    index_path, offsets_path, source_path = _class_index_paths(data_dir, split)
+    fingerprint = _labels_fingerprint(data_dir, split)
+    if not _is_class_index_valid(index_path, offsets_path, source_path, 
+                                 fingerprint, num_classes):
+        labels = np.reshape(load_labels_fn(), -1)
+        # stable sort so that the order inside every class is reproducible
+        class_index = np.argsort(labels, kind='mergesort').astype(np.int64)
+        class_counts = np.bincount(labels, minlength=num_classes)
+        class_offsets = np.concatenate([[0], np.cumsum(class_counts)]).astype(np.int64)
+        # fingerprint last, so the index only counts as built once all exist
+        _save_atomic(index_path, class_index)
+        _save_atomic(offsets_path, class_offsets)
+        _save_atomic(source_path, fingerprint)
+
+    class_index = np.load(index_path, mmap_mode='r')
+    class_offsets = np.load(offsets_path)
+    assert class_offsets.shape == (num_classes + 1,)
+    assert class_index.shape == (class_offsets[-1],)
+    return class_index, class_offsets
+
+def sample_class_pairs(class_index, class_offsets, max_epochs, seed=None):
+    """Sample {max_epochs} examples of every class, one example of every
+    class per epoch.
+
+    Args:
+        class_index: positions of the examples sorted by class;
+        class_offsets: start position of every class in {class_index};
+        max_epochs: number of examples to sample for every class;
+        seed: if None, take the first {max_epochs} examples of every class,
+            otherwise randomly select them with this seed (stratified by class).
+    Returns:
+        sampled_idc: positions of the sampled examples, epoch major, i.e.
+            [epoch 0: class 0, 1, ..., epoch 1: class 0, 1, ...],
+            (max_epochs*num_classes,).
+    """
+    num_classes = class_offsets.shape[0] - 1
+    if seed is not None:
+        rng = np.random.RandomState(seed)
+
+    sampled_idc_lists = [] # [list of indices for 0, ... for 1, ...]
+    for c in range(num_classes):
+        start, end = class_offsets[c], class_offsets[c+1]
+        assert end - start >= max_epochs, \
+            'class {} only has {} examples'.format(c, end - start)
+        if seed is None:
+            rows = np.arange(start, start + max_epochs)
+        else:
+            rows = start + rng.choice(end - start, max_epochs, replace=False)
+        # only the selected rows of the memory mapped index are read
+        sampled_idc_lists.append(np.asarray(class_index[rows]))
+    sampled_idc_mat = np.stack(sampled_idc_lists, axis=1) # (max_epochs, num_classes)
+    return sampled_idc_mat.flatten()
+
+def streaming_dataset(images, labels, shuffle=False, chunk_size=1024,
+                      num_shards=1, shard_index=0):
+    """Stream the examples of the memory mapped arrays through a generator,
+    nothing is embedded in the graph and only {chunk_size} examples are
+    read into memory at once. With {num_shards} > 1 only every 
+    {num_shards}-th example starting from {shard_index} is read.
+
+    Args:
+        images: memory mapped images, (?, H, W) or (?, H, W, C);
+        labels: memory mapped labels, (?,);
+        shuffle: whether to read the examples in a new random order 
+            every time the dataset is iterated over, i.e. every epoch;
+        chunk_size: number of examples read at once;
+        num_shards: number of disjoint shards of the examples;
+        shard_index: index of the shard to read.
+    Returns:
+        dataset: Dataset object, each instance is an (image, label) pair.
+    """
+    assert images.shape[0] == labels.shape[0]
+    num_examples = images.shape[0]
+
+    def generator():
+        order = np.arange(shard_index, num_examples, num_shards)
+        if shuffle:
+            order = np.random.permutation(order)
+        for start in range(0, len(order), chunk_size):
+            # read the rows of every chunk in the order of the file
+            idc = np.sort(order[start:start+chunk_size])
+            images_chunk, labels_chunk = images[idc], labels[idc]
+            if shuffle:
+                perm = np.random.permutation(len(idc))
+                images_chunk, labels_chunk = images_chunk[perm], labels_chunk[perm]
+            yield images_chunk, labels_chunk
+
+    dataset = tf.data.Dataset.from_generator(
+        generator, 
+        (tf.as_dtype(images.dtype), tf.as_dtype(labels.dtype)),
+        (tf.TensorShape([None] + list(images.shape[1:])), tf.TensorShape([None])))
+    # split the chunks back into single examples
+    dataset = dataset.apply(tf.contrib.data.unbatch())
+    return dataset
+
+def split_batch(batch_data, num_splits):
+    """Split a batch of the dataset iterator among the towers along the 
+    batch axis, the first towers take one more example when the batch size 
+    is not a multiple of {num_splits}, e.g. the last batch of an epoch.
+
+    Args:
+        batch_data: a feature dictionary of one batch, every feature is 
+            batch major;
+        num_splits: number of towers.
+    Returns:
+        a list of {num_splits} feature dictionaries, one per tower.
+    """
+    if num_splits == 1:
+        return [batch_data]
+    batch_size = tf.shape(next(iter(batch_data.values())))[0]
+    base, remainder = batch_size // num_splits, batch_size % num_splits
+    split_sizes = base + tf.cast(tf.range(num_splits) < remainder, tf.int32)
+    splits = {key: tf.split(value, split_sizes, num=num_splits, axis=0)
+              for key, value in batch_data.items()}
+    return [{key: splits[key][i] for key in splits} for i in range(num_splits)]
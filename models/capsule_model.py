@@ -53,6 +53,10 @@ class CapsuleModel(model.Model):
 
         num_pixels = image_depth * image_size * image_size
 
+        if self._hparams.data_format == 'NHWC':
+            # the pixels of the remake keep the (CHW) order whatever the layout
+            batched_images = tf.transpose(batched_images, [0, 3, 1, 2])
+
         with tf.name_scope('recons'):
             remake = capsule_utils.reconstruction(
                 capsule_mask=batched_labels,
@@ -65,6 +69,8 @@ class CapsuleModel(model.Model):
                 balance_factor=0.0005)
         
         remake_reshaped = tf.reshape(remake, [-1, image_depth, image_size, image_size])
+        if self._hparams.data_format == 'NHWC':
+            remake_reshaped = tf.transpose(remake_reshaped, [0, 2, 3, 1])
 
         return remake_reshaped
 
@@ -81,7 +87,8 @@ class CapsuleModel(model.Model):
         different transformations for possible `capsule space` arrangement.
 
         Args:
-            input_tensor: 5 rank input tensor, shape (batch, 1, 256, h, w)
+            input_tensor: 5 rank input tensor, shape (batch, 1, 256, h, w), 
+                or (batch, 1, h, w, 256) if NHWC
             num_classes: number of object categories. Used as the output dimmension.
         Returns:
             A 3R tensor of the next capsule layer with 10 capsule embeddings.
@@ -98,12 +105,20 @@ class CapsuleModel(model.Model):
             stride=2,
             padding=self._hparams.padding,
             reassemble=False,
+            data_format=self._hparams.data_format,
             num_routing=1,
             leaky=self._hparams.leaky)
-        capsule1_atom_last = tf.transpose(capsule1, [0, 1, 3, 4, 2])
+        if self._hparams.data_format == 'NHWC':
+            # already atom last, (batch, out_dim, h, w, 8)
+            capsule1_atom_last = capsule1
+            _, _, height, width, _ = capsule1.get_shape()
+        else:
+            capsule1_atom_last = tf.transpose(capsule1, [0, 1, 3, 4, 2])
+            _, _, _, height, width = capsule1.get_shape()
+        # the input capsules of capsule2 are in the same order in both 
+        # layouts, so are the weights
         capsule1_3d = tf.reshape(capsule1_atom_last,
                                  [tf.shape(input_tensor)[0], -1, 8])
-        _, _, _, height, width = capsule1.get_shape()
         in_dim = self._hparams.num_prime_capsules * height.value * width.value
         
         return capsule_utils.capsule(
@@ -114,38 +129,32 @@ class CapsuleModel(model.Model):
             out_dim=num_classes, 
             out_atoms=16, 
             layer_name='capsule2',
-            reassemble=True,
+            reassemble=self._hparams.reassemble,
             num_routing=self._hparams.routing,
             leaky=self._hparams.leaky)
 
-    def build_replica(self, tower_idx):
-        """Adds a replica graph ops.
-
-        Builds the architecture of the neural net to derive logits from 
-        batched_dataset. The inference graph defined here should involve 
-        trainable variables otherwise the optimizer will raise a ValueError.
+    def _build_inference(self, batched_images, tower_idx):
+        """Adds the convolutional and capsule layers on top of the given 
+        batched images.
 
         Args:
+            batched_images: 4R tensor of batched input images, (?, c, h, w), 
+                or (?, h, w, c) if NHWC.
             tower_idx: the index number for this tower. Each tower is named
                 as tower_{tower_idx} and resides on gpu:{tower_idx}.
         Returns:
-            Inferred namedtuple containing (logits, recons).
+            capsule_output: 3R tensor of the last capsule layer, (?, 10, 16).
+            logits: the norms of the last capsule layer, (?, 10).
         """
         # Image specs
-        image_size = self._specs['image_size']
         image_depth = self._specs['depth']
         num_classes = self._specs['num_classes']
 
-        # Define input_tensor for input batched_images
-        batched_images = tf.placeholder(tf.float32,
-            shape=[None, image_depth, image_size, image_size],
-            name='batched_images') # (?, 3, h, w)
-        """visual"""
-        tf.add_to_collection('tower_%d_batched_images' % tower_idx, batched_images)
-
-        # declare the threshold placeholder for ensemble evaluation
-        threshold = tf.placeholder(tf.float32, name='threshold')
-        tf.add_to_collection('tower_%d_batched_threshold' % tower_idx, threshold)
+        # declare the threshold placeholder for ensemble evaluation,
+        # a scalar or a vector of thresholds to sweep at once
+        if self._hparams.reassemble and not tf.get_collection('tower_%d_batched_threshold' % tower_idx):
+            threshold = tf.placeholder(tf.float32, name='threshold')
+            tf.add_to_collection('tower_%d_batched_threshold' % tower_idx, threshold)
 
         # ReLU Convolution
         with tf.variable_scope('conv1') as scope:
@@ -159,15 +168,15 @@ class CapsuleModel(model.Model):
                 batched_images,
                 kernel, strides=[1, 1, 1, 1],
                 padding=self._hparams.padding,
-                data_format='NCHW')
+                data_format=self._hparams.data_format)
             pre_activation = tf.nn.bias_add(conv1, biases, 
-                data_format='NCHW', name='logits')
+                data_format=self._hparams.data_format, name='logits')
             """visual"""
             tf.add_to_collection('tower_%d_visual' % tower_idx, pre_activation)
             relu1 = tf.nn.relu(pre_activation, name=scope.name)
             if self._hparams.verbose:
                 tf.summary.histogram(scope.name + '/activation', relu1)
-        hidden1 = tf.expand_dims(relu1, 1) # (?, 1, 3, h, w) h,w are different from previous ones.
+        hidden1 = tf.expand_dims(relu1, 1) # (?, 1, 256, h, w) or (?, 1, h, w, 256) h,w are different from previous ones.
 
         # Capsules
         capsule_output = self._build_capsule(hidden1, num_classes, tower_idx)
@@ -175,10 +184,44 @@ class CapsuleModel(model.Model):
         """visual"""
         tf.add_to_collection('tower_%d_visual' % tower_idx, logits)
 
-        # Declare one-hot format placeholder for batched_labels
-        batched_labels = tf.placeholder(tf.int32,
-            shape=[None, num_classes], name='batched_labels')
-        tf.add_to_collection('tower_%d_batched_labels' % tower_idx, batched_labels)
+        return capsule_output, logits
+
+    def build_inference(self, batched_images, tower_idx):
+        """Adds the inference graph ops on top of the given batched images.
+
+        Args:
+            batched_images: 4R tensor of batched input images, (?, c, h, w), 
+                or (?, h, w, c) if NHWC.
+            tower_idx: the index number for this tower. Each tower is named
+                as tower_{tower_idx} and resides on gpu:{tower_idx}.
+        Returns:
+            logits: the norms of the last capsule layer, (?, 10).
+        """
+        _, logits = self._build_inference(batched_images, tower_idx)
+        return logits
+
+    def build_replica(self, tower_idx, batch_data=None):
+        """Adds a replica graph ops.
+
+        Builds the architecture of the neural net to derive logits from 
+        batched_dataset. The inference graph defined here should involve 
+        trainable variables otherwise the optimizer will raise a ValueError.
+
+        Args:
+            tower_idx: the index number for this tower. Each tower is named
+                as tower_{tower_idx} and resides on gpu:{tower_idx};
+            batch_data: a feature dictionary of the next batch from the 
+                dataset iterator, the default values of the input placeholders.
+        Returns:
+            Inferred namedtuple containing (logits, recons).
+        """
+        # Define placeholders for batched_images (?, 3, h, w) 
+        # and one-hot format batched_labels (?, num_classes)
+        batched_images, batched_labels = self._build_input_placeholders(
+            tower_idx, batch_data)
+
+        # Convolution and capsule layers
+        capsule_output, logits = self._build_inference(batched_images, tower_idx)
         
         # Reconstruction
         remake = None
@@ -54,11 +54,11 @@ class CNNModel(model.Model):
                     input_tensor,
                     kernel, [1, 1, 1, 1],
                     padding=self._hparams.padding,
-                    data_format='NCHW')
+                    data_format=self._hparams.data_format)
                 biases = variables.bias_variable([channels[i]],
                                                  verbose=self._hparams.verbose)
                 pre_activation = tf.nn.bias_add(
-                    conv, biases, data_format='NCHW', name='logits')
+                    conv, biases, data_format=self._hparams.data_format, name='logits')
                 """visual"""
                 tf.add_to_collection('tower_%d_visual' % tower_idx, pre_activation)
                 
@@ -66,37 +66,30 @@ class CNNModel(model.Model):
                 if self._hparams.verbose:
                     tf.summary.histogram('activation', relu)
                 input_tensor = tf.contrib.layers.max_pool2d(
-                    relu, kernel_size=2, stride=2, data_format='NCHW', padding='SAME')
+                    relu, kernel_size=2, stride=2, data_format=self._hparams.data_format, 
+                    padding='SAME')
         
         return input_tensor
 
-    def build_replica(self, tower_idx):
-        """Adds a replica graph ops.
-
-        Builds the architecture of the neural net to derive logits from 
-        batched_dataset. The inference graph defined here should involve 
-        trainable variables otherwise the optimizer will raise a ValueError.
+    def build_inference(self, batched_images, tower_idx):
+        """Adds the inference graph ops on top of the given batched images.
 
         Args:
+            batched_images: 4R tensor of batched input images.
             tower_idx: the index number for this tower. Each tower is named
                 as tower_{tower_idx} and resides on gpu:{tower_idx}.
         Returns:
-            Inferred namedtuple containing (logits, None).
+            logits: the output logits of the model.
         """
         # Image specs
-        image_size = self._specs['image_size']
         image_depth = self._specs['depth']
         num_classes = self._specs['num_classes']
 
-        # Define input_tensor for input batched_images
-        batched_images = tf.placeholder(tf.float32, 
-            shape=[None, image_depth, image_size, image_size], 
-            name='batched_images')
-        """visual"""
-        tf.add_to_collection('tower_%d_batched_images' % tower_idx, batched_images)
-        
         # Add convolutional layers
         conv_out = self._add_convs(batched_images, [image_depth, 512, 256], tower_idx)
+        if self._hparams.data_format == 'NHWC':
+            # flatten in the (CHW) order, so that fc1 has the same weights in both layouts
+            conv_out = tf.transpose(conv_out, [0, 3, 1, 2])
         hidden1 = tf.contrib.layers.flatten(conv_out) # flatten neurons, shape (?, rest)
 
         # Add fully connected layer 1, activation = relu
@@ -124,11 +117,30 @@ class CNNModel(model.Model):
             """visual"""
             tf.add_to_collection('tower_%d_visual' % tower_idx, logits)
         
-        # Declare one-hot format placeholder for batched_labels
-        batched_labels = tf.placeholder(tf.int32,
-            shape=[None, num_classes], name='batched_labels') # 'tower_i/batched_labels:0'
-        """visual"""
-        tf.add_to_collection('tower_%d_batched_labels' % tower_idx, batched_labels)
+        return logits
+
+    def build_replica(self, tower_idx, batch_data=None):
+        """Adds a replica graph ops.
+
+        Builds the architecture of the neural net to derive logits from 
+        batched_dataset. The inference graph defined here should involve 
+        trainable variables otherwise the optimizer will raise a ValueError.
+
+        Args:
+            tower_idx: the index number for this tower. Each tower is named
+                as tower_{tower_idx} and resides on gpu:{tower_idx};
+            batch_data: a feature dictionary of the next batch from the 
+                dataset iterator, the default values of the input placeholders.
+        Returns:
+            Inferred namedtuple containing (logits, None).
+        """
+        # Define placeholders for batched_images and one-hot format batched_labels,
+        # 'tower_i/batched_images:0' and 'tower_i/batched_labels:0'
+        batched_images, batched_labels = self._build_input_placeholders(
+            tower_idx, batch_data)
+        
+        # Add inference layers
+        logits = self.build_inference(batched_images, tower_idx)
 
         return model.Inferred(logits, None)
 
@@ -0,0 +1,107 @@
+# Copyright 2018 Xu Chen All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Device strategies, which place the replicas (towers), the variables and
+the input pipeline of a model.
+
+single:       all the replicas and the variables on one device, the
+              replicas run one after another;
+cpu_replicas: every replica on its own virtual CPU device, the replicas run
+              concurrently and their ops share the thread pool of the cores,
+              the variables and the input on cpu:0;
+multi_gpu:    replica i on gpu:i, the variables and the input on cpu:0.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import tensorflow as tf
+
+STRATEGIES = ['single', 'cpu_replicas', 'multi_gpu']
+
+# ops holding the state of a variable, placed on the variable device
+_VARIABLE_OPS = ['Variable', 'VariableV2', 'VarHandleOp']
+
+class DeviceStrategy(object):
+    """Placement of the replicas, the variables and the input of a model."""
+
+    def __init__(self, name, num_replicas, device='/gpu:0', num_threads=None):
+        """Initializes the device strategy.
+
+        Args:
+            name: 'single', 'cpu_replicas' or 'multi_gpu';
+            num_replicas: number of replicas, i.e. towers, of the model;
+            device: the device of the 'single' strategy;
+            num_threads: number of threads of the session, None for all the cores.
+        """
+        assert name in STRATEGIES, 'Unknown device strategy {}!'.format(name)
+        self.name = name
+        self.num_replicas = num_replicas
+        self.num_threads = num_threads or multiprocessing.cpu_count()
+
+        self.input_device = '/cpu:0'
+        if name == 'single':
+            self._replica_devices = [device] * num_replicas
+            self.variable_device = device
+        elif name == 'cpu_replicas':
+            self._replica_devices = ['/cpu:%d' % i for i in range(num_replicas)]
+            self.variable_device = '/cpu:0'
+        else:
+            self._replica_devices = ['/gpu:%d' % i for i in range(num_replicas)]
+            self.variable_device = '/cpu:0'
+
+    def replica_device(self, replica_idx):
+        """The device of the given replica."""
+        return self._replica_devices[replica_idx]
+
+    def device_fn(self, replica_idx):
+        """Device function of the given replica, to be used with tf.device().
+
+        The variables created inside the replica go to the variable device,
+        every other op goes to the device of the replica.
+        """
+        replica_device = self.replica_device(replica_idx)
+        variable_device = self.variable_device
+
+        def _device_fn(op):
+            if op.type in _VARIABLE_OPS:
+                return variable_device
+            return replica_device
+        return _device_fn
+
+    def session_config(self, session_threads=None):
+        """Session config with the devices and the thread pools of the strategy.
+
+        Args:
+            session_threads: number of threads of the session, overrides the
+                thread pools of the strategy, e.g. to share the cores with
+                other processes.
+        Returns:
+            A tf.ConfigProto.
+        """
+        config = tf.ConfigProto(allow_soft_placement=True)
+        if self.name == 'cpu_replicas':
+            # one virtual cpu device per replica
+            config.device_count['CPU'] = self.num_replicas
+            # an inter op thread per replica (and the input) so that the 
+            # replicas run concurrently, every op splits over all the cores
+            config.inter_op_parallelism_threads = self.num_replicas + 1
+            config.intra_op_parallelism_threads = self.num_threads
+        if session_threads:
+            config.intra_op_parallelism_threads = session_threads
+            config.inter_op_parallelism_threads = session_threads
+        return config
@@ -14,34 +14,45 @@
 # limitations under the License.
 # ==============================================================================
 
-"""Library for capsule layers."""
+"""Library for capsule layers.
+
+The tensors added to tower_{tower_idx}_visual are in the layout of the 
+data format of the layer, whichever routing path built them:
+
+conv votes:         NCHW (batch, in_dim, out_dim, atoms, h, w),
+                    NHWC (batch, in_dim, h, w, out_dim, atoms);
+conv activations:   NCHW (batch, out_dim, atoms, h, w),
+                    NHWC (batch, out_dim, h, w, atoms);
+fc activations:     (batch, out_dim, atoms) for both.
+"""
 
 from __future__ import absolute_import
 from __future__ import division 
 from __future__ import print_function
 
-import numpy as np 
 import tensorflow as tf 
 
 from models.layers import variables
 
-def _squash(in_tensor):
+def _squash(in_tensor, axis=2):
     """Applies (squash) to capsule layer.
     
     Args:
         in_tensor: tensor, 
             shape [batch, num_cap_types, num_atoms] for a fc capsule layer or
             shape [batch, num_cap_types, num_atoms, h, w] for a convolutional 
-            capsule layer.
+            capsule layer (the atoms last if NHWC, e.g. [batch, h, w, 
+            num_cap_types, num_atoms] inside the routing).
+        axis: the axis of the atoms.
     Returns:
         A tensor with same shape
     """
     with tf.name_scope('norm_non_linearity'):
-        norm = tf.norm(in_tensor, axis=2, keepdims=True)
+        norm = tf.norm(in_tensor, axis=axis, keepdims=True)
         norm_squared = norm * norm
         return (in_tensor / norm) * (norm_squared / (1 + norm_squared))
 
-def _leaky_routing(logits, out_dim):
+def _leaky_routing(logits, out_dim, axis=2):
     """Adds extra dimmension to routing logits.
 
     This enables active capsules to be routed to the extra dim if they are not a
@@ -51,18 +62,19 @@ def _leaky_routing(logits, out_dim):
         logits: the original logits. shape (in_dim, out_dim) if fully connected. 
             Otherwise, it has two more dimmensions.
         out_dim:
+        axis: the axis of the output capsule types.
     
     Returns:
         routing probabilities for each pair of capsules. Same shape as logits.
     """
     leak = tf.zeros_like(logits, optimize=True)
-    leak = tf.reduce_sum(leak, axis=2, keepdims=True)
-    leaky_logits = tf.concat([leak, logits], axis=2)
-    leaky_routing = tf.nn.softmax(leaky_logits, axis=2)
-    return tf.split(leaky_routing, [1, out_dim], 2)[1]
+    leak = tf.reduce_sum(leak, axis=axis, keepdims=True)
+    leaky_logits = tf.concat([leak, logits], axis=axis)
+    leaky_routing = tf.nn.softmax(leaky_logits, axis=axis)
+    return tf.split(leaky_routing, [1, out_dim], axis)[1]
 
 def _update_routing(tower_idx, votes, biases, logit_shape, num_ranks, in_dim, out_dim, reassemble, 
-                    leaky, num_routing):
+                    leaky, num_routing, data_format='NCHW'):
     """Sums over scaled votes and applies squash to compute the activations.
 
     Iteratively updates routing logits (scales) based on the similarity between
@@ -72,7 +84,7 @@ def _update_routing(tower_idx, votes, biases, logit_shape, num_ranks, in_dim, ou
         tower_idx: the index number for this tower. Each tower is named
             as tower_{tower_idx} and resides on gpu:{tower_idx}.
         votes: tensor, the transformed outputs of the layer below.
-        biases: tensor, bias variable.
+        biases: tensor, bias variable, (out_dim, out_atoms) or (out_dim, out_atoms, 1, 1).
         logit_shape: tensor, shape of the logit to be initialized.
         num_ranks: scalar, rank of the votes tensor. For fully connected capsule it
             is 4, for convolutional capsule it is 6.
@@ -80,34 +92,63 @@ def _update_routing(tower_idx, votes, biases, logit_shape, num_ranks, in_dim, ou
         out_dim: scalar, number of capsule types of output.
         leaky: boolean, whether to use leaky routing.
         num_routing: scalar, number of routing iterations.
-        reassemble: boolean, whether to use reassemble method.
+        reassemble: boolean, whether to build the reassemble (ensemble) outputs,
+            which are only needed by the ensemble evaluation.
+        data_format: 'NCHW' or 'NHWC', layout of the votes of a convolutional
+            capsule layer, the routing runs in the same layout.
     Returns:
-        The activation tensor of the output layer after `num_routing` iterations.
+        The activation tensor of the output layer after `num_routing` iterations,
+        (batch, out_dim, out_atoms, ...), or (batch, out_dim, h, w, out_atoms) 
+        if NHWC.
+
+    votes: [batch, in_dim, out_dim, out_atoms, ...], route and logits:
+    [batch, in_dim, out_dim, ...]. The route is broadcast over the atoms and
+    the activation over the input capsules, so neither the votes nor the 
+    activation are transposed or tiled. If NHWC, votes: [batch, in_dim, h, w, 
+    out_dim, out_atoms], route and logits: [batch, in_dim, h, w, out_dim], the
+    atoms are the last axis of the votes and of the activation.
     """
-    votes_t_shape = [3, 0, 1, 2]
-    r_t_shape = [1, 2, 3, 0]
-    for i in range(num_ranks - 4):
-        votes_t_shape += [i + 4]
-        r_t_shape += [i + 4]
-    votes_trans = tf.transpose(votes, votes_t_shape)
+    if data_format == 'NHWC':
+        # axes of the output capsule types in the logits and of the atoms in 
+        # the votes and in the activation
+        out_dim_axis, votes_atoms_axis, atoms_axis = -1, -1, -1
+        # broadcast over the trailing (out_dim, out_atoms)
+        biases = tf.reshape(biases, [out_dim, -1])
+    else:
+        out_dim_axis, votes_atoms_axis, atoms_axis = 2, 3, 2
+
+    def _preactivate(route):
+        """Weighted sum of the votes over the input capsules."""
+        # [batch, in_dim, out_dim, 1, ...] * [batch, in_dim, out_dim, out_atoms, ...]
+        preact_unrolled = tf.expand_dims(route, votes_atoms_axis) * votes
+        return tf.reduce_sum(preact_unrolled, axis=1) + biases
+
+    def _agreement(activation):
+        """Agreement of the votes with the activation, [batch, in_dim, out_dim, ...]."""
+        # [batch, in_dim, out_dim, out_atoms, ...] * [batch, 1, out_dim, out_atoms, ...]
+        return tf.reduce_sum(votes * tf.expand_dims(activation, 1), axis=votes_atoms_axis)
+
+    def _route(logits):
+        """Routing probabilities over the output capsule types."""
+        if leaky:
+            return _leaky_routing(logits, out_dim, out_dim_axis)
+        return tf.nn.softmax(logits, axis=out_dim_axis)
+
+    def _output_layout(activation):
+        """The activation in the layout of the output of the layer."""
+        if data_format == 'NHWC':
+            # [batch, h, w, out_dim, out_atoms] -> [batch, out_dim, h, w, out_atoms]
+            return tf.transpose(activation, [0, 3, 1, 2, 4])
+        return activation
 
     def _body(i, logits, activations):
         """Routing while loop."""
         # route: [batch, in_dim, out_dim, ...]
-        if leaky:
-            route = _leaky_routing(logits, out_dim)
-        else:
-            route = tf.nn.softmax(logits, axis=2)
-        preact_unrolled = route * votes_trans
-        preact_trans = tf.transpose(preact_unrolled, r_t_shape)
-        preactivate = tf.reduce_sum(preact_trans, axis=1) + biases
-        activation = _squash(preactivate)
+        route = _route(logits)
+        preactivate = _preactivate(route)
+        activation = _squash(preactivate, atoms_axis)
         activations = activations.write(i, activation)
-        act_3d = tf.expand_dims(activation, 1)
-        tile_shape = np.ones(num_ranks, dtype=np.int32).tolist()
-        tile_shape[1] = in_dim
-        act_replicated = tf.tile(act_3d, tile_shape)
-        distances = tf.reduce_sum(votes * act_replicated, axis=3)
+        distances = _agreement(activation)
         # logits = logits.write(i+1, logit + distances)
         logits += distances
         return (i + 1, logits, activations)
@@ -124,67 +165,113 @@ def _update_routing(tower_idx, votes, biases, logit_shape, num_ranks, in_dim, ou
         swap_memory=True)
 
     # do it manually
-    if leaky:
-        route = _leaky_routing(logits, out_dim)
-    else:
-        route = tf.nn.softmax(logits, axis=2) # (?, 512, 10)
+    route = _route(logits) # (?, 512, 10)
     """Normal route section"""
-    preact_unrolled = route * votes_trans
-    preact_trans = tf.transpose(preact_unrolled, r_t_shape)
-    preactivate = tf.reduce_sum(preact_trans, axis=1) + biases
-    activation = _squash(preactivate)
+    preactivate = _preactivate(route)
+    activation = _squash(preactivate, atoms_axis)
     activations = activations.write(num_routing - 1, activation)
-    act_3d = tf.expand_dims(activation, 1)
-    tile_shape = np.ones(num_ranks, dtype=np.int32).tolist()
-    tile_shape[1] = in_dim
-    act_replicated = tf.tile(act_3d, tile_shape)
-    distances = tf.reduce_sum(votes * act_replicated, axis=3)
+    distances = _agreement(activation)
     logits += distances
 
-    full_norm = tf.norm(preactivate, axis=2, keepdims=True)
-    full_norm_squared = full_norm * full_norm
-    scale = full_norm / (1 + full_norm_squared)
     if reassemble:
         """Boost section"""
-        # transpose route to make compare easier
-        route_trans = tf.transpose(route, [0, 2, 1])
-        ten_splits = tf.split(route_trans, num_or_size_splits=10, axis=1)
+        # only built for the fully connected capsule layer, route: (?, 512, 10)
+        assert num_ranks == 4
+        full_norm = tf.norm(preactivate, axis=2, keepdims=True)
+        full_norm_squared = full_norm * full_norm
+        scale = full_norm / (1 + full_norm_squared) # (?, 10, 1)
         threshold = tf.get_collection('tower_%d_batched_threshold' % tower_idx)[0]
-        for split in ten_splits:
-            split_shape = tf.shape(split) # (?, 1, 512)
-            valid_cap_indices = tf.less_equal(
-                split, 
-                tf.fill(split_shape, threshold)) # threshold here
-            valid_cap_indices_sq = tf.squeeze(valid_cap_indices)
-            valid_cap_multiplier = tf.cast(valid_cap_indices_sq, tf.float32) # (?, 512) 1.0 or 0.0
-            valid_cap_multiplier_tiled = tf.tile(
-                tf.expand_dims(valid_cap_multiplier, -1), 
-                [1, 1, 10])
-            preact_unrolled = valid_cap_multiplier_tiled * route * votes_trans
-            preact_trans = tf.transpose(preact_unrolled, r_t_shape)
-            preactivate = tf.reduce_sum(preact_trans, axis=1) + biases
+        # a scalar threshold or a vector of thresholds to sweep at once
+        thresholds = tf.reshape(threshold, [-1])
+        votes_trans = tf.transpose(votes, [0, 2, 1, 3]) # (?, 10, 512, 16)
+
+        def _masked_act_norms(threshold):
+            """Norms of the reassembled capsules of every class for one threshold."""
+            # mask of the input capsules of every class at once, 1.0 where the 
+            # route of the input capsule to the class is not above the threshold
+            valid_cap_multiplier = tf.cast(
+                tf.less_equal(route, threshold), tf.float32) # (?, 512, 10) 1.0 or 0.0
+            valid_cap_multiplier_trans = tf.transpose(valid_cap_multiplier, [0, 2, 1]) # (?, 10, 512)
+            # masked route of every class: [batch, class, in_dim, out_dim]
+            masked_route = tf.expand_dims(valid_cap_multiplier_trans, -1) * tf.expand_dims(route, 1)
+            # weighted sum of the votes over the input capsules for every class, 
+            # batched over [batch, out_dim]: [class, in_dim] @ [in_dim, out_atoms]
+            masked_route_trans = tf.transpose(masked_route, [0, 3, 1, 2]) # (?, 10, class, 512)
+            preact_trans = tf.matmul(masked_route_trans, votes_trans) # (?, 10, class, 16)
+            preactivate = tf.transpose(preact_trans, [0, 2, 1, 3]) + biases # (?, class, 10, 16)
             # activation = _squash(preactivate)
             # manual squash
             with tf.name_scope('manual_norm_non_linearity'):
-                activation = preactivate * scale
-            act_norm = tf.norm(activation, axis=-1, name='act_norm')
+                activation = preactivate * tf.expand_dims(scale, 1)
+            return tf.norm(activation, axis=-1) # (?, class, 10)
+
+        # the routing above is shared by all the thresholds
+        act_norms = tf.map_fn(_masked_act_norms, thresholds, back_prop=False)
+        act_norms = tf.identity(act_norms, name='act_norm') # (thresholds, ?, class, 10)
+        for act_norm in tf.unstack(act_norms, num=out_dim, axis=2):
+            # (thresholds, ?, 10)
             tf.add_to_collection('tower_%d_ensemble_acts' % tower_idx, act_norm) # total 10
 
     """visual""" 
     for i in range(num_routing):
-        tf.add_to_collection('tower_%d_visual' % tower_idx, activations.read(i))
-    return activations.read(num_routing - 1)
+        # same layout as the output of the layer and as _uniform_routing
+        tf.add_to_collection('tower_%d_visual' % tower_idx, 
+                             _output_layout(activations.read(i)))
+    return _output_layout(activations.read(num_routing - 1))
     
 
+def _uniform_routing(tower_idx, votes, biases, out_dim, leaky, data_format='NCHW'):
+    """Sums over uniformly scaled votes and applies squash to compute the activations.
+
+    Fast path of _update_routing for a single routing iteration over a single
+    input capsule type. The routing logits start at zero, so the only route 
+    is uniform, 1/out_dim or 1/(out_dim+1) if leaky, and the weighted sum over 
+    the input capsules is the scaled votes of the only input capsule type, 
+    which gives the same activations without the routing loop.
+
+    Args:
+        tower_idx: the index number for this tower. Each tower is named
+            as tower_{tower_idx} and resides on gpu:{tower_idx}.
+        votes: tensor, the transformed outputs of the layer below, 
+            shape [batch, 1, out_dim, out_atoms, h, w], or 
+            [batch, 1, h, w, out_dim, out_atoms] if NHWC.
+        biases: tensor, bias variable, (out_dim, out_atoms, 1, 1).
+        out_dim: scalar, number of capsule types of output.
+        leaky: boolean, whether to use leaky routing.
+        data_format: 'NCHW' or 'NHWC', layout of the votes.
+    Returns:
+        The activation tensor of the output layer, (batch, out_dim, out_atoms, h, w),
+        or (batch, out_dim, h, w, out_atoms) if NHWC.
+    """
+    if leaky:
+        # the extra dimmension of the leak takes its share of the route
+        route = 1.0 / (out_dim + 1)
+    else:
+        route = 1.0 / out_dim
+    if data_format == 'NHWC':
+        # the same bias variable broadcast over the trailing (out_dim, out_atoms)
+        preactivate = tf.squeeze(votes, axis=1) * route + tf.squeeze(biases, axis=[2, 3])
+        preactivate = tf.transpose(preactivate, [0, 3, 1, 2, 4])
+        activation = _squash(preactivate, axis=-1)
+    else:
+        preactivate = tf.squeeze(votes, axis=1) * route + biases
+        activation = _squash(preactivate)
+
+    """visual"""
+    tf.add_to_collection('tower_%d_visual' % tower_idx, activation)
+    return activation
+
 def _depthwise_conv3d(tower_idx, in_tensor, in_dim, in_atoms,
                       out_dim, out_atoms,
-                      kernel, stride=2, padding='SAME'):
+                      kernel, stride=2, padding='SAME', data_format='NCHW'):
     """Perform 2D convolution given a 5D input tensor.
 
     This layer given an input tensor of shape (batch, in_dim, in_atoms, in_h, in_w).
     We squeeze this first two dimmensions to get a 4R tensor as the input of 
     tf.nn.conv2d. Then splits the first dimmension and the last dimmension and 
-    returns the 6R convolution output.
+    returns the 6R convolution output. If NHWC, the atoms are the last 
+    dimmension of the input (batch, in_dim, in_h, in_w, in_atoms) and of the
+    output (batch, in_dim, out_h, out_w, out_dim, out_atoms).
     
     Args:
         tower_idx: the index number for this tower. Each tower is named
@@ -197,11 +284,15 @@ def _depthwise_conv3d(tower_idx, in_tensor, in_dim, in_atoms,
         kernel: tensor, convolutional kernel variable.
         stride: scalar, stride of the convolutional kernel.
         padding: 'SAME' or 'VALID', padding mechanism for convolutional kernels.
+        data_format: 'NCHW' or 'NHWC', layout of the input and the output.
     Returns: 
         6R tensor output of a 2D convolution with shape (batch, in_dim, out_dim,
         out_atoms, out_h, out_w), the covolution output shape and the input shape.
     """
     with tf.name_scope('conv'):
+        if data_format == 'NHWC':
+            return _depthwise_conv3d_nhwc(tower_idx, in_tensor, in_dim, in_atoms,
+                                          out_dim, out_atoms, kernel, stride, padding)
         in_shape = tf.shape(in_tensor) # op
         _, _, _, in_height, in_width = in_tensor.get_shape() # (batch, in_dim, in_atoms, in_h, in_w)
         # Reshape in_tensor to 4R by merging first two dimmensions.
@@ -230,11 +321,48 @@ def _depthwise_conv3d(tower_idx, in_tensor, in_dim, in_atoms,
         """visual"""
         tf.add_to_collection('tower_%d_visual' % tower_idx, conv_reshaped)
         return conv_reshaped, conv_shape, in_shape
-        
+
+def _depthwise_conv3d_nhwc(tower_idx, in_tensor, in_dim, in_atoms,
+                           out_dim, out_atoms, kernel, stride, padding):
+    """NHWC version of _depthwise_conv3d, same arguments.
+
+    Returns:
+        6R tensor output of a 2D convolution with shape (batch, in_dim, out_h, 
+        out_w, out_dim, out_atoms), the covolution output shape and the input shape.
+    """
+    in_shape = tf.shape(in_tensor) # op
+    _, _, in_height, in_width, _ = in_tensor.get_shape() # (batch, in_dim, in_h, in_w, in_atoms)
+    # Reshape in_tensor to 4R by merging first two dimmensions.
+    in_tensor_reshaped = tf.reshape(in_tensor, [
+        in_shape[0]*in_dim, in_shape[2], in_shape[3], in_atoms
+    ])
+    in_tensor_reshaped.set_shape((None, in_height.value, in_width.value, in_atoms))
+
+    # do convolution
+    conv = tf.nn.conv2d(
+        in_tensor_reshaped,
+        kernel, [1, stride, stride, 1],
+        padding=padding,
+        data_format='NHWC')
+    conv_shape = tf.shape(conv) # shape (batch*in_dim, H, W, out_dim*out_atoms)
+    _, conv_height, conv_width, _ = conv.get_shape()
+    # Reshape back to 6R by splitting first dimmension to batch and in_dim
+    # and splitting the last dimmension to out_dim and out_atoms.
+    conv_reshaped = tf.reshape(conv, [
+        in_shape[0], in_dim, conv_shape[1], conv_shape[2], out_dim, out_atoms
+    ], name='votes')
+    conv_reshaped.set_shape((None, in_dim, conv_height.value, conv_width.value,
+        out_dim, out_atoms))
+
+    """visual"""
+    tf.add_to_collection('tower_%d_visual' % tower_idx, conv_reshaped)
+    return conv_reshaped, conv_shape, in_shape
+
+
 def conv_slim_capsule(tower_idx, in_tensor, in_dim, in_atoms,
                       out_dim, out_atoms, layer_name,
                       kernel_size=5, stride=2, padding='SAME', 
-                      reassemble=False,
+                      reassemble=False, data_format='NCHW',
                       **routing_args):
     """Builds a slim convolutional capsule layer.
 
@@ -265,11 +393,15 @@ def conv_slim_capsule(tower_idx, in_tensor, in_dim, in_atoms,
         kernel_size: scalar: convolutional kernel size (kernel_size, kernel_size)
         stride: scalar, stride of the convolutional kernel.
         padding: 'SAME' or 'VALID', padding mechanism for convolutional kernels.
+        reassemble: boolean, whether to build the reassemble branch of the routing.
+        data_format: 'NCHW' or 'NHWC', if NHWC the atoms are the last dimmension
+            of the input (batch, in_dim, in_h, in_w, in_atoms) and of the output.
         **routing_args: dictionary {leaky, num_routing}, args to be passed to the 
             routing procedure.
     Returns:
         Tensor of activations for this layer of shape
-            (batch, out_dim, out_atoms, out_h, out_w).
+            (batch, out_dim, out_atoms, out_h, out_w), or 
+            (batch, out_dim, out_h, out_w, out_atoms) if NHWC.
     """
     with tf.variable_scope(layer_name):
         kernel = variables.weight_variable(
@@ -277,23 +409,36 @@ def conv_slim_capsule(tower_idx, in_tensor, in_dim, in_atoms,
         biases = variables.bias_variable(
             shape=[out_dim, out_atoms, 1, 1]) 
         votes, votes_shape, in_shape = _depthwise_conv3d(
-            tower_idx, in_tensor, in_dim, in_atoms, out_dim, out_atoms, kernel, stride, padding)
+            tower_idx, in_tensor, in_dim, in_atoms, out_dim, out_atoms, kernel, stride, padding,
+            data_format)
         
         with tf.name_scope('routing'):
-            logit_shape = tf.stack([
-                in_shape[0], in_dim, out_dim, votes_shape[2], votes_shape[3]
-            ])
-            biases_replicated = tf.tile(biases, [1, 1, votes_shape[2], votes_shape[3]])
-
+            if in_dim == 1 and routing_args['num_routing'] == 1 and not reassemble:
+                # e.g. on top of a conv2d layer, nothing to route
+                return _uniform_routing(
+                    tower_idx, votes, biases, out_dim, routing_args['leaky'], data_format)
+
+            if data_format == 'NHWC':
+                # route in the NHWC layout of the votes, the atoms are the last axis
+                logit_shape = tf.stack([
+                    in_shape[0], in_dim, votes_shape[1], votes_shape[2], out_dim
+                ])
+            else:
+                logit_shape = tf.stack([
+                    in_shape[0], in_dim, out_dim, votes_shape[2], votes_shape[3]
+                ])
+            # biases (out_dim, out_atoms, 1, 1) broadcast over the positional grid,
+            # or over the trailing (out_dim, out_atoms) if NHWC
             activations = _update_routing(
                 tower_idx,
                 votes=votes, 
-                biases=biases_replicated, 
+                biases=biases, 
                 logit_shape=logit_shape, 
                 num_ranks=6, 
                 in_dim=in_dim, 
                 out_dim=out_dim,
                 reassemble=reassemble,
+                data_format=data_format,
                 **routing_args)
         return activations
 
@@ -334,12 +479,12 @@ def capsule(tower_idx, in_tensor, in_dim, in_atoms,
         biases = variables.bias_variable([out_dim, out_atoms])
         with tf.name_scope('Wx_plus_b'):
             # Depthwise matmul: [b, d, c] @ [d, c, o_c] = [b, d, o_c]
-            # to do this: tile input, do element-wise multiplication and reduce
-            # sum over in_atoms dimmension.
-            in_tiled = tf.tile(
-                tf.expand_dims(in_tensor, -1), 
-                [1, 1, 1, out_dim * out_atoms])
-            votes = tf.reduce_sum(in_tiled * weights, axis=2)
+            # to do this: batch the matmul over the in_dim dimmension, 
+            # [d, b, c] @ [d, c, o_c] = [d, b, o_c], which contracts the 
+            # in_atoms dimmension without tiling the input.
+            in_trans = tf.transpose(in_tensor, [1, 0, 2])
+            votes_trans = tf.matmul(in_trans, weights)
+            votes = tf.transpose(votes_trans, [1, 0, 2])
             votes_reshaped = tf.reshape(votes,
                                         [-1, in_dim, out_dim, out_atoms])
         
@@ -20,7 +20,9 @@ from __future__ import print_function
 import tensorflow as tf
 
 def weight_variable(shape, stddev=0.1, verbose=False):
-	"""Creates a CPU variable with normal initialization. Adds summaries.
+	"""Creates a variable with normal initialization. Adds summaries.
+
+	The variable is placed by the device strategy of the enclosing tower.
 
 	Args:
 		shape: list, the shape of the variable.
@@ -30,20 +32,21 @@ def weight_variable(shape, stddev=0.1, verbose=False):
 	Returns:
 		Weight variable tensor of shape=shape.
 	"""
-	with tf.device('/cpu:0'):
-		with tf.name_scope('weights'):
-			weights = tf.get_variable(
-				'weights',
-				shape,
-				initializer=tf.truncated_normal_initializer(
-						stddev=stddev, dtype=tf.float32),
-				dtype=tf.float32)
+	with tf.name_scope('weights'):
+		weights = tf.get_variable(
+			'weights',
+			shape,
+			initializer=tf.truncated_normal_initializer(
+					stddev=stddev, dtype=tf.float32),
+			dtype=tf.float32)
 	variable_summaries(weights, verbose)
 	return weights
 
 
 def bias_variable(shape, verbose=False):
-	"""Creates a CPU variable with constant initialization. Adds summaries.
+	"""Creates a variable with constant initialization. Adds summaries.
+
+	The variable is placed by the device strategy of the enclosing tower.
 
 	Args:
 		shape: list, the shape of the variable.
@@ -52,13 +55,12 @@ def bias_variable(shape, verbose=False):
 	Returns:
 		Bias variable tensor with shape=shape.
 	"""
-	with tf.device('/cpu:0'):
-		with tf.name_scope('biases'):
-			biases = tf.get_variable(
-				'biases',
-				shape,
-				initializer=tf.constant_initializer(0.1),
-				dtype=tf.float32)
+	with tf.name_scope('biases'):
+		biases = tf.get_variable(
+			'biases',
+			shape,
+			initializer=tf.constant_initializer(0.1),
+			dtype=tf.float32)
 	variable_summaries(biases, verbose)
 	return biases
 
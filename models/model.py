@@ -21,7 +21,9 @@ from __future__ import print_function
 import abc 
 import collections
 import tensorflow as tf 
+from models import devices
 from models.layers import utils
+from input_data import utils as input_utils
 
 Inferred = collections.namedtuple('Inferred',
                                  ('logits', 'remakes'))
@@ -29,12 +31,15 @@ TowerResult = collections.namedtuple('TowerResult',
                                     ('inferred', 'correct', 'accuracy', 'grads'))
 JoinedResult = collections.namedtuple('JoinedResult',
                                      ('summary', 'train_op', 'correct', 'accuracy'))
+CollectiveResult = collections.namedtuple('CollectiveResult',
+                                         ('summary', 'grads', 'grad_placeholders', 
+                                          'train_op', 'correct', 'accuracy'))
 class Model(object):
     """Base class for building a model and running inference on it."""
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, hparams, dataset_specs):
+    def __init__(self, hparams, dataset_specs, strategy=None):
         """Initializes the model parameters.
         
         Args:
@@ -44,10 +49,16 @@ class Model(object):
                 `split`, `max_epochs`, `total_batch_size`, `num_gpus`,
                 `num_gpus`, `image_dim`, `depth`, 
                 `num_classes`, `total_size`, `steps_per_epoch`.
+            strategy: devices.DeviceStrategy placing the towers and the 
+                variables, by default one tower per GPU.
         """
         self._hparams = hparams
         self._specs = dataset_specs
-        with tf.device('/cpu:0'):
+        if strategy is None:
+            strategy = devices.DeviceStrategy(
+                'multi_gpu', dataset_specs.get('num_gpus', 1))
+        self._strategy = strategy
+        with tf.device(self._strategy.variable_device):
             self._global_step = tf.get_variable(
                 'global_step', [],
                 initializer=tf.constant_initializer(0),
@@ -93,11 +104,12 @@ class Model(object):
         Returns:
             A JoinedResult of evaluation results.
         """
-        # average gradients
-        grads = self._average_gradients(tower_grads)
-        # apply gradients
-        train_op = self._optimizer.apply_gradients(
-            grads, global_step=self._global_step)
+        with tf.device(self._strategy.variable_device):
+            # average gradients next to the variables
+            grads = self._average_gradients(tower_grads)
+            # apply gradients
+            train_op = self._optimizer.apply_gradients(
+                grads, global_step=self._global_step)
         # add summaries
         summaries = tf.get_collection(tf.GraphKeys.SUMMARIES)
         summary = tf.summary.merge(summaries)
@@ -113,7 +125,71 @@ class Model(object):
         return JoinedResult(summary, train_op, summed_corrects, accuracy)
 
     @abc.abstractmethod
-    def build_replica(self, tower_idx):
+    def build_inference(self, batched_images, tower_idx):
+        """Adds the inference graph ops on top of the given batched images.
+
+        Builds the layers of the neural net from {batched_images} to the 
+        logits and adds the visualization related tensors to the collection 
+        tower_{tower_idx}_visual. The input can be any 4R tensor, so the 
+        inference graph can also be rebuilt on top of other tensors, e.g. 
+        inside a gradient ascent loop.
+
+        Args:
+            batched_images: 4R tensor of batched input images.
+            tower_idx: the index number for this tower. Each tower is named
+                as tower_{tower_idx} and resides on gpu:{tower_idx}.
+        Returns:
+            logits: the output logits of the model.
+        """
+        raise NotImplementedError('Not implemented.')
+
+    def _build_input_placeholders(self, tower_idx, batch_data=None):
+        """Adds the input placeholders of one tower.
+
+        The placeholders are named 'tower_{tower_idx}/batched_images:0' and 
+        'tower_{tower_idx}/batched_labels:0' and added to the collections 
+        tower_{tower_idx}_batched_images and tower_{tower_idx}_batched_labels.
+        If {batch_data} is given, the placeholders take their values from it 
+        by default, so the tower reads straight from the dataset iterator and 
+        feeding the placeholders is only needed to override the batch.
+
+        Args:
+            tower_idx: the index number for this tower;
+            batch_data: a feature dictionary of the next batch of the tower 
+                from the dataset iterator, or None to build plain placeholders.
+        Returns:
+            batched_images: images placeholder, (?, depth, h, w), or 
+                (?, h, w, depth) if the data format is NHWC;
+            batched_labels: one-hot labels placeholder, (?, num_classes).
+        """
+        image_size = self._specs['image_size']
+        image_depth = self._specs['depth']
+        num_classes = self._specs['num_classes']
+        if self._hparams.data_format == 'NHWC':
+            images_shape = [None, image_size, image_size, image_depth]
+        else:
+            images_shape = [None, image_depth, image_size, image_size]
+        labels_shape = [None, num_classes]
+
+        if batch_data is None:
+            batched_images = tf.placeholder(tf.float32, 
+                shape=images_shape, name='batched_images')
+            batched_labels = tf.placeholder(tf.int32, 
+                shape=labels_shape, name='batched_labels')
+        else:
+            batched_images = tf.placeholder_with_default(
+                batch_data['images'], shape=images_shape, name='batched_images')
+            batched_labels = tf.placeholder_with_default(
+                tf.cast(batch_data['labels'], tf.int32), shape=labels_shape, 
+                name='batched_labels')
+        """visual"""
+        tf.add_to_collection('tower_%d_batched_images' % tower_idx, batched_images)
+        tf.add_to_collection('tower_%d_batched_labels' % tower_idx, batched_labels)
+
+        return batched_images, batched_labels
+
+    @abc.abstractmethod
+    def build_replica(self, tower_idx, batch_data=None):
         """Adds a replica graph ops.
 
         Builds the architecture of the neural net to derive logits from 
@@ -122,13 +198,15 @@ class Model(object):
 
         Args:
             tower_idx: the index number for this tower. Each tower is named
-                as tower_{tower_idx} and resides on gpu:{tower_idx}.
+                as tower_{tower_idx} and resides on gpu:{tower_idx};
+            batch_data: a feature dictionary of the next batch from the 
+                dataset iterator, the default values of the input placeholders.
         Returns:
             Inferred namedtuple containing (logits, None).
         """
         raise NotImplementedError('Not implemented.')
 
-    def _build_single_tower(self, tower_idx):
+    def _build_single_tower(self, tower_idx, batch_data=None):
         """Calculates the model gradient for one tower.
         
         Adds the inference and loss operations to the graph. Calculates the 
@@ -136,15 +214,18 @@ class Model(object):
 
         Args:
             tower_idx: the index number for this tower. Each tower is named
-                as tower_{tower_idx} and resides on gpu:{tower_idx}.
+                as tower_{tower_idx} and resides on the device of replica
+                {tower_idx} of the device strategy;
+            batch_data: a feature dictionary of the next batch from the 
+                dataset iterator, or None to feed the inputs.
         Returns:
             TowerResult: a namedtuple containing inferred logits, number of correct
                 predictions per batch, and the gradients 
         """
-        with tf.device('/gpu:%d' % tower_idx):
+        with tf.device(self._strategy.device_fn(tower_idx)):
             with tf.name_scope('tower_%d' % tower_idx) as scope:
                 # build a tower/replica
-                inferred = self.build_replica(tower_idx)
+                inferred = self.build_replica(tower_idx, batch_data)
                 # calculate the loss and number of correct predictions per batch
                 total_loss, num_correct_per_batch, accuracy = utils.evaluate(
                     logits=inferred.logits,
@@ -156,12 +237,16 @@ class Model(object):
         
         return TowerResult(inferred, num_correct_per_batch, accuracy, grads)
 
-    def build_model_on_multi_gpus(self):
+    def build_model_on_multi_gpus(self, iterator=None):
         """Build the model and Graph and add the train ops on single GPUs.
 
-        Divides the inference and gradient computation on multiple GPUs.
-        The aggregates the gradients and return the resultant ops.
+        Divides the inference and gradient computation on the replicas of 
+        the device strategy, multiple GPUs by default. The aggregates the 
+        gradients and return the resultant ops.
 
+        Args:
+            iterator: dataset iterator, if given, every batch of the iterator
+                is split among the towers inside the graph instead of being fed.
         Returns:
             joined_results: a namedtuple containing 
         """
@@ -169,10 +254,16 @@ class Model(object):
         corrects = []
         accuracies = []
         tower_grads = []
+        # the next batch of all the towers, prefetched by the dataset
+        tower_batches = [None] * self._specs['num_gpus']
+        if iterator is not None:
+            with tf.device(self._strategy.input_device):
+                tower_batches = input_utils.split_batch(
+                    iterator.get_next(), self._specs['num_gpus'])
         with tf.variable_scope(tf.get_variable_scope()):
             for i in range(self._specs['num_gpus']):
                 # build single tower
-                tower_output = self._build_single_tower(i)
+                tower_output = self._build_single_tower(i, tower_batches[i])
                 # append to lists
                 inferreds.append(tower_output.inferred)
                 corrects.append(tower_output.correct)
@@ -188,4 +279,48 @@ class Model(object):
         tf.add_to_collection('accuracy', joined_result.accuracy)
 
         return joined_result
-        
+
+    def build_model_for_collective(self, iterator=None):
+        """Build a single tower whose gradients are averaged with the towers 
+        of the other training processes outside of the graph.
+
+        The gradients of the tower are fetched, averaged by the collective of
+        the processes and fed back into the placeholders of the train op, so 
+        that every process applies the same update to its own variables.
+
+        Args:
+            iterator: dataset iterator, if given, the tower takes its own 
+                batch from the iterator inside the graph instead of being fed.
+        Returns:
+            collective_result: a namedtuple containing the summary, the 
+                gradients, their placeholders, the train op, the number of 
+                correct predictions and the accuracy of the tower.
+        """
+        with tf.variable_scope(tf.get_variable_scope()):
+            batch_data = None
+            if iterator is not None:
+                with tf.device(self._strategy.input_device):
+                    batch_data = iterator.get_next()
+            tower_output = self._build_single_tower(0, batch_data)
+        grads_and_vars = [(grad, var) for grad, var in tower_output.grads 
+                          if grad is not None]
+
+        with tf.device(self._strategy.variable_device):
+            # the averaged gradients are fed in every step
+            with tf.name_scope('averaged_grads'):
+                grad_placeholders = [tf.placeholder(grad.dtype, grad.get_shape())
+                                     for grad, _ in grads_and_vars]
+            train_op = self._optimizer.apply_gradients(
+                zip(grad_placeholders, [var for _, var in grads_and_vars]),
+                global_step=self._global_step)
+        summaries = tf.get_collection(tf.GraphKeys.SUMMARIES)
+        summary = tf.summary.merge(summaries)
+
+        tf.add_to_collection('summary', summary)
+        tf.add_to_collection('train_op', train_op)
+        tf.add_to_collection('correct', tower_output.correct)
+        tf.add_to_collection('accuracy', tower_output.accuracy)
+
+        return CollectiveResult(summary, [grad for grad, _ in grads_and_vars], 
+                                grad_placeholders, train_op, 
+                                tower_output.correct, tower_output.accuracy)
@@ -35,8 +35,7 @@ def compare_targetCap_vs_diffDims(model_dataset_lvl_dir, obj_type, instance_num,
         fig, axes = plt.subplots(nrows=1, ncols=ncols, figsize=(ncols*1.4, 1.4))
         axes = np.reshape(axes, (1, ncols))
         for j, iter_n in enumerate(selected_iter_ns):
-            data = np.load(os.path.join(
-                load_dir, 'instance_{}-cap_{}-dim_{}.npz'.format(instance_num, cap_idx, i)))
+            data = utils.load_result(load_dir, instance_num, cap_idx, i)
             ax = axes[0, j]
 
             tar_idx = data['iters'].tolist().index(iter_n)
@@ -106,8 +105,7 @@ def compare_targetCap_vs_diffDims_Distribution(model_dataset_lvl_dir, obj_type,
         axes = np.reshape(axes, (1, ncols))
 
         for j, iter_n in enumerate(selected_iter_ns):
-            data = np.load(os.path.join(
-                load_dir, 'instance_{}-cap_{}-dim_{}.npz'.format(instance_num, cap_idx, i)))
+            data = utils.load_result(load_dir, instance_num, cap_idx, i)
             ax = axes[0, j]
 
             tar_idx = data['iters'].tolist().index(iter_n)
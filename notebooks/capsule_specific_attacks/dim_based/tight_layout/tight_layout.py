@@ -31,8 +31,7 @@ def compare_targetCap_vs_diffDims(model_dataset_lvl_dir, obj_type, instance_num,
 
     for i in range(nrows):
         for j, iter_n in enumerate(selected_iter_ns):
-            data = np.load(os.path.join(
-                load_dir, 'instance_{}-cap_{}-dim_{}.npz'.format(instance_num, cap_idx, i)))
+            data = utils.load_result(load_dir, instance_num, cap_idx, i)
             
             tar_idx = data['iters'].tolist().index(iter_n)
             img_raw = np.clip(np.squeeze(data['images'][tar_idx], axis=0), 0., 1.)
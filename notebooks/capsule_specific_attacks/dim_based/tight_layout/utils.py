@@ -3,8 +3,14 @@ Utility file functions
 """
 
 import os 
+import sys
 from glob import glob
 
+# result store reader at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                os.pardir, os.pardir, os.pardir, os.pardir))
+from result_store import load_result
+
 AVAILABLE_ITER_NS = [1, 2, 3, 4, 5,
                      10, 20, 40, 60, 80, 100]
 
@@ -40,4 +46,3 @@ def get_load_dir(dataset_lvl_dir, obj_type):
     """
     load_dir_list = glob(os.path.join(dataset_lvl_dir, obj_type, '*'))
     return load_dir_list[0]
-
@@ -41,11 +41,9 @@ def compare_Ori_vs_Tar(model_dataset_lvl_dir, obj_type, instance_num, cap_idx,
         axes = np.reshape(axes, (1, ncols))
         for j, iter_n in enumerate(selected_iter_ns):
             if diffOris_vs_sameTar:
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, i, cap_idx)))
+                data = utils.load_result(load_dir, instance_num, i, cap_idx)
             else:
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, cap_idx, i)))
+                data = utils.load_result(load_dir, instance_num, cap_idx, i)
             
             ax = axes[0, j]
 
@@ -132,11 +130,9 @@ def compare_Ori_vs_Tar_Distribution(model_dataset_lvl_dir, obj_type, instance_nu
         
         for j, iter_n in enumerate(selected_iter_ns):
             if diffOris_vs_sameTar:
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, i, cap_idx)))
+                data = utils.load_result(load_dir, instance_num, i, cap_idx)
             else:
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, cap_idx, i)))
+                data = utils.load_result(load_dir, instance_num, cap_idx, i)
             
             ax = axes[0, j]
             tar_idx = data['iters'].tolist().index(iter_n)
@@ -3,8 +3,14 @@ Utility file functions
 """
 
 import os 
+import sys
 from glob import glob
 
+# result store reader at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                os.pardir, os.pardir, os.pardir, os.pardir))
+from result_store import load_result
+
 MNIST_CATEGORIES = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
 CIFAR10_CATEGORIES = ['airplane', 'automobile', 'bird', 'cat', 'deer', 'dog', 'frog', 'horse', 'ship', 'truck']
 
@@ -48,4 +54,3 @@ def get_load_dir(dataset_lvl_dir, obj_type):
     """
     load_dir_list = glob(os.path.join(dataset_lvl_dir, obj_type, '*'))
     return load_dir_list[0]
-
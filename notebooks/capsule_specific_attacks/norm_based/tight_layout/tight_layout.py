@@ -41,11 +41,9 @@ def compare_Ori_vs_Tar_tight(model_dataset_lvl_dir, obj_type, instance_num, cap_
     for i in range(nrows):
         for j, iter_n in enumerate(selected_iter_ns):
             if diffOris_vs_sameTar: 
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, i, cap_idx)))
+                data = utils.load_result(load_dir, instance_num, i, cap_idx)
             else:
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, cap_idx, i)))
+                data = utils.load_result(load_dir, instance_num, cap_idx, i)
             
             tar_idx = data['iters'].tolist().index(iter_n)
             img_raw = np.clip(np.squeeze(data['images'][tar_idx], axis=0), 0., 1.)
@@ -14,6 +14,7 @@
 # ==============================================================================
 
 import os 
+import sys
 import numpy as np 
 from glob import glob 
 import matplotlib.pyplot as plt 
@@ -52,6 +53,10 @@ AVAILABLE_ITER_NS = [1, 2, 3, 4, 5,
 NORM_ASPECT_METHODS = ['naive_max_norm', 'max_norm_diff']
 DIRECTION_ASPECT_METHODS = ['naive_max_caps_dim', 'max_norm_diff']
 
+"""Result store reader at the root of the repository"""
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from result_store import load_result
+
 """Set up data directories"""
 data_dir = '/Users/xu/Storage/vis'
 
@@ -94,6 +99,7 @@ def get_load_dir(dataset_lvl_dir, obj_type):
     assert len(load_dir_list) == 1
     return load_dir_list[0]
 
+
 """Plot training vs testing curves"""
 def get_evaluate_results(dataset_lvl_dir):
     """Get train and test accuracies against epochs.
@@ -256,11 +262,9 @@ def compare_Ori_vs_Tar(model_dataset_lvl_dir, obj_type, instance_num, cap_idx,
     for i in range(nrows): # classes
         for j, iter_n in enumerate(selected_iter_ns): # iterations
             if diffOris_vs_sameTar:
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, i, cap_idx)))
+                data = load_result(load_dir, instance_num, i, cap_idx)
             else:
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, cap_idx, i)))
+                data = load_result(load_dir, instance_num, cap_idx, i)
             
             # define ax for convenient access
             ax = axes[i, j]
@@ -394,11 +398,9 @@ def compare_Ori_vs_Tar_Distribution(model_dataset_lvl_dir, obj_type, instance_nu
     for i in range(nrows): # classes
         for j, iter_n in enumerate(selected_iter_ns): # iterations
             if diffOris_vs_sameTar:
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, i, cap_idx)))
+                data = load_result(load_dir, instance_num, i, cap_idx)
             else:
-                data = np.load(os.path.join(
-                    load_dir, 'instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, cap_idx, i)))
+                data = load_result(load_dir, instance_num, cap_idx, i)
             
             # define ax for convenient access
             ax = axes[i, j]
@@ -508,8 +510,7 @@ def compare_mostActiveCap_vs_diffDims(model_dataset_lvl_dir, obj_type, instance_
     """Plot visualizations"""
     for i in range(nrows):
         for j, iter_n in enumerate(selected_iter_ns):
-            data = np.load(os.path.join(
-                load_dir, 'instance_{}-cap_{}-dim_{}.npz'.format(instance_num, cap_idx, i)))
+            data = load_result(load_dir, instance_num, cap_idx, i)
             
             # define ax for convenient access
             ax = axes[i, j]
@@ -621,8 +622,7 @@ def compare_mostActiveCap_vs_diffDims_Distribution(model_dataset_lvl_dir, obj_ty
     """Plot visualizations"""
     for i in range(nrows):
         for j, iter_n in enumerate(selected_iter_ns):
-            data = np.load(os.path.join(
-                load_dir, 'instance_{}-cap_{}-dim_{}.npz'.format(instance_num, cap_idx, i)))
+            data = load_result(load_dir, instance_num, cap_idx, i)
             
             # define ax for convenient access
             ax = axes[i, j]
@@ -0,0 +1,322 @@
+# Copyright 2018 Xu Chen All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Appendable store of the exploration results of one run.
+
+Every row of the store holds the results of one gradient ascent, keyed by
+(instance, class, k), where class is lbl0 (norm aspect) or the capsule
+(direction aspect) and k is lbl1 (norm aspect) or the dimension (direction
+aspect). Rows are appended in chunks, one chunk per ascended image.
+
+.                       <--- store_dir
+├── meta.json           <--- number of rows, dtype and row shape of every field
+├── index.bin           <--- (instance, class, k) key of every row, int32
+├── iters.bin           <--- (num_rows, n_recorded)
+├── images.bin          <--- (num_rows, n_recorded, 1, C, H, W)
+├── pred.bin            <--- (num_rows, n_recorded, 10)
+└── pred_entropy.bin    <--- (num_rows, n_recorded)
+
+Only those rows counted in meta.json are valid, so a run that dies while
+appending leaves a readable store behind.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import queue
+import atexit
+import threading
+import contextlib
+import numpy as np
+
+FIELDS = ['iters', 'images', 'pred', 'pred_entropy']
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w'):
+    """Open a temporary file next to {path}, which replaces {path} once it 
+    is completely written, so concurrent readers either see the old or the 
+    whole new file, never a partial one.
+
+    Args:
+        path: path of the file to write;
+        mode: 'w' or 'wb'.
+    Yields:
+        the opened temporary file.
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class ResultStore(object):
+    """Chunked result store of one exploration run, memory mapped for reading."""
+
+    def __init__(self, store_dir, mode='r'):
+        """Open a result store.
+
+        Args:
+            store_dir: the directory of the store;
+            mode: 'r' to read an existing store, 'a' to create or append to it,
+                'w' to create it and drop the rows of an existing one.
+        """
+        assert mode in ['r', 'a', 'w']
+        self.store_dir = store_dir
+        self._meta_path = os.path.join(store_dir, 'meta.json')
+        self._lookup = None
+        self._files = {}
+
+        if mode == 'w':
+            # an empty store is then written over the existing one
+            if os.path.exists(self._meta_path):
+                os.remove(self._meta_path)
+            mode = 'a'
+        self.mode = mode
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, 'r') as f:
+                self._meta = json.load(f)
+        elif mode == 'a':
+            if not os.path.exists(store_dir):
+                os.makedirs(store_dir)
+            self._meta = {'num_rows': 0, 'fields': {}}
+        else:
+            raise IOError('Result store not found in {}!'.format(store_dir))
+
+        if mode == 'a':
+            # drop the rows that were written but never counted
+            self._truncate()
+            self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._meta['num_rows']
+
+    def __getitem__(self, name):
+        return self.field(name)
+
+    def _path(self, name):
+        return os.path.join(self.store_dir, '%s.bin' % name)
+
+    def _row_nbytes(self, name):
+        if name == 'index':
+            return 3 * np.dtype(np.int32).itemsize
+        spec = self._meta['fields'][name]
+        return int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize
+
+    def _truncate(self):
+        for name in ['index'] + FIELDS:
+            path = self._path(name)
+            if os.path.exists(path):
+                if name in self._meta['fields'] or name == 'index':
+                    with open(path, 'r+b') as f:
+                        f.truncate(len(self) * self._row_nbytes(name))
+                else:
+                    # left over from a store that was written over
+                    os.remove(path)
+
+    def _write_meta(self):
+        with atomic_open(self._meta_path) as f:
+            json.dump(self._meta, f)
+
+    def append(self, keys, **fields):
+        """Append a chunk of rows to the store.
+
+        Args:
+            keys: (instance, class, k) key of every row, (n, 3);
+            fields: arrays of every field in FIELDS, each with n rows.
+        """
+        assert self.mode == 'a'
+        keys = np.asarray(keys, dtype=np.int32)
+        assert keys.ndim == 2 and keys.shape[1] == 3
+        assert sorted(fields) == sorted(FIELDS)
+
+        for name in FIELDS:
+            arr = np.asarray(fields[name])
+            assert arr.shape[0] == keys.shape[0]
+            if name not in self._meta['fields']:
+                # the first chunk decides the dtype and row shape of the field
+                self._meta['fields'][name] = {
+                    'dtype': arr.dtype.str, 'shape': list(arr.shape[1:])}
+            spec = self._meta['fields'][name]
+            assert list(arr.shape[1:]) == spec['shape']
+            self._file(name).write(
+                np.ascontiguousarray(arr, dtype=spec['dtype']).tobytes())
+        self._file('index').write(keys.tobytes())
+
+        for f in self._files.values():
+            f.flush()
+        # rows only become valid after the meta file is updated
+        self._meta['num_rows'] += keys.shape[0]
+        self._write_meta()
+        self._lookup = None
+
+    def _file(self, name):
+        if name not in self._files:
+            self._files[name] = open(self._path(name), 'ab')
+        return self._files[name]
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def keys(self):
+        """Memory mapped (instance, class, k) keys of every row, (num_rows, 3)."""
+        if len(self) == 0:
+            return np.zeros((0, 3), dtype=np.int32)
+        return np.memmap(self._path('index'), dtype=np.int32, mode='r',
+                         shape=(len(self), 3))
+
+    def field(self, name):
+        """Memory mapped rows of the given field, (num_rows, ...)."""
+        spec = self._meta['fields'][name]
+        shape = tuple([len(self)] + spec['shape'])
+        if len(self) == 0:
+            return np.zeros(shape, dtype=spec['dtype'])
+        return np.memmap(self._path(name), dtype=spec['dtype'], mode='r',
+                         shape=shape)
+
+    def find(self, instance, cls, k):
+        """Row index of the given key, None if it was not stored."""
+        if self._lookup is None:
+            self._lookup = {tuple(key): row
+                            for row, key in enumerate(self.keys().tolist())}
+        return self._lookup.get((instance, cls, k))
+
+    def get(self, instance, cls, k):
+        """Results of the given key, same as the keys of the old npz files.
+
+        Args:
+            instance: instance number;
+            cls: lbl0 (norm aspect) or capsule index (direction aspect);
+            k: lbl1 (norm aspect) or dimension index (direction aspect).
+        Returns:
+            a dictionary of every field in FIELDS of the row.
+        """
+        row = self.find(instance, cls, k)
+        if row is None:
+            raise KeyError((instance, cls, k))
+        return {name: self.field(name)[row] for name in FIELDS}
+
+class AsyncResultWriter(object):
+    """Append chunks to a result store from a background thread, so that the
+    next gradient ascent runs while the results of the last one are written.
+
+    The queue is bounded, when the disk falls behind append() blocks until
+    there is room again. Pending chunks are flushed on close() and at exit.
+    Once a write failed, the error of the writer thread is raised in the 
+    caller on every later call, the chunks after the failed one are never 
+    written.
+    """
+
+    def __init__(self, store, max_pending=8):
+        """Start the writer thread.
+
+        Args:
+            store: a ResultStore opened with mode 'a';
+            max_pending: maximum number of chunks waiting to be written.
+        """
+        assert store.mode == 'a'
+        self.store = store
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is None:
+                try:
+                    keys, fields = item
+                    self.store.append(keys, **fields)
+                except Exception as e:
+                    # keep consuming so that the caller never blocks forever,
+                    # the error stays latched and the later chunks are dropped
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def append(self, keys, **fields):
+        """Queue a chunk of rows, same arguments as ResultStore.append. The 
+        arrays should not be modified afterwards."""
+        assert not self._closed
+        self._raise_error()
+        self._queue.put((keys, fields))
+
+    def close(self):
+        """Write all the pending chunks and close the store."""
+        if not self._closed:
+            self._closed = True
+            atexit.unregister(self.close)
+            self._queue.put(None)
+            self._thread.join()
+            self.store.close()
+        self._raise_error()
+
+# opened result stores of load_result(), keyed by load_dir
+_open_stores = {}
+
+def load_result(load_dir, instance_num, cls, k):
+    """Load the results of one gradient ascent.
+
+    Args:
+        load_dir: loading directory of the run;
+        instance_num: instance number of the example;
+        cls: lbl0 (norm aspect) or capsule index (direction aspect);
+        k: lbl1 (norm aspect) or dimension index (direction aspect).
+    Returns:
+        data: a dictionary with 'iters', 'images', 'pred' and 'pred_entropy',
+            memory mapped from the result store of the run.
+    Raises:
+        FileNotFoundError: the run has no result of the ascent.
+    """
+    if not os.path.exists(os.path.join(load_dir, 'meta.json')):
+        # runs before the result store wrote one npz file per ascent
+        fnames = ['instance_{}-lbl0_{}-lbl1_{}.npz'.format(instance_num, cls, k),
+                  'instance_{}-cap_{}-dim_{}.npz'.format(instance_num, cls, k)]
+        fpaths = [os.path.join(load_dir, fname) for fname in fnames]
+        for fpath in fpaths:
+            if os.path.exists(fpath):
+                return np.load(fpath)
+        raise FileNotFoundError(
+            'No result of instance {}, cls {}, k {}, searched: {}'.format(
+                instance_num, cls, k, ', '.join(fpaths)))
+    if load_dir not in _open_stores:
+        _open_stores[load_dir] = ResultStore(load_dir)
+    return _open_stores[load_dir].get(instance_num, cls, k)